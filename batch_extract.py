@@ -0,0 +1,16 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from utils.common import extractor_batch
+from extractors import *
+
+"""
+    Run any registered extractor over a set of inputs, each of them
+    being written to its own folder, using a pool of processes. A
+    summary of timing, written .protos and failures for each input is
+    printed and saved to "summary.json".
+    
+    Usage: ./batch_extract.py [-h] [-m MANIFEST] [-j JOBS] extractor [inputs ...] output_dir [extractor options]
+"""
+
+if __name__ == '__main__':
+    extractor_batch()
@@ -2,6 +2,10 @@
 #-*- encoding: Utf-8 -*-
 from google.protobuf.descriptor_pb2 import FileDescriptorProto
 from google.protobuf.internal.decoder import _DecodeVarint
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from mmap import mmap, ACCESS_READ
+from os import cpu_count
 
 from os.path import dirname, realpath
 __import__('sys').path.append(dirname(realpath(__file__)) + '/..')
@@ -18,30 +22,129 @@ from utils.descpb_to_proto import descpb_to_proto
     in an undesirable way (bruteforcing the length of messages rather
     than calculating it, also failing part of time).
     
+    Input files are memory-mapped rather than read, and descriptors are
+    parsed straight from the mapping, so that scanning large firmware
+    images or memory dumps doesn't require to hold them in memory.
+    
+    With --jobs, the input is split into windows that are scanned in
+    parallel by a pool of processes, each of which maps the whole file
+    (so that the 1024-byte lookback and the descriptor's extent may
+    freely cross the window's bounds). Results are then merged so that
+    the output is the same as with the serial scan.
+    
     [1] https://github.com/google/protobuf/blob/15a15/src/google/protobuf/compiler/cpp/cpp_file.cc#L693
     [2] https://github.com/google/protobuf/blob/bb77c/src/google/protobuf/descriptor.proto#L59
     [3] https://github.com/sysdream/Protod/blob/master/protod
     
-    Usage: ./from_binary.py <infile> [<outdir>]
+    Usage: ./from_binary.py [-j JOBS] <infile> [<outdir>]
 """
 
+CHUNK_SIZE = 16 << 20
+
 @register_extractor(name = 'from_binary',
-                    desc = 'Extract Protobuf metadata from binary file (*.dll, *.so...)')
-def walk_binary(binr):
-    if type(binr) == str:
+                    desc = 'Extract Protobuf metadata from binary file (*.dll, *.so...)',
+                    options = {'--jobs': {'type': int, 'default': 1, 'metavar': 'N',
+                                          'help': 'Scan the file using N processes (0 for all CPUs)'}})
+def walk_binary(binr, jobs=1):
+    with map_binary(binr) as mapped:
+        if mapped is None:
+            return
+        
+        jobs = jobs or cpu_count()
+        if jobs > 1 and len(mapped) > CHUNK_SIZE:
+            candidates = find_descriptors_parallel(binr, len(mapped), jobs)
+        else:
+            candidates = find_descriptors(mapped)
+        
+        with memoryview(mapped) as view:
+            for start, end in skip_nested(candidates):
+                # Parse descriptor, without copying it out of the buffer
+                proto = FileDescriptorProto()
+                proto.ParseFromString(view[start:end])
+                
+                # Convert to ascii
+                yield descpb_to_proto(proto)
+
+"""
+    Candidates located inside of an already parsed descriptor (i.e
+    dependencies names) are skipped.
+"""
+
+def skip_nested(candidates):
+    last_end = 0
+    
+    for match, start, end in candidates:
+        if match < last_end:
+            continue
+        last_end = end
+        
+        yield start, end
+
+"""
+    Return the serialized descriptors found in a file, without parsing
+    them, so that these found in several files (i.e the same library
+    built for different architectures) can be deduplicated first, and
+    converted once through descriptor_to_proto().
+"""
+
+def read_descriptors(binr):
+    with map_binary(binr) as mapped:
+        if mapped is None:
+            return []
+        
+        return [bytes(mapped[start:end]) for start, end in skip_nested(find_descriptors(mapped))]
+
+def descriptor_to_proto(serialized):
+    return descpb_to_proto(FileDescriptorProto.FromString(serialized))
+
+"""
+    Provide a buffer supporting find() and slicing for either a file
+    path (which is memory-mapped), or bytes-like data.
+"""
+
+@contextmanager
+def map_binary(binr):
+    if type(binr) != str:
+        yield binr
+        return
+    
+    try:
+        fd = open(binr, 'rb')
+    except Exception:
+        yield None
+        return
+    
+    with fd:
         try:
-            with open(binr, 'rb') as fd:
-                binr = fd.read()
-        except Exception:
+            binr = mmap(fd.fileno(), 0, access=ACCESS_READ)
+        except ValueError: # Empty file
+            yield b''
             return
+        
+        with binr:
+            yield binr
+
+"""
+    Yield the offsets of every plausible serialized FileDescriptorProto
+    whose name field ends in [begin, until), as (match, start, end)
+    tuples. "match" is the position of the ".proto" string that led to
+    the candidate, "start" and "end" delimit the descriptor.
+    
+    Candidates may overlap (a descriptor embeds the names of the files
+    it depends on), it is up to the caller to discard these.
+"""
+
+def find_descriptors(binr, begin=0, until=None):
+    if until is None:
+        until = len(binr)
     
     # Search for:
     # ".proto" or ".protodevel", as part of the "name" (1) field
-    cursor = 0
-    while cursor < len(binr):
-        cursor = binr.find(b'.proto', cursor)
+    cursor = begin
+    while cursor < until:
+        match = cursor = binr.find(b'.proto', cursor, until + len('.proto'))
         
-        if cursor == -1:
+        if cursor == -1 or cursor >= until:
             break
         cursor += len('.proto')
         cursor += (binr[cursor:cursor + 5] == b'devel') * 5
@@ -61,21 +164,39 @@ def walk_binary(binr):
         
         # Look just after for subsequent markers
         tags = b'\x12\x1a\x22\x2a\x32\x3a\x42\x4a\x50\x58\x62'
-        if binr[cursor] not in tags:
+        if cursor >= len(binr) or binr[cursor] not in tags:
             continue
         
-        while cursor < len(binr) and binr[cursor] in tags:
-            tags = tags[tags.index(binr[cursor]):]
+        end = cursor
+        while end < len(binr) and binr[end] in tags:
+            tags = tags[tags.index(binr[end]):]
             
-            varint, end = _DecodeVarint(binr, cursor + 1)
-            cursor = end + varint * (binr[cursor] & 0b111 == 2)
-        
-        # Parse descriptor
-        proto = FileDescriptorProto()
-        proto.ParseFromString(binr[start:cursor])
+            varint, next_end = _DecodeVarint(binr, end + 1)
+            end = next_end + varint * (binr[end] & 0b111 == 2)
         
-        # Convert to ascii
-        yield descpb_to_proto(proto)
+        yield match, start, end
+
+"""
+    Same as find_descriptors(), but dispatch windows of the input to a
+    process pool. Candidates are yielded in order.
+"""
+
+def find_descriptors_parallel(binr, size, jobs):
+    windows = [(begin, min(begin + CHUNK_SIZE, size)) for begin in range(0, size, CHUNK_SIZE)]
+    
+    with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(binr,)) as pool:
+        for candidates in pool.map(_find_descriptors_window, windows):
+            yield from candidates
+
+def _init_worker(binr):
+    global _worker_mapping, _worker_binr
+    
+    # Keep the input mapped for the lifetime of the worker
+    _worker_mapping = map_binary(binr)
+    _worker_binr = _worker_mapping.__enter__()
+
+def _find_descriptors_window(window):
+    return list(find_descriptors(_worker_binr, *window))
 
 if __name__ == '__main__':
     extractor_main('from_binary')
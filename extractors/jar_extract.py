@@ -1,21 +1,32 @@
 #!/usr/bin/python3
 #-*- encoding: Utf-8 -*-
-from google.protobuf.descriptor_pb2 import DescriptorProto, EnumDescriptorProto, FieldDescriptorProto
-from re import findall, MULTILINE, search, split, sub, escape, finditer
+from google.protobuf.descriptor_pb2 import FieldDescriptorProto
+from re import findall, MULTILINE, search, split, sub, finditer, compile
 from typing import Dict, List, Set, Sequence, Optional
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, get_all_start_methods
 from collections import OrderedDict, defaultdict
+from contextlib import redirect_stdout
+from io import StringIO
 from itertools import count, product
 from string import ascii_lowercase
 from ctypes import c_int, c_long
-from struct import pack, unpack
+from struct import pack, unpack, error
 from ast import literal_eval
+from json import dump, dumps, load
+from hashlib import sha1
+from os import replace
 
 from os.path import dirname, realpath
 __import__('sys').path.append(dirname(realpath(__file__)) + '/..')
 from utils.common import register_extractor, extractor_main
 from utils.nest_messages import nest_and_print_to_files
 from extractors.from_binary import walk_binary
-from utils.java_wrapper import JarWrapper
+from utils.decomp_cache import DecompCache
+from utils.java_wrapper import JarWrapper, MAX_MEMORY
+from utils.proto_schema import Message, Enum, EnumValue, Field, load_schema
+from utils.class_file import ClassInfo, read_instructions, OP_ILOAD, OP_ISTORE, OP_ASTORE, OP_IFEQ, OP_IFNE, OP_GOTO, OP_GOTO_W, \
+                             OP_TABLESWITCH, OP_LOOKUPSWITCH, OP_INVOKES, OP_INVOKESPECIAL, OP_INVOKESTATIC, OP_BRANCHES, OP_JSR_W
 
 """
     This script aims to provide a complete Protobuf structure extraction
@@ -24,35 +35,59 @@ from utils.java_wrapper import JarWrapper
     Most of these (Lite, Nano, Micro) share a common structure in generated
     code. In a common logic for processing them, important library classes
     (such as CommonInputStream/CommonOutputStream) are first recognized
-    through simple string signatures.
+    through the strings, method signatures and class references found
+    in their constant pool.
 
     Then, generated classes are decompiled and parsed based on a regexp
     system (somewhat less burdensome than following bytecode structure),
     calls to library classes and their context are analyzed, and this
-    information is used to reconstruct the Protobuf structure.
+    information is used to reconstruct the Protobuf structure. Field
+    numbers and wire types are read from the bytecode of the switch in
+    parsing methods instead, unless it's ambiguous.
 
     The decompiler used is Jad. Although slighty outdated, it produces more
     complete output on erroring classes (rather than failing or omitting
-    code, like other tools), and is blazing fast. Dex-to-Jar conversion is
-    operated using dex2jar.
+    code, like other tools), and is blazing fast. DEX files are scanned
+    natively, and Dex-to-Jar conversion is operated using dex2jar only for
+    these holding classes that need to be decompiled.
 """
 
 @register_extractor(name = 'jar_extract',
-                    desc = 'Extract Protobuf structures from any Java code (*.jar, *.dex, *.apk)',
-                    depends={'binaries': ['java']})
-def handle_jar(path):
+                    desc = 'Extract Protobuf structures from any Java code (*.jar, *.dex, *.apk, *.aab, *.apks, *.xapk)',
+                    depends={'binaries': ['java']},
+                    options={'--jobs': {'type': int, 'metavar': 'N',
+                                        'help': 'Number of concurrent decompiler and extraction processes (defaults to the number of CPUs)'},
+                             '--no-cache': {'action': 'store_true',
+                                            'help': 'Don\'t use the persistent cache of decompiled classes'},
+                             '--clear-cache': {'action': 'store_true',
+                                               'help': 'Empty the persistent cache of decompiled classes first'},
+                             '--decompiler': {'metavar': 'COMMAND',
+                                              'help': 'Command starting a persistent decompiler server producing Jad-compatible output, to be used instead of Jad (see utils/decompilers.py)'},
+                             '--max-memory': {'type': int, 'metavar': 'MB',
+                                              'help': 'Memory budget for decompiled sources and parsed classes, per process (defaults to 1024)'},
+                             '--triage': {'action': 'store_true',
+                                          'help': 'Only list the Protobuf runtimes and generated classes found to inventory.json, without decompiling anything'},
+                             '--root': {'metavar': 'CLASS',
+                                        'help': 'Only extract this message class (i.e "com.foo.Bar"), and the messages and enums it refers to'},
+                             '--state': {'metavar': 'FILE',
+                                         'help': 'Keep per-class results in this file, so that only classes that changed are extracted again on the next run (e.g over a newer build of the same application)'}})
+def handle_jar(path, jobs=None, no_cache=False, clear_cache=False, decompiler=None, max_memory=None, triage=False, root=None, state=None):
+    if clear_cache:
+        DecompCache().clear()
+    
     # Scan classes for Java Protobuf string signatures
     
     if path.endswith('.jar'):
         yield '_progress', ('Decompressing JAR...', None)
     else:
-        yield '_progress', ('Converting DEX to JAR...', None)
+        yield '_progress', ('Indexing DEX...', None)
     
-    with JarWrapper(path) as jar:
+    with JarWrapper(path, jobs, cache=not no_cache, max_memory=(max_memory or MAX_MEMORY >> 20) << 20, decompiler=decompiler) as jar:
         enums = {}
         
         pkg_to_codedinputstream = OrderedDict()
         pkg_to_codedoutputstream = {}
+        codedinputstream_runtimes = {} # For a given CodedInputStream, "lite", "nano" or "micro"
         map_entry_cls = []
         out_additional_cls = []
         
@@ -62,16 +97,18 @@ def handle_jar(path):
         First iteration on classes: look for library classes signatures.
         """
         
+        class_infos = {} # For a given class, the contents of its constant pool
+        
         for i, cls in enumerate(jar.classes):
             if i % 10 == 0:
                 yield '_progress', ('Scanning Java package contents...', (i / len(jar.classes)) * 0.5)
             
             pkg = cls[:cls.rfind('.')] if '.' in cls else ''
-            binr = jar.read(cls)
+            info = class_infos[cls] = jar.info(cls)
             
             # Search for CodedInputStream/CodedOutputStream
             
-            raw_cls = cls.replace('.', '/').encode('utf8')
+            raw_cls = cls.replace('.', '/')
             
             """
             Handle multiple cases:
@@ -86,22 +123,23 @@ def handle_jar(path):
             kinds that can be produced by Proguard) instead.
             """
             
-            SIG_NANO = b'([BII)V' # CodedInputByteBufferNano(final byte[] buffer, final int off, final int len)
-            SIG_NANO_2 = b'([BI)V' # CodedInputByteBufferNano(final byte[] buffer, final int bufferSize)
-            SIG_DEF = b'([BIIZ)L%s;' % raw_cls # static CodedInputStream newInstance(final byte[] buf, final int off, final int len, final boolean bufferIsImmutable)
-            SIG_DEF_2 = b'([BII)L%s;' % raw_cls # static CodedInputStream newInstance(final byte[] buf, final int off, final int len)
-            SIG_CALL = b'([BIIZ)V' # private ArrayDecoder(final byte[] buffer, final int offset, final int len, boolean immutable)
-            SIG_CALL_2 = b'([BII)V' # private ArrayDecoder(final byte[] buffer, final int offset, final int len)
-            SIG_CALL_3 = b'([BIIZL' # CodedInputStream$ArrayDecoder(byte abyte0[], int i, int j, boolean flag, com.google.protobuf.CodedInputStream$1 codedinputstream$1)
+            SIG_NANO = '([BII)V' # CodedInputByteBufferNano(final byte[] buffer, final int off, final int len)
+            SIG_NANO_2 = '([BI)V' # CodedInputByteBufferNano(final byte[] buffer, final int bufferSize)
+            SIG_DEF = '([BIIZ)L%s;' % raw_cls # static CodedInputStream newInstance(final byte[] buf, final int off, final int len, final boolean bufferIsImmutable)
+            SIG_DEF_2 = '([BII)L%s;' % raw_cls # static CodedInputStream newInstance(final byte[] buf, final int off, final int len)
+            SIG_CALL = '([BIIZ)V' # private ArrayDecoder(final byte[] buffer, final int offset, final int len, boolean immutable)
+            SIG_CALL_2 = '([BII)V' # private ArrayDecoder(final byte[] buffer, final int offset, final int len)
+            SIG_CALL_3 = '([BIIZL' # CodedInputStream$ArrayDecoder(byte abyte0[], int i, int j, boolean flag, com.google.protobuf.CodedInputStream$1 codedinputstream$1)
             
-            has_constructor = SIG_DEF in binr or SIG_DEF_2 in binr
-            calls_arraydecoder = SIG_CALL in binr or SIG_CALL_2 in binr or SIG_CALL_3 in binr
-            is_legit_class = b'Beginning index' not in binr and b'Number too large' not in binr and b'a byte array' not in binr
+            has_constructor = SIG_DEF in info.descriptors or SIG_DEF_2 in info.descriptors
+            calls_arraydecoder = SIG_CALL in info.descriptors or SIG_CALL_2 in info.descriptors or \
+                                 any(desc.startswith(SIG_CALL_3) for desc in info.descriptors)
+            is_legit_class = 'Beginning index' not in info.strings and 'Number too large' not in info.strings and 'a byte array' not in info.strings
             
-            has_constructor_nano = SIG_NANO in binr or SIG_NANO_2 in binr
-            has_relevant_string = b'message contained an invalid tag' in binr
-            has_relevant_string_nano = b'is beyond current' in binr
-            has_relevant_string_micro = b"when buffer wasn't empty" in binr
+            has_constructor_nano = SIG_NANO in info.descriptors or SIG_NANO_2 in info.descriptors
+            has_relevant_string = 'message contained an invalid tag' in info.strings
+            has_relevant_string_nano = 'is beyond current' in info.strings
+            has_relevant_string_micro = "when buffer wasn't empty" in info.strings
             
             """
             Try to match CodedOutputStream before CodedInputStream, as
@@ -109,12 +147,12 @@ def handle_jar(path):
             recognizable string.
             """
             
-            has_out_constructor = b'([BII' in binr
-            has_out_relevant_string = b'write as much data as' in binr
-            has_out_relevant_string_old = b'UTF-8 not supported.' in binr
-            has_out_relevant_string_nano = b'Unpaired surrogate at index ' in binr and b'wrap' in binr
-            has_out_relevant_string_2 = b'Converting ill-formed UTF-16.' in binr and b'Pos:' not in binr
-            is_legit_out_class = b'byte array' not in binr
+            has_out_constructor = any(desc.startswith('([BII') for desc in info.descriptors)
+            has_out_relevant_string = 'write as much data as' in info.strings
+            has_out_relevant_string_old = 'UTF-8 not supported.' in info.strings
+            has_out_relevant_string_nano = 'Unpaired surrogate at index ' in info.strings and 'wrap' in info.method_names
+            has_out_relevant_string_2 = 'Converting ill-formed UTF-16.' in info.strings and 'Pos:' not in info.strings
+            is_legit_out_class = 'byte array' not in info.strings
             
             if has_out_constructor and (\
                ((has_out_relevant_string or has_out_relevant_string_old) and is_legit_out_class) or \
@@ -130,28 +168,39 @@ def handle_jar(path):
                 while pkg in pkg_to_codedinputstream:
                     pkg += '_'
                 pkg_to_codedinputstream[pkg] = cls
+                
+                codedinputstream_runtimes[cls] = 'lite' if has_constructor and is_legit_class and (calls_arraydecoder or has_relevant_string) else \
+                                                 'nano' if has_relevant_string_nano else 'micro'
             
             # Other classes that may be called for (de)serializing objects
             
-            elif b'Generated message class' in binr: # GeneratedMessage*
+            elif 'Generated message class' in info.strings: # GeneratedMessage*
                 out_additional_cls.append(cls)
 
-            elif b'is not a primitive type' in binr: # InternalNano
+            elif 'is not a primitive type' in info.strings: # InternalNano
                 map_entry_cls.append(cls)
             
-            elif b'Groups are not allowed in maps' in binr or \
-                 b'a map entry message.' in binr: # MapEntry*
+            elif 'Groups are not allowed in maps' in info.strings or \
+                 'a map entry message.' in info.strings: # MapEntry*
                 map_entry_cls.append(cls)
             
             # Search for J2ME implementation's ProtoBuf.java
             
-            elif b'Unexp.EOF' in binr:
-                code = jar.decomp(cls, True).raw
-                protobuftype_cls = search('public \w+\(([\w.$]+) \w+\)', code).group(1)
+            elif 'Unexp.EOF' in info.strings:
+                if triage: # Read the ProtoBufType class from the constructor's signature instead
+                    protobuftype_cls = next((desc[2:-3].replace('/', '.') for access, name, desc in info.methods
+                                             if name == '<init>' and search('^\(L[^;]+;\)V$', desc)), None)
+                    default_consts = {}
+                    if not protobuftype_cls:
+                        continue
                 
-                default_consts = {}
-                for prop, const in findall('(\w+) = new Boolean\((\w+)\)', code):
-                    default_consts[cls + '.' + prop] = const
+                else:
+                    code = jar.decomp(cls, True).raw
+                    protobuftype_cls = search('public \w+\(([\w.$]+) \w+\)', code).group(1)
+                    
+                    default_consts = {}
+                    for prop, const in findall('(\w+) = new Boolean\((\w+)\)', code):
+                        default_consts[cls + '.' + prop] = const
                 
                 while pkg in pkg_to_j2me_protobuftype:
                     pkg += '_'
@@ -172,46 +221,76 @@ def handle_jar(path):
         gen_classes = OrderedDict()
         gen_classes_j2me = OrderedDict()
         had_metadata = set()
+        metadata_classes = [] # Classes that may embed a descriptor, to be decompiled
+        
+        impl_sigs = [(codedinputstream.replace('.', '/'),
+                      '(L%s;' % pkg_to_codedoutputstream[impl].replace('.', '/'),
+                      codedinputstream, pkg_to_codedoutputstream[impl])
+                     for impl, codedinputstream in pkg_to_codedinputstream.items()]
+        
+        j2me_sigs = [('(IILjava/lang/Object;)L%s;' % protobuftype_cls.replace('.', '/'),
+                      protobuftype_cls, consts)
+                     for protobuftype_cls, consts in pkg_to_j2me_protobuftype.values()]
         
         for i, cls in enumerate(jar.classes):
             if i % 10 == 0:
                 yield '_progress', ('Scanning Java package contents...', (i / len(jar.classes)) * 0.5 + 0.5)
             
-            binr = jar.read(cls)
+            info = class_infos[cls]
             
             # Search for metadata descriptors
-            if b'.proto\x12' in binr or b'.protodevel\x12' in binr:
-                code = jar.decomp(cls, True).raw
-                code = sub('",\s+"', '', code, flags=MULTILINE)
-                meta = search(r'"(\\n.+?\.proto.+)"', code)
-                if meta:
-                    meta = meta.group(1).encode('latin1')
-                    meta = meta.decode('unicode_escape').encode('latin1')
-                    
-                    yield from walk_binary(meta)
-                    had_metadata.add(cls)
+            if triage and ('.proto\x12' in info.strings or '.protodevel\x12' in info.strings):
+                had_metadata.add(cls)
+            
+            elif '.proto\x12' in info.strings or '.protodevel\x12' in info.strings:
+                metadata_classes.append(cls)
             
             # Search for signatures common to generated Java classes
-            for impl in pkg_to_codedinputstream:
-                if b'%s' % pkg_to_codedinputstream[impl].replace('.', '/').encode('ascii') in binr and \
-                   b'(L%s;' % pkg_to_codedoutputstream[impl].replace('.', '/').encode('ascii') in binr and \
-                   cls not in (pkg_to_codedinputstream[impl], pkg_to_codedoutputstream[impl]):
-                    gen_classes[cls] = (pkg_to_codedinputstream[impl], pkg_to_codedoutputstream[impl])
+            for in_type, out_sig, codedinputstream, codedoutputstream in impl_sigs:
+                if in_type in info.types and any(desc.startswith(out_sig) for desc in info.descriptors) and \
+                   cls not in (codedinputstream, codedoutputstream):
+                    gen_classes[cls] = (codedinputstream, codedoutputstream)
         
             # Search for generated J2ME classes
-            for impl, (protobuftype_cls, consts) in pkg_to_j2me_protobuftype.items():
-                if b'(IILjava/lang/Object;)L%s;' % protobuftype_cls.replace('.', '/').encode('ascii') in binr and \
-                   cls != protobuftype_cls:
+            for sig, protobuftype_cls, consts in j2me_sigs:
+                if sig in info.descriptors and cls != protobuftype_cls:
                     gen_classes_j2me[cls] = (protobuftype_cls, consts)
 
             # Search for enums
-            if b'Ljava/lang/Enum<' in binr[:256]:
+            if info.superclass == 'java/lang/Enum':
                 enums[cls] = cls
                 
                 if '$' in cls:
                     enums[cls.replace('$', '.')] = cls
                     enums[cls.rsplit('.', 1)[0] + '.' + cls.rsplit('$', 1)[1]] = cls
         
+        if triage:
+            yield 'inventory.json', dumps(make_inventory(jar, pkg_to_codedinputstream, pkg_to_codedoutputstream, codedinputstream_runtimes,
+                                                         pkg_to_j2me_protobuftype, gen_classes, gen_classes_j2me, enums, class_infos, had_metadata), indent=4)
+            return
+        
+        """
+        Read the descriptors embedded into classes, from their decompiled
+        code. When starting from a root message, this is deferred until
+        the classes are known to be referred to.
+        """
+        
+        def read_metadata(cls):
+            code = jar.decomp(cls, True).raw
+            code = sub('",\s+"', '', code, flags=MULTILINE)
+            meta = search(r'"(\\n.+?\.proto.+)"', code)
+            if meta:
+                meta = meta.group(1).encode('latin1')
+                meta = meta.decode('unicode_escape').encode('latin1')
+                
+                yield from walk_binary(meta)
+                had_metadata.add(cls)
+        
+        if not root:
+            for i, cls in enumerate(metadata_classes):
+                yield '_progress', ('Reading embedded descriptors...', i / len(metadata_classes))
+                yield from read_metadata(cls)
+        
         gen_classes_nodollar = OrderedDict(gen_classes)
         for cls, pkg in OrderedDict(gen_classes_nodollar).items():
             if '$' in cls:
@@ -223,25 +302,127 @@ def handle_jar(path):
         scraping and extraction work.
         """
         
-        # These variables will be filled in by extract_* functions:
+        # These variables will be filled in from extract_* functions results:
         
-        msg_path_to_obj = OrderedDict() # For the class name of a message/enum, its DescriptorProto object
+        msg_path_to_obj = OrderedDict() # For the class name of a message/enum, its Message/Enum object
         msg_to_referrers = defaultdict(list) # For a nested message/enum, all message fields that refer to it
         
-        # Call the extraction routine for most implementations
-        for i, (cls, (codedinputstream, codedoutputstream)) in enumerate(gen_classes.items()):
-            yield '_progress', ('Extracting %s...' % cls, i / len(gen_classes))
+        # Call the extraction routine for most implementations, then for J2ME
+        extract_jobs = [('lite', cls, codedinputstream, codedoutputstream)
+                        for cls, (codedinputstream, codedoutputstream) in gen_classes.items()
+                        if cls.split('$')[0] not in had_metadata]
+        extract_jobs += [('j2me', cls, protobuftype_cls, consts)
+                         for cls, (protobuftype_cls, consts) in gen_classes_j2me.items()]
+        
+        context = (jar, enums, gen_classes_nodollar, gen_classes_j2me, map_entry_cls, out_additional_cls)
+        
+        # Reuse the results from the previous run for classes that didn't change
+        digests = {}
+        
+        def digest(cls):
+            if cls not in digests:
+                digests[cls] = jar.digest(cls)
+            return digests[cls]
+        
+        def fingerprint(classes):
+            return class_context(classes, class_infos, enums, gen_classes, gen_classes_j2me, map_entry_cls, out_additional_cls)
+        
+        decompiler = repr((jar.decompiler.identity(), jar.decompiler.flags(False), jar.decompiler.flags(True)))
+        prev_state = load_state(state, decompiler) if state else {}
+        new_state = OrderedDict()
+        
+        for job in extract_jobs:
+            key = '%s:%s' % job[:2]
+            entry = prev_state.get(key)
             
-            if cls.split('$')[0] not in had_metadata:
-                extract_lite(jar, cls, enums, gen_classes_nodollar, codedinputstream, codedoutputstream, map_entry_cls, out_additional_cls,
-                             msg_path_to_obj, msg_to_referrers)
+            if entry and entry['args'] == repr(job[2:]) and entry['context'] == fingerprint(entry['classes']) and \
+               all(digest(cls) == cls_digest for cls, cls_digest in entry['classes'].items()):
+                new_state[key] = entry
         
-        # Call the extraction routine for J2ME
-        for i, (cls, (protobuftype_cls, consts)) in enumerate(gen_classes_j2me.items()):
-            yield '_progress', ('Extracting %s...' % cls, i / len(gen_classes_j2me))
+        # When starting from a root message, only extract the classes it refers to, layer after layer
+        if root:
+            job_names = {}
+            for job in extract_jobs:
+                cls = job[1]
+                job_names[cls] = job_names[cls.replace('$', '.')] = job
+                if '$' in cls:
+                    job_names[cls.rsplit('.', 1)[0] + '.' + cls.rsplit('$', 1)[1]] = job
+            
+            unread_metadata = set(metadata_classes)
             
-            extract_j2me(jar, cls, enums, gen_classes_j2me, protobuftype_cls, consts,
-                         msg_path_to_obj, msg_to_referrers)
+            if root not in job_names:
+                outer_cls = root.split('$')[0]
+                if outer_cls in unread_metadata:
+                    unread_metadata.remove(outer_cls)
+                    yield from read_metadata(outer_cls)
+                
+                if outer_cls not in had_metadata:
+                    raise ValueError('%s is not a generated message class' % root)
+            
+            pending = [job_names[root]] if root in job_names else []
+        else:
+            pending = extract_jobs
+        
+        partials = {}
+        
+        while pending:
+            # Messages from classes with an embedded descriptor are read from it instead
+            if root:
+                for outer_cls in OrderedDict.fromkeys(job[1].split('$')[0] for job in pending):
+                    if outer_cls in unread_metadata:
+                        unread_metadata.remove(outer_cls)
+                        yield from read_metadata(outer_cls)
+                
+                pending = [job for job in pending if job[1].split('$')[0] not in had_metadata]
+            
+            stale_jobs = [job for job in pending if '%s:%s' % job[:2] not in new_state]
+            
+            # Decompile the classes we'll look at, concurrently
+            to_decompile = [cls for kind, cls, *args in stale_jobs if kind == 'lite']
+            to_decompile_j2me = [cls for kind, cls, *args in stale_jobs if kind == 'j2me']
+            
+            for i in jar.prefetch(to_decompile):
+                yield '_progress', ('Decompiling classes...', i / len(to_decompile))
+            
+            for i in jar.prefetch(to_decompile_j2me, no_parse=True):
+                yield '_progress', ('Decompiling classes...', i / len(to_decompile_j2me))
+            
+            extracted = extract_classes(context, stale_jobs)
+            
+            for i, job in enumerate(pending):
+                yield '_progress', ('Extracting %s...' % job[1], i / len(pending))
+                key = '%s:%s' % job[:2]
+                
+                if key in new_state:
+                    partials[key] = load_partial(new_state[key])
+                else:
+                    partials[key] = next(extracted)
+                    if state:
+                        classes = OrderedDict((cls, digest(cls)) for cls in partials[key][4])
+                        new_state[key] = dump_partial(partials[key], repr(job[2:]), classes, fingerprint(classes))
+            
+            if not root:
+                break
+            
+            # Follow references to other messages (J2ME messages are named after their class' fields)
+            referred = OrderedDict()
+            for job in pending:
+                for msg in partials['%s:%s' % job[:2]][1]:
+                    ref_job = job_names.get(msg) or job_names.get(msg.rsplit('.', 1)[0])
+                    if ref_job and '%s:%s' % ref_job[:2] not in partials:
+                        referred['%s:%s' % ref_job[:2]] = ref_job
+            pending = list(referred.values())
+        
+        # Merge results in the same order as when extracting all classes
+        for job in extract_jobs:
+            key = '%s:%s' % job[:2]
+            if key in partials:
+                merge_extracted(msg_path_to_obj, msg_to_referrers, partials[key])
+        
+        del class_infos
+        
+        if state:
+            save_state(state, decompiler, new_state)
         
         yield '_progress', ('Dumping information to .protos...', None)
 
@@ -251,10 +432,205 @@ def handle_jar(path):
         # If we got an APK and it contained .so's with embedded metadata or .protos, yield them
         yield from jar.bonus_protos.items()
 
+"""
+    Summarize what the signature scan found, for the --triage option:
+    the runtimes used, and counts of generated classes, enums and classes
+    with embedded descriptors, overall and by package.
+"""
+
+def make_inventory(jar, pkg_to_codedinputstream, pkg_to_codedoutputstream, codedinputstream_runtimes,
+                   pkg_to_j2me_protobuftype, gen_classes, gen_classes_j2me, enums, class_infos, had_metadata):
+    runtimes = []
+    
+    for impl, codedinputstream in pkg_to_codedinputstream.items():
+        runtimes.append(OrderedDict([
+            ('runtime', codedinputstream_runtimes[codedinputstream]),
+            ('coded_input_stream', codedinputstream),
+            ('coded_output_stream', pkg_to_codedoutputstream[impl]),
+            ('generated_classes', sum(classes[0] == codedinputstream for classes in gen_classes.values()))
+        ]))
+    
+    for protobuftype_cls, consts in pkg_to_j2me_protobuftype.values():
+        runtimes.append(OrderedDict([
+            ('runtime', 'j2me'),
+            ('protobuf_type', protobuftype_cls),
+            ('generated_classes', sum(args[0] == protobuftype_cls for args in gen_classes_j2me.values()))
+        ]))
+    
+    # Only count Protobuf enums: those referred to by generated classes,
+    # or implementing the enum interfaces of the runtime
+    referred = set()
+    for cls in list(gen_classes) + list(gen_classes_j2me):
+        referred.update(ref.replace('/', '.') for ref in class_infos[cls].types)
+    
+    enums = sorted(cls for cls in set(enums.values()) if cls in referred or
+                   any(iface.rsplit('/', 1)[-1] in ('Internal$EnumLite', 'ProtocolMessageEnum') for iface in class_infos[cls].interfaces))
+    
+    packages = defaultdict(lambda: OrderedDict([('generated_classes', 0), ('j2me_classes', 0),
+                                                ('enums', 0), ('embedded_descriptors', 0)]))
+    for key, classes in (('generated_classes', gen_classes), ('j2me_classes', gen_classes_j2me),
+                         ('enums', enums), ('embedded_descriptors', had_metadata)):
+        for cls in classes:
+            packages[cls.rsplit('.', 1)[0] if '.' in cls else ''][key] += 1
+    
+    return OrderedDict([
+        ('classes', len(jar.classes)),
+        ('runtimes', runtimes),
+        ('generated_classes', len(gen_classes) + len(gen_classes_j2me)),
+        ('enums', len(enums)),
+        ('embedded_descriptors', len(had_metadata)),
+        ('bonus_protos', list(jar.bonus_protos)),
+        ('packages', OrderedDict(sorted(packages.items())))
+    ])
+
+"""
+    Extraction of every generated class is run as an independent job,
+    over a pool of forked processes when there are several CPUs.
+    
+    A job starts from empty msg_path_to_obj/msg_to_referrers tables,
+    and returns them along with the names of the messages the class
+    defines, its printed output, and the classes it decompiled along
+    the way (which it depends on). These partial results are merged
+    in the order of classes, the same way as if extraction was done
+    serially into shared tables.
+"""
+
+def extract_classes(context, jobs):
+    jar = context[0]
+    
+    if jar.jobs > 1 and len(jobs) > 1 and 'fork' in get_all_start_methods():
+        with ProcessPoolExecutor(min(jar.jobs, len(jobs)), mp_context=get_context('fork'),
+                                 initializer=_init_worker, initargs=(context,)) as pool:
+            yield from pool.map(_extract_class_worker, jobs)
+    
+    else:
+        for job in jobs:
+            yield extract_class(context, job)
+
+def extract_class(context, job):
+    jar, enums, gen_classes, gen_classes_j2me, map_entry_cls, out_additional_cls = context
+    kind, cls, *args = job
+    
+    msg_path_to_obj = OrderedDict()
+    msg_to_referrers = defaultdict(list)
+    jar.accessed = set()
+    
+    with redirect_stdout(StringIO()) as output:
+        if kind == 'lite':
+            codedinputstream, codedoutputstream = args
+            defined = extract_lite(jar, cls, enums, gen_classes, codedinputstream, codedoutputstream, map_entry_cls, out_additional_cls,
+                                   msg_path_to_obj, msg_to_referrers)
+        else:
+            protobuftype_cls, consts = args
+            defined = extract_j2me(jar, cls, enums, gen_classes_j2me, protobuftype_cls, consts,
+                                   msg_path_to_obj, msg_to_referrers)
+    
+    return msg_path_to_obj, msg_to_referrers, defined or [], output.getvalue(), sorted({cls} | jar.accessed)
+
+def _init_worker(context):
+    global _worker_context
+    
+    # The JarWrapper is inherited from the parent process, reopen its files
+    context[0].reopen()
+    _worker_context = context
+
+def _extract_class_worker(job):
+    return extract_class(_worker_context, job)
+
+"""
+    Merge the results of a job into the global tables.
+    
+    Entries other than the messages defined by the class (enums, maps,
+    J2ME placeholders for referenced messages) are only created when
+    not already existing, as extract_* functions check for this before
+    creating them. References from a map that already existed are
+    dropped for the same reason.
+"""
+
+def merge_extracted(msg_path_to_obj, msg_to_referrers, partial):
+    part_path_to_obj, part_to_referrers, defined, output, classes = partial
+    
+    print(output, end='')
+    
+    existing = {path for path in part_path_to_obj if path in msg_path_to_obj and path not in defined}
+    
+    for path, obj in part_path_to_obj.items():
+        if path in defined or path not in msg_path_to_obj:
+            msg_path_to_obj[path] = obj
+    
+    for msg, referrers in part_to_referrers.items():
+        for referrer in referrers:
+            if referrer[1] not in existing:
+                msg_to_referrers[msg].append(referrer)
+
+"""
+    Results of extraction can be kept across runs in a JSON state file,
+    holding for every job its partial results, along with what they
+    depend on: the hashes of the classes it decompiled, and whether the
+    classes these refer to were recognized as generated messages or
+    enums. When all of these are the same, the job is not run again.
+    
+    Results are only reused with the same decompiler and flags, as
+    output may differ between them.
+"""
+
+STATE_VERSION = 2
+
+def load_state(path, decompiler):
+    try:
+        with open(path) as fd:
+            state = load(fd, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError):
+        return {}
+    
+    if state.get('version') != STATE_VERSION or state.get('decompiler') != decompiler:
+        return {}
+    return state['jobs']
+
+def save_state(path, decompiler, jobs):
+    with open(path + '.tmp', 'w') as fd:
+        dump({'version': STATE_VERSION, 'decompiler': decompiler, 'jobs': jobs}, fd)
+    replace(path + '.tmp', path)
+
+def class_context(classes, class_infos, enums, gen_classes, gen_classes_j2me, map_entry_cls, out_additional_cls):
+    refs = set()
+    for cls in classes:
+        if cls in class_infos:
+            refs.update(class_infos[cls].types)
+    
+    refs = [ref.replace('/', '.') for ref in sorted(refs)]
+    refs = [(ref, ref in enums, ref in gen_classes, ref in gen_classes_j2me) for ref in refs]
+    
+    return sha1(repr((refs, map_entry_cls, out_additional_cls)).encode()).hexdigest()
+
+def dump_partial(partial, args, classes, context):
+    part_path_to_obj, part_to_referrers, defined, output, dependencies = partial
+    
+    return {'args': args,
+            'classes': classes,
+            'context': context,
+            'objs': [(path, obj.dump()) for path, obj in part_path_to_obj.items()],
+            'referrers': list(part_to_referrers.items()),
+            'defined': defined,
+            'output': output}
+
+def load_partial(entry):
+    part_path_to_obj = OrderedDict()
+    for path, obj in entry['objs']:
+        part_path_to_obj[path] = load_schema(obj)
+    
+    part_to_referrers = defaultdict(list)
+    for msg, referrers in entry['referrers']:
+        part_to_referrers[msg] = [tuple(referrer) for referrer in referrers]
+    
+    return part_path_to_obj, part_to_referrers, entry['defined'], entry['output'], list(entry['classes'])
+
 """
     Extraction routine for most implementations (Base, Lite, Nano, Micro)
     
     Base should already be handled through metadata extraction.
+    
+    Return the names of the messages defined.
 """
 def extract_lite(jar, cls, enums, gen_classes, codedinputstream, codedoutputstream, map_entry_cls, out_additional_cls,
                  msg_path_to_obj, msg_to_referrers):
@@ -293,146 +669,152 @@ def extract_lite(jar, cls, enums, gen_classes, codedinputstream, codedoutputstre
         {fnumber: (flabel, ftype, fenumormsg, fdefault, var)}
     """
     
+    # Read the switch from bytecode, only parsing it from decompiled code when that's ambiguous
+    merge_fields = read_merge_switch(jar, code.cls, enums, gen_classes, codedinputstream, map_entry_cls)
     
-    for start, (call, end) in code.method_calls.items():
-        call_ret, call_obj, call_name, call_args = call
-        
-        if call_obj in [codedinputstream, *map_entry_cls] \
-           and not (call_ret, call_args) == ('void', 'int'):
-        
-            if not in_switch:
-                # Look at the switch structure around the read*() calls:
-                
-                next_lines = '\n'.join(code.raw[start:].split('\n')[:3])
-                
-                if 'INSTR lookupswitch' in next_lines or ' switch(' in next_lines:
-                    in_switch = True
-                    label_to_val = code.parse_switch(start, next_lines)
+    if merge_fields is not None:
+        fields.update(merge_fields)
+    
+    else:
+        for start, (call, end) in code.method_calls.items():
+            call_ret, call_obj, call_name, call_args = call
             
-            else:
-                # Then at the switch's cases:
+            if call_obj in [codedinputstream, *map_entry_cls] \
+               and not (call_ret, call_args) == ('void', 'int'):
                 
-                if label_to_val and start < label_to_val[0][0]: # We're before the current switch case...
-                    continue
-                while label_to_val and start > label_to_val[0][1][1]: # We're after the next one in method...
-                    lazy_start, (lazy_tag, lazy_end) = label_to_val.pop(0)
+                if not in_switch:
+                    # Look at the switch structure around the read*() calls:
                     
-                    if lazy_tag and lazy_tag >> 3 not in fields:
-                        lazy_obj = search('([\w$.]+) [\w$]+ = new ', code.raw[lazy_start:lazy_end])
-                        fenumormsg = None
-                        if lazy_obj and lazy_obj.group(1) in gen_classes:
-                            fenumormsg = lazy_obj.group(1)
-                        
-                        ftype = {0: 'int32', 1: 'fixed64', 2: 'bytes', 3: 'group', 5: 'fixed32'}[lazy_tag & 7]
-                        fields[lazy_tag >> 3] = (None, ftype, fenumormsg, None, None)
-                
-                if not label_to_val: # We have seen every case...
-                    break
-                
-                label_start, (tag, label_end) = label_to_val[0]
-                
-                # Parse the message number and wire type from switch case value
-                fnumber, wire_type = (tag >> 3), (tag & 0b111)
-                if fnumber in fields and fields[fnumber][0] != 'bytes':
-                    continue
-                
-                case = code.raw[label_start:label_end]
-                
-                # Interprete wire type: https://developers.google.com/protocol-buffers/docs/encoding#structure,
-                # Then look at called method's return type
-                
-                fenumormsg = None
-                call_ret = call_ret.split('.')[-1]
+                    next_lines = code.lines_from(start, 3)
+                    
+                    if 'INSTR lookupswitch' in next_lines or ' switch(' in next_lines:
+                        in_switch = True
+                        label_to_val = code.parse_switch(start, next_lines)
                 
-                if wire_type == 0: # Varint
-                    ftype = {'long': 'int64', 'boolean': 'bool'}.get(call_ret, 'uint32')
-                    # We'll distinguish a uint32 from a int32 on step 2.
-                    # We can't know signedness for (u)int64, (s)fixed32 or (s)fixed64, so pick the most common case.
+                else:
+                    # Then at the switch's cases:
+                    
+                    if label_to_val and start < label_to_val[0][0]: # We're before the current switch case...
+                        continue
+                    while label_to_val and start > label_to_val[0][1][1]: # We're after the next one in method...
+                        lazy_start, (lazy_tag, lazy_end) = label_to_val.pop(0)
+                        
+                        if lazy_tag and lazy_tag >> 3 not in fields:
+                            lazy_obj = search('([\w$.]+) [\w$]+ = new ', code.raw[lazy_start:lazy_end])
+                            fenumormsg = None
+                            if lazy_obj and lazy_obj.group(1) in gen_classes:
+                                fenumormsg = lazy_obj.group(1)
+                            
+                            ftype = {0: 'int32', 1: 'fixed64', 2: 'bytes', 3: 'group', 5: 'fixed32'}[lazy_tag & 7]
+                            fields[lazy_tag >> 3] = (None, ftype, fenumormsg, None, None)
+                    
+                    if not label_to_val: # We have seen every case...
+                        break
+                    
+                    label_start, (tag, label_end) = label_to_val[0]
                     
-                    if ('!= 0' in case and not '.arraycopy' in case) or 'oolean' in case:
-                        ftype = 'bool'
-                    elif 'Long' in ftype and ftype == 'uint32':
-                        ftype = 'int64'
+                    # Parse the message number and wire type from switch case value
+                    fnumber, wire_type = (tag >> 3), (tag & 0b111)
+                    if fnumber in fields and fields[fnumber][0] != 'bytes':
+                        continue
+                    
+                    case = code.raw[label_start:label_end]
+                    
+                    # Interprete wire type: https://developers.google.com/protocol-buffers/docs/encoding#structure,
+                    # Then look at called method's return type
+                    
+                    fenumormsg = None
+                    call_ret = call_ret.split('.')[-1]
+                    
+                    if wire_type == 0: # Varint
+                        ftype = {'long': 'int64', 'boolean': 'bool'}.get(call_ret, 'uint32')
+                        # We'll distinguish a uint32 from a int32 on step 2.
+                        # We can't know signedness for (u)int64, (s)fixed32 or (s)fixed64, so pick the most common case.
+                        
+                        if ('!= 0' in case and not '.arraycopy' in case) or 'oolean' in case:
+                            ftype = 'bool'
+                        elif 'Long' in ftype and ftype == 'uint32':
+                            ftype = 'int64'
+                        
+                        # Look for enums
+                        if ftype == 'uint32':
+                            for start2, (call2, end2) in code.calls_in_range(label_start, label_end):
+                                _, call2_obj, _, _ = call2
+                                
+                                if call2_obj in enums:
+                                    ftype = 'enum'
+                                    fenumormsg = call2_obj
+                                    break
                     
-                    # Look for enums
-                    if ftype == 'uint32':
-                        for start2, (call2, end2) in code.method_calls.items():
+                    elif wire_type == 1:
+                        ftype = {'double': 'double'}.get(call_ret, 'fixed64')
+                        if 'longBitsToDouble' in case:
+                            ftype = 'double'
+                    
+                    elif wire_type == 5:
+                        ftype = {'float': 'float'}.get(call_ret, 'fixed32')
+                        if 'intBitsToFloat' in case:
+                            ftype = 'float'
+                    
+                    elif wire_type == 2: # Length-delimited
+                        ftype = {'String': 'string'}.get(call_ret, 'bytes')
+                        
+                        first_arg = code.lines_from(end).split(',')[0]
+                        if first_arg.endswith('()'):
+                            first_arg = first_arg.rsplit('.', 1)[0]
+                            
+                            if first_arg in gen_classes:
+                                fenumormsg = first_arg
+                                ftype = 'message'
+                    
+                    elif wire_type == 3:
+                        ftype = 'group'
+                        
+                        for start2, (call2, end2) in code.calls_in_range(label_start, label_end):
                             _, call2_obj, _, _ = call2
                             
-                            if label_start < start2 < label_end and call2_obj in enums:
-                                ftype = 'enum'
+                            if call2_obj in gen_classes:
                                 fenumormsg = call2_obj
-                                break
-                
-                elif wire_type == 1:
-                    ftype = {'double': 'double'}.get(call_ret, 'fixed64')
-                    if 'longBitsToDouble' in case:
-                        ftype = 'double'
+                                break                
+                    else:
+                        return
                     
-                elif wire_type == 5:
-                    ftype = {'float': 'float'}.get(call_ret, 'fixed32')
-                    if 'intBitsToFloat' in case:
-                        ftype = 'float'
-                
-                elif wire_type == 2: # Length-delimited
-                    ftype = {'String': 'string'}.get(call_ret, 'bytes')
-
-                    first_arg = code.raw[end:].split('\n', 1)[0].split(',')[0]
-                    if first_arg.endswith('()'):
-                        first_arg = first_arg.rsplit('.', 1)[0]
-                        
-                        if first_arg in gen_classes:
-                            fenumormsg = first_arg
-                            ftype = 'message'
-                
-                elif wire_type == 3:
-                    ftype = 'group'
-
-                    for start2, (call2, end2) in code.method_calls.items():
-                        _, call2_obj, _, _ = call2
+                    if not fenumormsg and ftype in ('group', 'bytes'):
+                        msg_obj = search('([\w$.]+) [\w$]+ = new ', case)
                         
-                        if label_start < start2 < label_end and call2_obj in gen_classes:
-                            fenumormsg = call2_obj
-                            break                
-                else:
-                    return
-                
-                if not fenumormsg and ftype in ('group', 'bytes'):
-                    msg_obj = search('([\w$.]+) [\w$]+ = new ', case)
+                        if msg_obj and msg_obj.group(1) in gen_classes:
+                            fenumormsg = msg_obj.group(1)
+                            if ftype == 'bytes':
+                                ftype = 'message'
                     
-                    if msg_obj and msg_obj.group(1) in gen_classes:
-                        fenumormsg = msg_obj.group(1)
-                        if ftype == 'bytes':
-                            ftype = 'message'
-                
-                # General case: store information for step 2
-                if call_obj not in map_entry_cls or len(call_args.split(', ')) != 8:
-                    fields[fnumber] = (None, ftype, fenumormsg, None, None)
+                    # General case: store information for step 2
+                    if call_obj not in map_entry_cls or len(call_args.split(', ')) != 8:
+                        fields[fnumber] = (None, ftype, fenumormsg, None, None)
 
-                else: # Look for InternalNano.mergeMapEntry()
-                    args = code.raw[start:].split('(')[1].split(')')[0].split(', ')
-                    var, ftype1, fmsg1, ftype2, fmsg2 = args[1], int(args[3]), None, int(args[4]), args[5]
+                    else: # Look for InternalNano.mergeMapEntry()
+                        args = code.raw[start:].split('(')[1].split(')')[0].split(', ')
+                        var, ftype1, fmsg1, ftype2, fmsg2 = args[1], int(args[3]), None, int(args[4]), args[5]
 
-                    fmsg2 = fmsg2[4:].split('(')[0] if fmsg2.startswith('new ') else None
-                    
-                    fields[fnumber] = create_map(cls, jar, enums, code.pkg, var, fnumber, ftype1, fmsg1, ftype2, fmsg2, \
-                                                 msg_to_referrers, msg_path_to_obj)
+                        fmsg2 = fmsg2[4:].split('(')[0] if fmsg2.startswith('new ') else None
+                        
+                        fields[fnumber] = create_map(cls, jar, enums, code.pkg, var, fnumber, ftype1, fmsg1, ftype2, fmsg2, \
+                                                     msg_to_referrers, msg_path_to_obj)
 
-    
-    if not in_switch and 'tableswitch 0 0' not in code.raw:
-        return
-    
-    # Store any remaining fields that weren't parsed
-    while label_to_val:
-        lazy_start, (lazy_tag, lazy_end) = label_to_val.pop(0)
-        if lazy_tag and lazy_tag >> 3 not in fields:
-            lazy_obj = search('([\w$.]+) [\w$]+ = new ', code.raw[lazy_start:lazy_end])
-            fenumormsg = None
-            if lazy_obj and lazy_obj.group(1) in gen_classes:
-                fenumormsg = lazy_obj.group(1)
-            
-            ftype = {0: 'int32', 1: 'fixed64', 2: 'bytes', 3: 'group', 5: 'fixed32'}[lazy_tag & 7]
-            fields[lazy_tag >> 3] = (None, ftype, fenumormsg, None, None)
+        
+        if not in_switch and 'tableswitch 0 0' not in code.raw:
+            return
+        
+        # Store any remaining fields that weren't parsed
+        while label_to_val:
+            lazy_start, (lazy_tag, lazy_end) = label_to_val.pop(0)
+            if lazy_tag and lazy_tag >> 3 not in fields:
+                lazy_obj = search('([\w$.]+) [\w$]+ = new ', code.raw[lazy_start:lazy_end])
+                fenumormsg = None
+                if lazy_obj and lazy_obj.group(1) in gen_classes:
+                    fenumormsg = lazy_obj.group(1)
+                
+                ftype = {0: 'int32', 1: 'fixed64', 2: 'bytes', 3: 'group', 5: 'fixed32'}[lazy_tag & 7]
+                fields[lazy_tag >> 3] = (None, ftype, fenumormsg, None, None)
     
     """
     Step 2: Look for calls to CodedOutputStream (or CodedOutputByteBufferNano, or GeneratedMessage) methods
@@ -448,24 +830,23 @@ def extract_lite(jar, cls, enums, gen_classes, codedinputstream, codedoutputstre
     for start, (call, end) in code.method_calls.items():
         call_ret, call_obj, call_name, call_args = call
         
-        has_constant = search('\(\d+', code.raw[start:].split('\n')[0]) or search('\([a-zA-Z_]\w*, \d+', code.raw[start:].split('\n')[0])
+        line = code.lines_from(start)
+        has_constant = search('\(\d+', line) or search('\([a-zA-Z_]\w*, \d+', line)
         
         if call_obj in [codedoutputstream, *out_additional_cls, *map_entry_cls] and \
            (has_constant or take_packed):
 
-            from_condition = False
-            
             # Does it originate from a condition block?
-            for cond_start, cond_end in code.cond_bounds:
-                if cond_start < start < cond_end:
-                    from_condition = True
-                    prev_cond_end = cond_end
-                    break
+            from_condition = code.cond_at(start)
+            
+            if from_condition:
+                cond_start, cond_end = from_condition
+                prev_cond_end = cond_end
             
             # If it doesn't (it is a required field in Nano implementation),
             # what are the nearest blocks we can relate to?
-            if not from_condition:
-                func_start, func_end = next((i for i in code.method_bounds.values() if i[0] < start < i[1]), None)
+            else:
+                func_start, func_end = code.method_at(start)
                 
                 after_line = code.raw.index('\n', start)
                 cond_start, cond_end = max(func_start, prev_cond_end), after_line
@@ -540,10 +921,10 @@ def extract_lite(jar, cls, enums, gen_classes, codedinputstream, codedoutputstre
             
             # Look for enums
             if ftype == 'int32':
-                for start2, (call2, end2) in code.method_calls.items():
+                for start2, (call2, end2) in code.calls_in_range(cond_start, cond_end):
                     _, call2_obj, _, _ = call2
                     
-                    if cond_start < start2 < cond_end and call2_obj in enums:
+                    if call2_obj in enums:
                         ftype = 'enum'
                         fenumormsg = call2_obj
                         break
@@ -603,16 +984,16 @@ def extract_lite(jar, cls, enums, gen_classes, codedinputstream, codedoutputstre
                 
                 # Search for the line defining the default value for this variable
                 
-                fdefault = findall('\s+(?:super\.)?%s(?:\[\])* = (.+?);' % escape(var), code.raw, flags=MULTILINE)
+                fdefault = code.assigned_values(var)
                 if not fdefault:
                     fdefault = ['null']
                 fdefault = next((i for i in fdefault if i not in ('0', 'null', 'false')), fdefault[0])
                 
                 # Check its type for an embedded message or group, too
                 
-                fdefault_type = search('([\w.$]+?) %s(?:\[\])*(?: =|;)' % escape(var), code.raw, flags=MULTILINE)
-                if fdefault_type and fdefault_type.group(1) in gen_classes:
-                    fenumormsg = fdefault_type.group(1)
+                fdefault_type = code.declared_type(var)
+                if fdefault_type in gen_classes:
+                    fenumormsg = fdefault_type
                     if ftype == 'bytes':
                         ftype = 'message'
                 
@@ -680,11 +1061,10 @@ def extract_lite(jar, cls, enums, gen_classes, codedinputstream, codedoutputstre
     print(fields)
 
     """
-    Final step: Build the DescriptorProto object
+    Final step: Build the Message object
     """
     
-    message = DescriptorProto()
-    message.name = cls.rsplit('.', 1)[-1]
+    message = Message(cls.rsplit('.', 1)[-1])
 
     seen_vars = {}
     my_namer = namer()
@@ -696,7 +1076,8 @@ def extract_lite(jar, cls, enums, gen_classes, codedinputstream, codedoutputstre
     all_vars = [field[4] or 'unk' for field in fields.values()]
     
     for number, (flabel, ftype, fenumormsg, fdefault, var) in sorted(fields.items()):
-        field = message.field.add()
+        field = Field()
+        message.field.append(field)
         var = var or 'unk'
         flabel = flabel or 'optional'
         
@@ -721,11 +1102,11 @@ def extract_lite(jar, cls, enums, gen_classes, codedinputstream, codedoutputstre
         if all_vars.count(var) > 1:
             #assert flabel == 'optional'
             if var not in oneofs:
-                oneofs[var] = (len(message.oneof_decl), message.oneof_decl.add())
-                oneofs[var][1].name = disp_var
-            if not use_namer or oneofs[var][1].name == disp_var:
+                oneofs[var] = len(message.oneof_decl)
+                message.oneof_decl.append(disp_var)
+            if not use_namer or message.oneof_decl[oneofs[var]] == disp_var:
                 disp_var = next(my_namer)
-            field.oneof_index = oneofs[var][0]
+            field.oneof_index = oneofs[var]
             fdefault = None
         
         if fdefault and (var not in seen_vars or seen_vars[var] == (flabel, ftype)) and \
@@ -745,6 +1126,186 @@ def extract_lite(jar, cls, enums, gen_classes, codedinputstream, codedoutputstre
         seen_vars[var] = (flabel, ftype)
     
     msg_path_to_obj[cls] = message
+    return [cls]
+
+"""
+    Bytecode-level counterpart of extract_lite()'s step 1: read the
+    switch over the tags returned by CodedInputStream straight from
+    the class file, along with the calls made from each of its cases,
+    rather than from Jad's rendering of it.
+    
+    Return the "fields" dictionary that step 1 would have filled, or
+    None when the class doesn't have exactly one such switch, or when
+    a case can't be interpreted without the source (map fields, which
+    need create_map(), or unknown wire types).
+"""
+
+def read_merge_switch(jar, cls, enums, gen_classes, codedinputstream, map_entry_cls):
+    info = ClassInfo(jar.read(cls), with_code=True)
+    stream = codedinputstream.replace('.', '/')
+    
+    def is_read_tag(insn):
+        pos, op, arg = insn
+        call = info.constants.get(arg) if op in OP_INVOKES else None
+        return type(call) == tuple and call == (stream, 'readTag', '()I')
+    
+    # Look for a switch whose value comes from a readTag() call, possibly through a local variable
+    
+    switches = []
+    for code in info.code.values():
+        try:
+            insns = list(read_instructions(code))
+        except (error, IndexError):
+            return None
+        
+        tag_locals = set()
+        for i, (pos, op, arg) in enumerate(insns[1:], 1):
+            if op == OP_ISTORE:
+                if is_read_tag(insns[i - 1]):
+                    tag_locals.add(arg)
+                else:
+                    tag_locals.discard(arg)
+            
+            elif op in (OP_TABLESWITCH, OP_LOOKUPSWITCH):
+                prev_pos, prev_op, prev_arg = insns[i - 1]
+                if is_read_tag(insns[i - 1]) or (prev_op == OP_ILOAD and prev_arg in tag_locals):
+                    switches.append((code, insns, i))
+    
+    if len(switches) != 1:
+        return None
+    
+    code, insns, index = switches[0]
+    switch_pos, _, (default, cases) = insns[index]
+    
+    targets = sorted({default, *(target for key, target in cases)})
+    if targets[0] < switch_pos:
+        return None
+    
+    # Cases break to a common place, either past the switch, or back to
+    # the loop around it (when jumps were threaded by an optimizer)
+    breaks = set()
+    for start, end in zip(targets, targets[1:]):
+        breaks |= {arg for pos, op, arg in insns if op in (OP_GOTO, OP_GOTO_W) and start <= pos < end and not start <= arg < end}
+    
+    if len(breaks) > 1:
+        return None
+    break_pos = breaks.pop() if breaks else len(code)
+    
+    # The last case ends where the other ones break to, or with its own break
+    if break_pos > targets[-1]:
+        targets.append(break_pos)
+    elif break_pos < targets[0]:
+        targets.append(next((pos + 1 for pos, op, arg in insns if pos >= targets[-1] and
+                             op in (OP_GOTO, OP_GOTO_W) and arg == break_pos), len(code)))
+    else:
+        return None
+    
+    # Cases are read in the order of their code, the first one for a field number wins
+    fields = {}
+    for tag, target in sorted(cases, key=lambda case: case[1]):
+        if not tag or tag >> 3 in fields:
+            continue
+        
+        case_end = next(pos for pos in targets if pos > target)
+        case = [insn for insn in insns if target <= insn[0] < case_end]
+        
+        # Cases that jump elsewhere than into themselves or out of the switch are left to Jad
+        for pos, op, arg in case:
+            if op in (*OP_BRANCHES, OP_GOTO_W, OP_JSR_W) and not (target <= arg < case_end or arg == break_pos):
+                return None
+            elif op in (OP_TABLESWITCH, OP_LOOKUPSWITCH):
+                return None
+        
+        field = read_merge_case(info, case, tag & 7, enums, gen_classes, stream, map_entry_cls)
+        if field is None:
+            return None
+        fields[tag >> 3] = field
+    
+    return fields
+
+"""
+    Interpret the instructions from a case of the switch above, using
+    the same rules as extract_lite() uses for Jad's output.
+"""
+
+def read_merge_case(info, case, wire_type, enums, gen_classes, stream, map_entry_cls):
+    if wire_type not in (0, 1, 2, 3, 5):
+        return None
+    
+    calls = [(i, op, info.constants[arg]) for i, (pos, op, arg) in enumerate(case)
+             if op in OP_INVOKES and type(info.constants.get(arg)) == tuple]
+    
+    call_objs = [call_obj.replace('/', '.') for i, op, (call_obj, call_name, call_desc) in calls]
+    
+    # Look for an object instantiated into a local variable ("Foo foo = new Foo()")
+    new_obj = next((call_objs[j] for j, (i, op, (call_obj, call_name, call_desc)) in enumerate(calls)
+                    if op == OP_INVOKESPECIAL and call_name == '<init>' and
+                       i + 1 < len(case) and case[i + 1][1] == OP_ASTORE), None)
+    if new_obj not in gen_classes:
+        new_obj = None
+    
+    reads = [(i, call) for i, op, call in calls
+             if call[0] in [stream, *(cls.replace('.', '/') for cls in map_entry_cls)] and call[2] != '(I)V']
+    
+    # Cases without a read call are typed after the wire type only
+    if not reads:
+        ftype = {0: 'int32', 1: 'fixed64', 2: 'bytes', 3: 'group', 5: 'fixed32'}[wire_type]
+        return (None, ftype, new_obj, None, None)
+    
+    read_index, (call_obj, call_name, call_desc) = reads[0]
+    if call_obj != stream:
+        return None
+    
+    call_ret = call_desc.split(')')[1]
+    call_ret = {'J': 'long', 'Z': 'boolean', 'D': 'double', 'F': 'float', 'I': 'int'}.get(call_ret, call_ret.strip('L;').split('/')[-1])
+    call_names = {call_name for i, op, (call_obj, call_name, call_desc) in calls}
+    
+    fenumormsg = None
+    
+    if wire_type == 0: # Varint
+        ftype = {'long': 'int64', 'boolean': 'bool'}.get(call_ret, 'uint32')
+        
+        # Read value compared with zero
+        is_compared = read_index + 1 < len(case) and case[read_index + 1][1] in (OP_IFEQ, OP_IFNE)
+        
+        if (is_compared and 'arraycopy' not in call_names) or 'java.lang.Boolean' in call_objs:
+            ftype = 'bool'
+        
+        # Look for enums
+        if ftype == 'uint32':
+            fenumormsg = next((call_obj for call_obj in call_objs if call_obj in enums), None)
+            if fenumormsg:
+                ftype = 'enum'
+    
+    elif wire_type == 1:
+        ftype = {'double': 'double'}.get(call_ret, 'fixed64')
+        if 'longBitsToDouble' in call_names:
+            ftype = 'double'
+    
+    elif wire_type == 5:
+        ftype = {'float': 'float'}.get(call_ret, 'fixed32')
+        if 'intBitsToFloat' in call_names:
+            ftype = 'float'
+    
+    elif wire_type == 2: # Length-delimited
+        ftype = {'String': 'string'}.get(call_ret, 'bytes')
+        
+        # Look for a "Foo.parser()" argument
+        for j, (i, op, (call_obj, call_name, call_desc)) in enumerate(calls):
+            if i < read_index and op == OP_INVOKESTATIC and call_desc.startswith('()') and call_objs[j] in gen_classes:
+                fenumormsg = call_objs[j]
+                ftype = 'message'
+    
+    elif wire_type == 3:
+        ftype = 'group'
+        fenumormsg = next((call_obj for call_obj in call_objs if call_obj in gen_classes), None)
+    
+    if not fenumormsg and ftype in ('group', 'bytes') and new_obj:
+        fenumormsg = new_obj
+        if ftype == 'bytes':
+            ftype = 'message'
+    
+    return (None, ftype, fenumormsg, None, None)
 
 def namer():
     for length in count(1):
@@ -780,28 +1341,23 @@ def parse_default(field, ftype, fdefault):
         field.default_value = str(fdefault)
 
 """
-    Create an enum or map, still as descriptor objects.
+    Create an enum or map, as Enum/Message objects.
 """
 
 def create_enum(jar, enums, fenum, msg_path_to_obj):
     if fenum not in msg_path_to_obj:
         enum_code = jar.decomp(enums[fenum], True).raw
         
-        enum = EnumDescriptorProto()
-        enum.name = fenum.split('.')[-1]
+        enum = Enum(fenum.split('.')[-1])
         for fname, fnumber in findall('(?:[\w.$]+|<init>)\("(.+?)", \d+, (-?\d+)[LDF]?\);', enum_code):
             if (fname, fnumber) != ('UNRECOGNIZED', '-1'):
-                value = enum.value.add()
-                value.name = fname
-                value.number = int(fnumber)
+                enum.value.append(EnumValue(fname, int(fnumber)))
         
         msg_path_to_obj[fenum] = enum
 
 def create_map(cls, jar, enums, pkg, var, number, ftype1, fmsg1, ftype2, fmsg2, \
                msg_to_referrers, msg_path_to_obj):
-    map_obj = DescriptorProto()
-    map_obj.options.map_entry = True
-    map_obj.name = '%s$map%d' % (cls.split('.')[-1], number)
+    map_obj = Message('%s$map%d' % (cls.split('.')[-1], number), map_entry=True)
     
     map_full_name = map_obj.name
     if pkg:
@@ -810,7 +1366,8 @@ def create_map(cls, jar, enums, pkg, var, number, ftype1, fmsg1, ftype2, fmsg2,
     if map_full_name not in msg_path_to_obj:
         for fnumber, fname, ftype, fmsg in ((1, 'key', ftype1, fmsg1), \
                                             (2, 'value', ftype2, fmsg2)):
-            field = map_obj.field.add()
+            field = Field()
+            map_obj.field.append(field)
 
             if type(ftype) is str:
                 if ftype.isnumeric():
@@ -820,17 +1377,17 @@ def create_map(cls, jar, enums, pkg, var, number, ftype1, fmsg1, ftype2, fmsg2,
                     enum_code = jar.decomp(enum_name, True).raw
                     ftype = type_consts[enum_code.split(enum_var + ' = new ')[1].split('"')[1].lower()]
 
-            if fmsg and ftype in (field.TYPE_GROUP, field.TYPE_ENUM, field.TYPE_MESSAGE):
+            if fmsg and ftype in (FieldDescriptorProto.TYPE_GROUP, FieldDescriptorProto.TYPE_ENUM, FieldDescriptorProto.TYPE_MESSAGE):
                 if '.' not in fmsg and pkg:
                     fmsg = pkg + '.' + fmsg
                 msg_to_referrers[fmsg].append((fname, map_full_name, ftype == FieldDescriptorProto.TYPE_GROUP))
                 field.type_name = '.' + fmsg
             
-            if ftype == field.TYPE_ENUM:
+            if ftype == FieldDescriptorProto.TYPE_ENUM:
                 if fmsg:
                     create_enum(jar, enums, fmsg, msg_path_to_obj)
                 else:
-                    ftype = field.TYPE_INT32
+                    ftype = FieldDescriptorProto.TYPE_INT32
             
             field.type = ftype
             field.name = fname
@@ -844,6 +1401,8 @@ def create_map(cls, jar, enums, pkg, var, number, ftype1, fmsg1, ftype2, fmsg2,
     Extraction routine for the J2ME implementation. See [1] for
     reference of type and label constants.
     
+    Return the names of the messages defined.
+    
     [1] https://github.com/android/platform_external_protobuf/blob/eclair-release/src/com/google/common/io/protocol/ProtoBufType.java
 """
 
@@ -866,15 +1425,20 @@ def extract_j2me(jar, cls, enums, gen_classes_j2me, protobuftype_cls, consts,
     for var in findall('(\w+) = new ', code):
         fields_for_msg[var]
     
+    # Object variable reassignments, as (start, end, var, value), kept
+    # up to date as the code is rewritten below
+    reassigns = [(match.start(), match.end(), *match.groups()) for match in J2ME_REASSIGN.finditer(code)]
+    
     while True:
         # Case 1: handle embedded groups
-        decl = list(finditer('(\(new \w+\(("\w+")\)\)(?=((?:\.\w+\(\d+, \d+, .+?\))+)\)))', code))[::-1]
+        decl = list(finditer('(\(new \w+\(("\w+")\)\)(?=((?:\.\w+\(\d+, \d+, .+?\))+)\)))', code))
+        decl = decl[-1] if decl else None
         if not decl:
             # Case 2: general case, handle messages
-            decl = list(finditer('( (\w+)(?=((?:\.\w+\(\d+, \d+, .+?\))+);))', code))
+            decl = search('( (\w+)(?=((?:\.\w+\(\d+, \d+, .+?\))+);))', code)
         if not decl:
             break
-        prefix, var, fields = decl[0].groups()
+        prefix, var, fields = decl.groups()
         
         if var[0] == '"':
             var = var.strip('"')
@@ -883,31 +1447,46 @@ def extract_j2me(jar, cls, enums, gen_classes_j2me, protobuftype_cls, consts,
                 var += '_'
         else:
             # If message, handle object variable reassignements
-            public_var = findall(' %s = ([a-zA-Z_][\w$]*);' % var, code[:decl[0].start()])
+            public_var = [value for start, end, name, value in reassigns if name == var and end <= decl.start()]
             if public_var and public_var[-1] != 'null':
                 var = public_var[-1]
-
-        code = code.replace(prefix + fields, var, 1)
+        
+        # Replace the declaration with the variable name, and reindex
+        # reassignments on the line it was part of
+        start = code.index(prefix + fields)
+        end = start + len(prefix + fields)
+        shift = len(var) - len(prefix + fields)
+        
+        line_start = code.rfind('\n', 0, start) + 1
+        line_end = code.find('\n', end)
+        if line_end == -1:
+            line_end = len(code)
+        
+        code = code[:start] + var + code[end:]
+        
+        reassigns = [i for i in reassigns if i[1] <= line_start] + \
+                    [(match.start(), match.end(), *match.groups()) for match in J2ME_REASSIGN.finditer(code, line_start, line_end + shift)] + \
+                    [(i[0] + shift, i[1] + shift, i[2], i[3]) for i in reassigns if i[0] >= line_end]
         
         # Store var, fields
         fields_for_msg[var] += fields
     
     """
-    Final step: Build the DescriptorProto object
+    Final step: Build the Message object
     """
     
     for var, fields in fields_for_msg.items():
-        message = DescriptorProto()
+        message = Message(var)
 
         my_namer = namer()
         summary = {}
         
         print('\nIn %s.%s:' % (cls, var))
-        message.name = var
 
         if fields:
             for ftypeandlabel, fnumber, fdefaultormsg in findall('\.\w+\((\d+), (\d+), (.+?)\)', fields):
-                field = message.field.add()
+                field = Field()
+                message.field.append(field)
                 
                 # Use int32 instead of enum (we don't have enum contents),
                 # Use bytes and string instead of data and text (Protobuf 1 types).
@@ -929,8 +1508,7 @@ def extract_j2me(jar, cls, enums, gen_classes_j2me, protobuftype_cls, consts,
                             msg_to_referrers[fdefaultormsg].append((field.name, cls + '.' + var, ftype == 'group'))
                             
                             if fdefaultormsg not in msg_path_to_obj: # Classes empty or to be created
-                                msg_path_to_obj[fdefaultormsg] = DescriptorProto()
-                                msg_path_to_obj[fdefaultormsg].name = fdefaultormsg.split('.')[-1]
+                                msg_path_to_obj[fdefaultormsg] = Message(fdefaultormsg.split('.')[-1])
                         
                         else:
                             field.type_name = '.' + cls + '.' + fdefaultormsg
@@ -954,6 +1532,10 @@ def extract_j2me(jar, cls, enums, gen_classes_j2me, protobuftype_cls, consts,
         
         msg_path_to_obj[cls + '.' + var] = message
         print(summary)
+    
+    return [cls + '.' + var for var in fields_for_msg]
+
+J2ME_REASSIGN = compile(' (\w+) = ([a-zA-Z_][\w$]*);')
 
 type_consts = {k.split('_')[1].lower(): v for k, v in FieldDescriptorProto.Type.items()}
 label_consts = {k.split('_')[1].lower(): v for k, v in FieldDescriptorProto.Label.items()}
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from struct import pack, pack_into
+
+"""
+    A tiny JVM class file assembler, for building the classes that
+    tests run extractors over without needing a Java compiler.
+    
+    Only what these classes use is supported: a constant pool with
+    classes, fields and methods, and methods with bytecode whose
+    branches and lookupswitch targets are given as labels.
+"""
+
+class ConstantPool:
+    def __init__(self):
+        self.entries = []
+        self.indexes = {}
+    
+    def add(self, key, data):
+        if key not in self.indexes:
+            self.entries.append(data)
+            self.indexes[key] = len(self.entries)
+        return self.indexes[key]
+    
+    def utf8(self, value):
+        data = value.encode('utf8')
+        return self.add(('utf8', value), b'\x01' + pack('>H', len(data)) + data)
+    
+    def cls(self, name):
+        return self.add(('class', name), b'\x07' + pack('>H', self.utf8(name)))
+    
+    def name_and_type(self, name, desc):
+        return self.add(('nat', name, desc), b'\x0c' + pack('>HH', self.utf8(name), self.utf8(desc)))
+    
+    def field(self, cls, name, desc):
+        return self.add(('field', cls, name, desc), b'\x09' + pack('>HH', self.cls(cls), self.name_and_type(name, desc)))
+    
+    def method(self, cls, name, desc):
+        return self.add(('method', cls, name, desc), b'\x0a' + pack('>HH', self.cls(cls), self.name_and_type(name, desc)))
+    
+    def to_bytes(self):
+        return pack('>H', len(self.entries) + 1) + b''.join(self.entries)
+
+class Bytecode:
+    def __init__(self):
+        self.code = bytearray()
+        self.labels = {}
+        self.fixups = [] # (instruction position, operand position, label, struct format)
+    
+    def op(self, *data):
+        self.code += bytes(data)
+    
+    def op_u2(self, op, index):
+        self.code += bytes([op]) + pack('>H', index)
+    
+    def label(self, name):
+        self.labels[name] = len(self.code)
+    
+    def branch(self, op, label):
+        self.fixups.append((len(self.code), len(self.code) + 1, label, '>h'))
+        self.code += bytes([op, 0, 0])
+    
+    def lookupswitch(self, default, cases):
+        pos = len(self.code)
+        self.code += b'\xab'
+        while len(self.code) % 4:
+            self.code += b'\0'
+        
+        self.fixups.append((pos, len(self.code), default, '>i'))
+        self.code += bytes(4) + pack('>i', len(cases))
+        
+        for key, label in sorted(cases.items()):
+            self.code += pack('>i', key)
+            self.fixups.append((pos, len(self.code), label, '>i'))
+            self.code += bytes(4)
+    
+    def to_bytes(self):
+        for pos, operand_pos, label, fmt in self.fixups:
+            pack_into(fmt, self.code, operand_pos, self.labels[label] - pos)
+        return bytes(self.code)
+
+"""
+    Methods are given as (name, descriptor, Bytecode, max stack, max
+    locals) tuples, fields as (name, descriptor) couples.
+"""
+
+def build_class(pool, name, superclass, fields, methods):
+    this, parent, code_attr = pool.cls(name), pool.cls(superclass), pool.utf8('Code')
+    fields = [(pool.utf8(field), pool.utf8(desc)) for field, desc in fields]
+    methods = [(pool.utf8(method), pool.utf8(desc), code.to_bytes(), max_stack, max_locals)
+               for method, desc, code, max_stack, max_locals in methods]
+    
+    out = b'\xca\xfe\xba\xbe' + pack('>HH', 0, 49) + pool.to_bytes()
+    out += pack('>HHHH', 0x21, this, parent, 0)
+    
+    out += pack('>H', len(fields))
+    for field, desc in fields:
+        out += pack('>HHHH', 0x1, field, desc, 0)
+    
+    out += pack('>H', len(methods))
+    for method, desc, code, max_stack, max_locals in methods:
+        attr = pack('>HHI', max_stack, max_locals, len(code)) + code + pack('>HH', 0, 0)
+        out += pack('>HHHH', 0x1, method, desc, 1) + pack('>HI', code_attr, len(attr)) + attr
+    
+    return out + pack('>H', 0)
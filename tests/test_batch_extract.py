@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+from subprocess import run, PIPE
+from sys import executable
+from pathlib import Path
+from json import load
+
+from os.path import dirname, realpath
+__import__('sys').path.append(dirname(realpath(__file__)) + '/..')
+from test_from_binary import make_binary
+
+ROOT = dirname(realpath(__file__)) + '/..'
+
+def read_tree(path):
+    return {str(i.relative_to(path)): i.read_text() for i in sorted(Path(path).rglob('*')) if i.is_file()}
+
+class BatchSummaryTest(TestCase):
+    def test_summary(self):
+        with TemporaryDirectory() as tmp:
+            Path(tmp, 'lib.so').write_bytes(make_binary())
+            Path(tmp, 'junk.so').write_bytes(b'\0' * 100)
+            
+            # Same output as the extractor run on its own
+            run([executable, ROOT + '/extractors/from_binary.py', 'lib.so', 'single'], cwd=tmp, stdout=PIPE, check=True)
+            
+            # "lib.so" is also matched by the glob, and is only processed once
+            out = run([executable, ROOT + '/batch_extract.py', 'from_binary', 'lib.so', 'junk.so', '*.so', 'missing.so', 'out',
+                       '-j', '2', '--jobs', '2'], cwd=tmp, stdout=PIPE, check=True).stdout.decode('utf8')
+            
+            self.assertIn('Processed 3 inputs (1 failed), wrote 3 .proto files to "out"', out)
+            
+            with open(tmp + '/out/summary.json') as fd:
+                summary = load(fd)
+            
+            self.assertEqual([(i['input'], i['output_dir'], i['protos']) for i in summary],
+                             [('lib.so', 'out/lib', 3), ('junk.so', 'out/junk', 0), ('missing.so', 'out/missing', 0)])
+            self.assertEqual([bool(i['error']) for i in summary], [False, False, True])
+            self.assertIn('FileNotFoundError', summary[2]['error'])
+            
+            self.assertEqual(read_tree(tmp + '/out/lib'), read_tree(tmp + '/single'))
+            self.assertEqual(len(read_tree(tmp + '/single')), 3)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from re import findall, search, escape, MULTILINE
+from unittest import TestCase, main
+from random import Random
+
+from os.path import dirname, realpath
+__import__('sys').path.append(dirname(realpath(__file__)) + '/..')
+from utils.java_wrapper import JarWrapper, IntervalIndex
+from utils.common import external
+
+JAR = str(external / 'dex2jar' / 'lib' / 'dx-1.7.jar')
+NB_CLASSES = 60
+
+"""
+    The expected values below are computed the way the parser did it
+    before being optimized, over real Jad output: stripping annotations
+    one at a time, and scanning the whole class (or all of its calls
+    and blocks) for every lookup.
+"""
+
+class ClassWrapperTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.jar = JarWrapper(JAR, jobs=4, cache=False)
+        classes = cls.jar.classes[:NB_CLASSES]
+        list(cls.jar.prefetch(classes))
+        
+        cls.codes = [code for code in map(cls.jar.decomp, classes) if code.raw]
+        assert len(cls.codes) > NB_CLASSES // 2
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.jar.cleanup()
+    
+    def test_annotations_stripped_as_before(self):
+        for code in self.codes:
+            raw = self.jar.source(code.cls, False)
+            while True:
+                annote = search(r'\n {4,}//(?:[* ] {0,3}[0-9]{1,5}){2}:.+(?:\n {4,}//.+)*', raw, flags=MULTILINE)
+                if not annote:
+                    break
+                raw = raw[:annote.start()] + raw[annote.end():]
+            
+            self.assertEqual(code.raw, raw)
+            self.assertTrue(code.method_cache)
+    
+    def test_lookups_match_linear_scans(self):
+        rand = Random(0)
+        
+        for code in self.codes:
+            bounds = list(code.method_bounds.values()) + code.cond_bounds
+            positions = {pos + delta for start, end in bounds for pos in (start, end) for delta in (-1, 0, 1)}
+            positions |= {pos + delta for pos in code.method_calls for delta in (-1, 0, 1)}
+            positions |= {rand.randrange(len(code.raw)) for i in range(50)}
+            
+            for pos in sorted(positions):
+                self.assertEqual(code.method_at(pos), next((i for i in code.method_bounds.values() if i[0] < pos < i[1]), None))
+                self.assertEqual(code.cond_at(pos), next((i for i in code.cond_bounds if i[0] < pos < i[1]), None))
+            
+            for start, end in bounds + [tuple(sorted(rand.sample(sorted(positions), 2))) for i in range(20)]:
+                self.assertEqual(code.calls_in_range(start, end),
+                                 [(i, call) for i, call in code.method_calls.items() if start < i < end])
+            
+            for pos in list(code.method_calls)[:20]:
+                self.assertEqual(code.lines_from(pos), code.raw[pos:].split('\n', 1)[0])
+                self.assertEqual(code.lines_from(pos, 3), '\n'.join(code.raw[pos:].split('\n')[:3]))
+    
+    def test_variable_indexes_match_findall(self):
+        for code in self.codes[:20]:
+            # Identifiers that are assigned or declared somewhere, and a few that aren't
+            for var in sorted(set(findall(r'([a-zA-Z_$][\w$]*)(?:\[\])*(?: =|;)', code.raw))) + ['this', 'i', 'Object']:
+                self.assertEqual(code.assigned_values(var),
+                                 findall(r'\s+(?:super\.)?%s(?:\[\])* = (.+?);' % escape(var), code.raw, flags=MULTILINE))
+                
+                decl = search(r'([\w.$]+?) %s(?:\[\])*(?: =|;)' % escape(var), code.raw, flags=MULTILINE)
+                self.assertEqual(code.declared_type(var), decl and decl.group(1))
+
+class IntervalIndexTest(TestCase):
+    def test_nested_intervals(self):
+        intervals = [(10, 20), (0, 100), (30, 40), (32, 35), (50, 60), (50, 55)]
+        index = IntervalIndex(intervals)
+        
+        for pos in range(-1, 102):
+            self.assertEqual(index.find(pos), next((i for i in intervals if i[0] < pos < i[1]), None))
+        
+        self.assertIsNone(IntervalIndex([]).find(0))
+
+if __name__ == '__main__':
+    main()
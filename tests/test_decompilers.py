@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from contextlib import redirect_stdout
+from subprocess import TimeoutExpired
+from unittest.mock import patch
+from unittest import TestCase, main
+from os import makedirs
+from io import StringIO
+from sys import executable
+
+from os.path import dirname, realpath
+__import__('sys').path.append(dirname(realpath(__file__)) + '/..')
+from utils.decompilers import JadDecompiler, ServerDecompiler
+from utils.java_wrapper import JarWrapper
+from utils.decomp_cache import DecompCache
+from utils.common import external
+
+ROOT = dirname(realpath(__file__)) + '/..'
+JAR = str(external / 'dex2jar' / 'lib' / 'dx-1.7.jar')
+SERVER = '"%s" "%s/utils/jad_server.py"' % (executable, ROOT)
+
+class ServerDecompilerTest(TestCase):
+    def decompile(self, decompiler, no_parse=False):
+        with JarWrapper(JAR, jobs=1, cache=False) as jar:
+            classes = jar.classes[:20]
+            out = StringIO()
+            with redirect_stdout(out):
+                sources = decompiler.decompile(jar, classes, no_parse)
+            decompiler.close()
+        return classes, sources, out.getvalue()
+    
+    def test_reference_server(self):
+        for no_parse in (False, True):
+            classes, expected, out = self.decompile(JadDecompiler(), no_parse)
+            self.assertEqual(len(expected), len(classes))
+            
+            classes, sources, out = self.decompile(ServerDecompiler(SERVER, JadDecompiler()), no_parse)
+            self.assertEqual(out, '')
+            self.assertEqual(sources, expected)
+    
+    def test_fallback_reason(self):
+        classes, expected, out = self.decompile(JadDecompiler())
+        
+        classes, sources, out = self.decompile(ServerDecompiler('exit 3'))
+        self.assertIn('(Decompiler server failed: ', out)
+        self.assertIn('3', out)
+        self.assertEqual(sources, expected)
+
+    def test_cache_shared_with_jad(self):
+        jad, server = JadDecompiler(), ServerDecompiler('décompilateur --port 1234')
+        
+        for no_parse in (False, True):
+            self.assertEqual(server.flags(no_parse), jad.flags(no_parse))
+        self.assertNotEqual(server.identity(), jad.identity())
+        self.assertNotEqual(server.identity(), ServerDecompiler(SERVER).identity())
+    
+    def test_cache_key_non_ascii_flags(self):
+        cache = DecompCache()
+        self.assertNotEqual(cache.key(b'', ['-d', 'sortie']), cache.key(b'', ['-d', 'sortie-é']))
+
+class JadTimeoutTest(TestCase):
+    def test_partial_output_is_not_cached(self):
+        # Jad leaves a truncated source behind when it's killed
+        def hung_jad(args, timeout, cwd, **kwargs):
+            outdir = args[args.index('-d') + 1]
+            for path in args[args.index('.java') + 1:]:
+                outpath = outdir + path[len(cwd):-len('.class')] + '.java'
+                makedirs(dirname(outpath), exist_ok=True)
+                with open(outpath, 'w') as fd:
+                    fd.write('public class Truncated\n{\n')
+            raise TimeoutExpired(args, timeout)
+        
+        with JarWrapper(JAR, jobs=1, cache=False) as jar, redirect_stdout(StringIO()):
+            classes = jar.classes[:3]
+            
+            with patch('utils.decompilers.run', hung_jad):
+                self.assertEqual(jar.run_decompiler(classes), {cls: '' for cls in classes})
+            
+            flags = jar.decompiler.flags(False)
+            for cls in classes:
+                self.assertIsNone(jar.cache.get(jar.cache.key(jar.read(cls), flags)))
+            
+            # Classes are decompiled again on the next request
+            self.assertTrue(all(jar.run_decompiler(classes).values()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from google.protobuf.descriptor_pb2 import FileDescriptorProto
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+from unittest import TestCase, main
+
+from os.path import dirname, realpath
+__import__('sys').path.append(dirname(realpath(__file__)) + '/..')
+from utils.descpb_to_proto import descpb_to_proto
+from extractors.from_binary import walk_binary
+
+def descriptor(name, package, messages, dependencies=()):
+    proto = FileDescriptorProto(name=name, package=package, dependency=dependencies)
+    for msg in messages:
+        proto.message_type.add(name=msg).field.add(name='id', number=1, type=5, label=1)
+    return proto
+
+# A descriptor refers to the files it depends on by name, which mustn't be taken for descriptors themselves
+DESCRIPTORS = [descriptor('foo/a.proto', 'foo', ['A']),
+               descriptor('foo/b.proto', 'foo', ['B', 'C'], ['foo/a.proto']),
+               descriptor('bar/c.protodevel', 'bar', ['D'])]
+
+EXPECTED = [descpb_to_proto(proto) for proto in DESCRIPTORS]
+
+def make_binary(padding=100):
+    binr = b'\x7fELF' + b'\0' * padding + b'not_a.proto\0'
+    for proto in DESCRIPTORS:
+        binr += bytes(range(256))[:padding] + proto.SerializeToString()
+    return binr + b'\0' * padding
+
+class WalkBinaryTest(TestCase):
+    def test_mapped_file(self):
+        binr = make_binary()
+        self.assertEqual(list(walk_binary(binr)), EXPECTED)
+        
+        with TemporaryDirectory() as tmp:
+            with open(tmp + '/lib.so', 'wb') as fd:
+                fd.write(binr)
+            self.assertEqual(list(walk_binary(tmp + '/lib.so')), EXPECTED)
+    
+    def test_empty_or_missing_file(self):
+        with TemporaryDirectory() as tmp:
+            open(tmp + '/empty.so', 'wb').close()
+            self.assertEqual(list(walk_binary(tmp + '/empty.so')), [])
+            self.assertEqual(list(walk_binary(tmp + '/missing.so')), [])
+
+class ParallelScanTest(TestCase):
+    def test_same_as_serial_scan(self):
+        # Windows small enough for descriptors, and the lookback before them, to cross their bounds
+        for chunk_size in (16, 61, 64, 1000):
+            with TemporaryDirectory() as tmp, patch('extractors.from_binary.CHUNK_SIZE', chunk_size):
+                with open(tmp + '/lib.so', 'wb') as fd:
+                    fd.write(make_binary())
+                
+                self.assertEqual(list(walk_binary(tmp + '/lib.so', jobs=3)), EXPECTED)
+                self.assertEqual(list(walk_binary(make_binary(), jobs=3)), EXPECTED)
+
+if __name__ == '__main__':
+    main()
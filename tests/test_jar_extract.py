@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from collections import OrderedDict, defaultdict
+from contextlib import redirect_stdout
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest import TestCase, main
+from json import dumps, loads
+from io import StringIO
+
+from os.path import dirname, realpath
+__import__('sys').path.append(dirname(realpath(__file__)) + '/..')
+from extractors.jar_extract import make_inventory, extract_classes, merge_extracted, dump_partial, load_partial, save_state, load_state
+from utils.nest_messages import nest_and_print_to_files
+from utils.class_file import ClassInfo
+
+def class_info(types=(), interfaces=()):
+    info = ClassInfo()
+    info.types = set(types)
+    info.interfaces = list(interfaces)
+    return info
+
+class InventoryTest(TestCase):
+    def test_only_protobuf_enums_are_counted(self):
+        class_infos = {
+            'a.Msg': class_info(['a/Msg', 'a/Msg$Kind']),
+            'a.Msg$Kind': class_info(),
+            'a.Status': class_info(interfaces=['com/google/protobuf/Internal$EnumLite']),
+            'a.Color': class_info(),
+            'b.Mode': class_info()
+        }
+        enums = {'a.Msg$Kind': 'a.Msg$Kind', 'a.Msg.Kind': 'a.Msg$Kind', 'a.Kind': 'a.Msg$Kind',
+                 'a.Status': 'a.Status', 'a.Color': 'a.Color', 'b.Mode': 'b.Mode'}
+        jar = SimpleNamespace(classes=list(class_infos), bonus_protos=OrderedDict())
+        
+        inventory = make_inventory(jar, {}, {}, {}, {}, {'a.Msg': ('x.CodedInputStream', 'x.CodedOutputStream')}, {},
+                                   enums, class_infos, set())
+        
+        self.assertEqual(inventory['enums'], 2)
+        self.assertEqual(inventory['packages']['a']['enums'], 2)
+        self.assertNotIn('b', inventory['packages'])
+
+# J2ME messages referring to each other, and to a class that is missing
+
+def j2me_source(num, ref):
+    return """package foo;
+
+public class M%d
+{
+    static 
+    {
+        A = new ProtoBufType();
+        B = new ProtoBufType();
+        A.addElement(1041, 1, null).addElement(1051, 2, B).addElement(1051, 3, %s).addElement(1050, 4, (new ProtoBufType("Grp")).addElement(1044, 4, null));
+        B.addElement(1052, 1, new Integer(5)).addElement(1041, 2, null);
+    }
+}
+""" % (num, ref)
+
+J2ME_SOURCES = OrderedDict([('foo.M0', j2me_source(0, 'foo.M1.A')), ('foo.M1', j2me_source(1, 'foo.M2.B')),
+                            ('foo.M2', j2me_source(2, 'foo.M0.B')), ('foo.M3', j2me_source(3, 'foo.M9.A'))])
+
+class StateTest(TestCase):
+    def extract(self, reuse_state):
+        jar = SimpleNamespace(jobs=1, decomp=lambda cls, no_parse=False: SimpleNamespace(raw=J2ME_SOURCES[cls]))
+        jobs = [('j2me', cls, 'foo.ProtoBufType', {}) for cls in J2ME_SOURCES]
+        context = (jar, {}, {}, {cls: None for cls in J2ME_SOURCES}, [], [])
+        
+        msg_path_to_obj, msg_to_referrers = OrderedDict(), defaultdict(list)
+        with redirect_stdout(StringIO()) as output:
+            for job, partial in zip(jobs, extract_classes(context, jobs)):
+                # Go through the JSON state file format
+                if reuse_state:
+                    entry = dump_partial(partial, repr(job[2:]), OrderedDict((cls, 'digest') for cls in partial[4]), 'context')
+                    partial = load_partial(loads(dumps(entry)))
+                
+                merge_extracted(msg_path_to_obj, msg_to_referrers, partial)
+            
+            files = list(nest_and_print_to_files(msg_path_to_obj, msg_to_referrers))
+        
+        return files, output.getvalue()
+    
+    def test_reused_results_give_same_output(self):
+        files, output = self.extract(False)
+        
+        self.assertEqual(len(files), 7)
+        self.assertIn('import "foo/M2/B.proto";', dict(files)['foo/M1/A.proto'])
+        self.assertEqual(self.extract(True), (files, output))
+    
+    def test_state_file(self):
+        with TemporaryDirectory() as tmp:
+            path = tmp + '/state.json'
+            jobs = OrderedDict([('j2me:foo.M0', {'args': '()'})])
+            
+            self.assertEqual(load_state(path, 'jad'), {})
+            save_state(path, 'jad', jobs)
+            self.assertEqual(load_state(path, 'jad'), jobs)
+            
+            # Results obtained with another decompiler are dropped
+            self.assertEqual(load_state(path, 'server'), {})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from tempfile import TemporaryDirectory
+from zipfile import ZipFile
+from struct import pack
+from io import BytesIO
+from unittest import TestCase, main
+
+from os.path import dirname, realpath
+__import__('sys').path.append(dirname(realpath(__file__)) + '/..')
+from utils.java_wrapper import JarWrapper, WRAPPER_SIZE_FACTOR
+from utils.common import external
+
+JAR = str(external / 'dex2jar' / 'lib' / 'dx-1.7.jar')
+
+def make_zip(members):
+    out = BytesIO()
+    with ZipFile(out, 'w') as zf:
+        for member, contents in members.items():
+            zf.writestr(member, contents)
+    return out.getvalue()
+
+# Build a DEX file declaring empty classes, enough for these to be indexed
+
+def make_dex(class_names):
+    nb = len(class_names)
+    string_ids_off = 0x70
+    type_ids_off = string_ids_off + 4 * nb
+    class_defs_off = type_ids_off + 4 * nb
+    data_off = class_defs_off + 32 * nb
+    
+    string_ids, string_data = b'', b''
+    for cls in class_names:
+        desc = ('L%s;' % cls.replace('.', '/')).encode('utf8')
+        string_ids += pack('<I', data_off + len(string_data))
+        string_data += bytes([len(desc)]) + desc + b'\0'
+    
+    type_ids = b''.join(pack('<I', index) for index in range(nb))
+    class_defs = b''.join(pack('<8I', index, 1, 0xffffffff, 0, 0xffffffff, 0, 0, 0) for index in range(nb))
+    
+    header = b'dex\n035\0'.ljust(0x38, b'\0')
+    header += pack('<12I', nb, string_ids_off, nb, type_ids_off, 0, 0, 0, 0, 0, 0, nb, class_defs_off)
+    header = header.ljust(0x70, b'\0')
+    
+    return header + string_ids + type_ids + class_defs + string_data
+
+class NestedArchiveTest(TestCase):
+    def test_non_zip_member_is_skipped(self):
+        nested = make_zip({'a/Nested.class': b'\xca\xfe\xba\xbe'})
+        
+        with TemporaryDirectory() as tmp:
+            fname = tmp + '/bundle.apks'
+            with open(fname, 'wb') as fd:
+                fd.write(make_zip({
+                    'base.apk': nested,
+                    'assets/encrypted.jar': b'\x8f\x13' * 64,
+                    'assets/empty.apk': b''
+                }))
+            
+            with JarWrapper(fname, jobs=1, cache=False) as jar:
+                self.assertEqual(jar.classes, ['a.Nested'])
+                self.assertEqual(len(jar.archives), 2)
+
+class InvalidDexTest(TestCase):
+    def test_unreadable_dex_is_skipped(self):
+        with TemporaryDirectory() as tmp:
+            fname = tmp + '/app.apk'
+            with open(fname, 'wb') as fd:
+                fd.write(make_zip({
+                    'classes.dex': b'dex\n035\0'.ljust(48, b'\0'),
+                    'assets/payload.dex': bytes(range(256)) * 4,
+                    'a/Plain.class': b'\xca\xfe\xba\xbe'
+                }))
+            
+            with JarWrapper(fname, jobs=1, cache=False) as jar:
+                self.assertEqual(jar.classes, ['a.Plain'])
+                self.assertFalse(jar.dex_files)
+
+class LazyDexTest(TestCase):
+    def test_dex_without_needed_classes_is_not_converted(self):
+        with TemporaryDirectory() as tmp:
+            fname = tmp + '/app.apk'
+            with open(fname, 'wb') as fd:
+                fd.write(make_zip({
+                    'classes.dex': make_dex(['a.First']),
+                    'classes2.dex': make_dex(['b.Second', 'b.Third'])
+                }))
+            
+            with JarWrapper(fname, jobs=2, cache=False) as jar:
+                self.assertEqual(jar.classes, ['a.First', 'b.Second', 'b.Third'])
+                
+                # dex2jar can't be assumed to be there, record what would be converted
+                converted = []
+                jar.convert_dex = lambda name: converted.append(name) or tmp + '/none.jar'
+                
+                list(jar.prefetch(['b.Second', 'b.Third']))
+                self.assertEqual(converted, [fname + '/classes2.dex'])
+                self.assertEqual(jar.converted, {fname + '/classes2.dex'})
+                
+                jar.load_class('b.Second')
+                self.assertEqual(converted, [fname + '/classes2.dex'])
+
+class MemoryBudgetTest(TestCase):
+    def parse(self, max_memory, classes=None):
+        with JarWrapper(JAR, jobs=4, cache=False, max_memory=max_memory) as jar:
+            classes = classes or [cls for cls in jar.classes[:40] if jar.decomp(cls).raw][:20]
+            list(jar.prefetch(classes))
+            
+            parsed = {}
+            for cls in classes + classes[::-1]:
+                code = jar.decomp(cls)
+                parsed[cls] = (code.raw, list(code.method_cache.items()))
+                
+                self.assertEqual(jar.memory_used, sum(jar.memory.values()))
+                self.assertTrue(jar.memory_used <= max_memory or len(jar.memory) == 1)
+            
+            return classes, parsed, jar.decompiled.keys()
+    
+    def test_evicted_classes_are_parsed_again(self):
+        classes, expected, kept = self.parse(1 << 30)
+        self.assertLessEqual(set(classes), set(kept))
+        
+        # Room for a few classes only
+        max_memory = max(len(raw) for raw, methods in expected.values()) * WRAPPER_SIZE_FACTOR * 3
+        classes, parsed, kept = self.parse(max_memory, classes)
+        
+        self.assertEqual(parsed, expected)
+        self.assertTrue(0 < len(kept) < len(classes))
+        
+        # Least recently used classes went first
+        self.assertIn(classes[0], kept)
+        self.assertNotIn(classes[len(classes) // 2], kept)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from contextlib import redirect_stdout
+from collections import OrderedDict, defaultdict
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+from unittest import TestCase, main
+from zipfile import ZipFile
+from io import StringIO
+
+from os.path import dirname, realpath
+__import__('sys').path.append(dirname(realpath(__file__)) + '/..')
+from class_builder import ConstantPool, Bytecode, build_class
+from utils.java_wrapper import JarWrapper
+from extractors import jar_extract
+
+OP_ICONST_0, OP_ICONST_1, OP_DUP, OP_IOR, OP_ARETURN, OP_RETURN = 0x03, 0x04, 0x59, 0x80, 0xb0, 0xb1
+OP_ALOAD_0, OP_ALOAD_1, OP_ALOAD_2, OP_ILOAD_2, OP_ISTORE_2, OP_ISTORE_3, OP_ILOAD_3 = 0x2a, 0x2b, 0x2c, 0x1c, 0x3d, 0x3e, 0x1d
+OP_ILOAD, OP_ISTORE, OP_ASTORE, OP_ALOAD = 0x15, 0x36, 0x3a, 0x19
+OP_IFEQ, OP_IFNE, OP_GOTO, OP_IFNONNULL = 0x99, 0x9a, 0xa7, 0xc7
+OP_GETFIELD, OP_PUTFIELD, OP_INVOKEVIRTUAL, OP_INVOKESPECIAL, OP_INVOKESTATIC, OP_NEW, OP_CHECKCAST = \
+    0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xbb, 0xc0
+
+LITE_STREAM = 'com/google/protobuf/CodedInputStream'
+NANO_STREAM = 'com/google/protobuf/nano/CodedInputByteBufferNano'
+
+"""
+    A parsing constructor as generated for Protobuf Lite 3.x:
+        
+        boolean done = false;
+        while (!done) {
+            int tag = input.readTag();
+            switch (tag) {
+                case 0: done = true; break;
+                default: if (!parseUnknownField(input, extensionRegistry, tag)) done = true; break;
+                case 8: bitField0_ |= 1; id_ = input.readInt32(); break;
+                ...
+            }
+        }
+"""
+
+def lite_class(read_tag='readTag', fall_through=False):
+    pool, code = ConstantPool(), Bytecode()
+    fields = []
+    
+    def stream_call(name, desc):
+        code.op_u2(OP_INVOKEVIRTUAL, pool.method(LITE_STREAM, name, desc))
+    
+    def put(name, desc):
+        fields.append((name, desc))
+        code.op_u2(OP_PUTFIELD, pool.field('p/LiteMsg', name, desc))
+    
+    code.op(OP_ICONST_0, OP_ISTORE_3)
+    code.label('loop')
+    code.op(OP_ILOAD_3)
+    code.branch(OP_IFNE, 'end')
+    code.op(OP_ALOAD_1)
+    stream_call(read_tag, '()I')
+    code.op(OP_ISTORE, 4, OP_ILOAD, 4)
+    code.lookupswitch('default', {0: 'done', 8: 'id', 18: 'name', 26: 'sub', 32: 'color', 41: 'ts'})
+    
+    code.label('done')
+    code.op(OP_ICONST_1, OP_ISTORE_3)
+    code.branch(OP_GOTO, 'break')
+    
+    code.label('default')
+    code.op(OP_ALOAD_0, OP_ALOAD_1, OP_ALOAD_2, OP_ILOAD, 4)
+    code.op_u2(OP_INVOKEVIRTUAL, pool.method('p/LiteMsg', 'parseUnknownField', '(L%s;Lcom/google/protobuf/ExtensionRegistryLite;I)Z' % LITE_STREAM))
+    code.branch(OP_IFNE, 'break')
+    code.op(OP_ICONST_1, OP_ISTORE_3)
+    code.branch(OP_GOTO, 'break')
+    
+    code.label('id')
+    code.op(OP_ALOAD_0, OP_DUP)
+    code.op_u2(OP_GETFIELD, pool.field('p/LiteMsg', 'bitField0_', 'I'))
+    code.op(OP_ICONST_1, OP_IOR)
+    put('bitField0_', 'I')
+    code.op(OP_ALOAD_0, OP_ALOAD_1)
+    stream_call('readInt32', '()I')
+    put('id_', 'I')
+    code.branch(OP_GOTO, 'color' if fall_through else 'break')
+    
+    code.label('name')
+    code.op(OP_ALOAD_1)
+    stream_call('readStringRequireUtf8', '()Ljava/lang/String;')
+    code.op(OP_ASTORE, 5, OP_ALOAD_0, OP_ALOAD, 5)
+    put('name_', 'Ljava/lang/Object;')
+    code.branch(OP_GOTO, 'break')
+    
+    code.label('sub')
+    code.op(OP_ALOAD_0, OP_ALOAD_1)
+    code.op_u2(OP_INVOKESTATIC, pool.method('p/Sub', 'parser', '()Lcom/google/protobuf/Parser;'))
+    code.op(OP_ALOAD_2)
+    stream_call('readMessage', '(Lcom/google/protobuf/Parser;Lcom/google/protobuf/ExtensionRegistryLite;)Lcom/google/protobuf/MessageLite;')
+    code.op_u2(OP_CHECKCAST, pool.cls('p/Sub'))
+    put('sub_', 'Lp/Sub;')
+    code.branch(OP_GOTO, 'break')
+    
+    code.label('color')
+    code.op(OP_ALOAD_0, OP_ALOAD_1)
+    stream_call('readEnum', '()I')
+    code.op_u2(OP_INVOKESTATIC, pool.method('p/Color', 'forNumber', '(I)Lp/Color;'))
+    put('color_', 'Lp/Color;')
+    code.branch(OP_GOTO, 'break')
+    
+    code.label('ts')
+    code.op(OP_ALOAD_0, OP_ALOAD_1)
+    stream_call('readFixed64', '()J')
+    put('ts_', 'J')
+    code.branch(OP_GOTO, 'break')
+    
+    code.label('break')
+    code.branch(OP_GOTO, 'loop')
+    code.label('end')
+    code.op(OP_RETURN)
+    
+    return build_class(pool, 'p/LiteMsg', 'com/google/protobuf/GeneratedMessageLite', list(OrderedDict.fromkeys(fields)),
+                       [('<init>', '(L%s;Lcom/google/protobuf/ExtensionRegistryLite;)V' % LITE_STREAM, code, 5, 6)])
+
+"""
+    A mergeFrom() method as generated for Protobuf Nano:
+        
+        while (true) {
+            int tag = input.readTag();
+            switch (tag) {
+                case 0: return this;
+                default: if (!WireFormatNano.parseUnknownField(input, tag)) return this; break;
+                case 8: this.id = input.readInt32(); break;
+                ...
+            }
+        }
+"""
+
+def nano_class(trailing=b''):
+    pool, code = ConstantPool(), Bytecode()
+    fields = []
+    
+    def stream_call(name, desc):
+        code.op_u2(OP_INVOKEVIRTUAL, pool.method(NANO_STREAM, name, desc))
+    
+    def put(name, desc):
+        fields.append((name, desc))
+        code.op_u2(OP_PUTFIELD, pool.field('p/NanoMsg', name, desc))
+    
+    code.label('loop')
+    code.op(OP_ALOAD_1)
+    stream_call('readTag', '()I')
+    code.op(OP_ISTORE_2, OP_ILOAD_2)
+    code.lookupswitch('default', {0: 'done', 8: 'id', 18: 'name', 24: 'flag', 33: 'value', 42: 'sub'})
+    
+    code.label('done')
+    code.op(OP_ALOAD_0, OP_ARETURN)
+    
+    code.label('default')
+    code.op(OP_ALOAD_1, OP_ILOAD_2)
+    code.op_u2(OP_INVOKESTATIC, pool.method('com/google/protobuf/nano/WireFormatNano', 'parseUnknownField', '(L%s;I)Z' % NANO_STREAM))
+    code.branch(OP_IFNE, 'break')
+    code.op(OP_ALOAD_0, OP_ARETURN)
+    
+    for label, name, read, desc in (('id', 'id', 'readInt32', 'I'), ('name', 'name', 'readString', 'Ljava/lang/String;'),
+                                    ('flag', 'flag', 'readBool', 'Z'), ('value', 'value', 'readDouble', 'D')):
+        code.label(label)
+        code.op(OP_ALOAD_0, OP_ALOAD_1)
+        stream_call(read, '()' + desc)
+        put(name, desc)
+        code.branch(OP_GOTO, 'break')
+    
+    code.label('sub')
+    code.op(OP_ALOAD_0)
+    code.op_u2(OP_GETFIELD, pool.field('p/NanoMsg', 'sub', 'Lp/Sub;'))
+    code.branch(OP_IFNONNULL, 'read_sub')
+    code.op(OP_ALOAD_0)
+    code.op_u2(OP_NEW, pool.cls('p/Sub'))
+    code.op(OP_DUP)
+    code.op_u2(OP_INVOKESPECIAL, pool.method('p/Sub', '<init>', '()V'))
+    put('sub', 'Lp/Sub;')
+    code.label('read_sub')
+    code.op(OP_ALOAD_1, OP_ALOAD_0)
+    code.op_u2(OP_GETFIELD, pool.field('p/NanoMsg', 'sub', 'Lp/Sub;'))
+    stream_call('readMessage', '(Lcom/google/protobuf/nano/MessageNano;)V')
+    code.branch(OP_GOTO, 'break')
+    
+    code.label('break')
+    code.branch(OP_GOTO, 'loop')
+    code.op(*trailing)
+    
+    return build_class(pool, 'p/NanoMsg', 'com/google/protobuf/nano/MessageNano', list(OrderedDict.fromkeys(fields)),
+                       [('mergeFrom', '(L%s;)Lp/NanoMsg;' % NANO_STREAM, code, 4, 3)])
+
+"""
+    Field numbers and types are read from the bytecode of the switch,
+    unless it's ambiguous, in which case Jad's output is parsed: both
+    should agree on generated classes.
+"""
+
+class MergeSwitchTest(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.enums = {'p.Color': 'p.Color'}
+        self.gen_classes = {'p.LiteMsg': None, 'p.NanoMsg': None, 'p.Sub': None}
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    def jar(self, cls, binr):
+        path = self.tmp.name + '/test.jar'
+        with ZipFile(path, 'w') as zf:
+            zf.writestr(cls.replace('.', '/') + '.class', binr)
+        return JarWrapper(path, jobs=1, cache=False)
+    
+    def read_switch(self, cls, binr, stream):
+        with self.jar(cls, binr) as jar:
+            return jar_extract.read_merge_switch(jar, cls, self.enums, self.gen_classes, stream.replace('/', '.'), [])
+    
+    def extract(self, cls, binr, stream, from_bytecode):
+        msg_path_to_obj = OrderedDict([('p.Color', jar_extract.Enum('Color'))])
+        
+        with self.jar(cls, binr) as jar, redirect_stdout(StringIO()):
+            if from_bytecode:
+                self.assertIsNotNone(jar_extract.read_merge_switch(jar, cls, self.enums, self.gen_classes, stream.replace('/', '.'), []))
+                jar_extract.extract_lite(jar, cls, self.enums, self.gen_classes, stream.replace('/', '.'), None, [], [],
+                                         msg_path_to_obj, defaultdict(list))
+            else:
+                with patch.object(jar_extract, 'read_merge_switch', return_value=None):
+                    jar_extract.extract_lite(jar, cls, self.enums, self.gen_classes, stream.replace('/', '.'), None, [], [],
+                                             msg_path_to_obj, defaultdict(list))
+        
+        return [obj.dump() for obj in msg_path_to_obj.values()]
+    
+    def test_lite_parity(self):
+        binr = lite_class()
+        self.assertEqual(self.extract('p.LiteMsg', binr, LITE_STREAM, True), self.extract('p.LiteMsg', binr, LITE_STREAM, False))
+    
+    def test_nano_parity(self):
+        binr = nano_class()
+        self.assertEqual(self.extract('p.NanoMsg', binr, NANO_STREAM, True), self.extract('p.NanoMsg', binr, NANO_STREAM, False))
+    
+    def test_ambiguous_switches(self):
+        self.assertIsNotNone(self.read_switch('p.LiteMsg', lite_class(), LITE_STREAM))
+        
+        # Another int-returning method than readTag()
+        self.assertIsNone(self.read_switch('p.LiteMsg', lite_class(read_tag='readRawVarint32'), LITE_STREAM))
+        
+        # A case jumping into another one
+        self.assertIsNone(self.read_switch('p.LiteMsg', lite_class(fall_through=True), LITE_STREAM))
+        
+        # Truncated bytecode (a "wide" prefix without its instruction)
+        self.assertIsNone(self.read_switch('p.NanoMsg', nano_class(trailing=b'\xc4'), NANO_STREAM))
+
+if __name__ == '__main__':
+    main()
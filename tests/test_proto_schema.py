@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from google.protobuf.descriptor_pb2 import DescriptorProto, EnumDescriptorProto, FieldDescriptorProto, FileDescriptorProto
+from unittest import TestCase, main
+from json import dumps, loads
+
+from os.path import dirname, realpath
+__import__('sys').path.append(dirname(realpath(__file__)) + '/..')
+from utils.proto_schema import Message, Enum, EnumValue, Field, load_schema
+from utils.descpb_to_proto import descpb_to_proto
+
+F = FieldDescriptorProto
+
+# A message with the kinds of fields extractors produce, built on slotted objects
+
+def schema_message():
+    msg = Message('Msg')
+    msg.field = [Field('id', 1, F.LABEL_REQUIRED, F.TYPE_INT64),
+                 Field('name', 2, F.LABEL_OPTIONAL, F.TYPE_STRING, default_value='none'),
+                 Field('kind', 3, F.LABEL_OPTIONAL, F.TYPE_ENUM, '.p.Msg.Kind', oneof_index=0),
+                 Field('sub', 4, F.LABEL_OPTIONAL, F.TYPE_MESSAGE, '.p.Msg.Sub', oneof_index=0),
+                 Field('tags', 5, F.LABEL_REPEATED, F.TYPE_MESSAGE, '.p.Msg.TagsEntry')]
+    msg.oneof_decl = ['value']
+    
+    sub = Message('Sub')
+    sub.field = [Field('data', 1, F.LABEL_OPTIONAL, F.TYPE_BYTES)]
+    entry = Message('TagsEntry', map_entry=True)
+    entry.field = [Field('key', 1, F.LABEL_OPTIONAL, F.TYPE_STRING), Field('value', 2, F.LABEL_OPTIONAL, F.TYPE_INT32)]
+    msg.nested_type = [sub, entry]
+    
+    kind = Enum('Kind')
+    kind.value = [EnumValue('UNKNOWN', 0), EnumValue('OTHER', 5)]
+    msg.enum_type = [kind]
+    
+    return msg
+
+# The same message, built as extractors did before, on descriptor protos directly
+
+def descriptor_message():
+    msg = DescriptorProto(name='Msg')
+    msg.field.add(name='id', number=1, label=F.LABEL_REQUIRED, type=F.TYPE_INT64)
+    msg.field.add(name='name', number=2, label=F.LABEL_OPTIONAL, type=F.TYPE_STRING, default_value='none')
+    msg.field.add(name='kind', number=3, label=F.LABEL_OPTIONAL, type=F.TYPE_ENUM, type_name='.p.Msg.Kind', oneof_index=0)
+    msg.field.add(name='sub', number=4, label=F.LABEL_OPTIONAL, type=F.TYPE_MESSAGE, type_name='.p.Msg.Sub', oneof_index=0)
+    msg.field.add(name='tags', number=5, label=F.LABEL_REPEATED, type=F.TYPE_MESSAGE, type_name='.p.Msg.TagsEntry')
+    msg.oneof_decl.add(name='value')
+    
+    sub = msg.nested_type.add(name='Sub')
+    sub.field.add(name='data', number=1, label=F.LABEL_OPTIONAL, type=F.TYPE_BYTES)
+    entry = msg.nested_type.add(name='TagsEntry')
+    entry.field.add(name='key', number=1, label=F.LABEL_OPTIONAL, type=F.TYPE_STRING)
+    entry.field.add(name='value', number=2, label=F.LABEL_OPTIONAL, type=F.TYPE_INT32)
+    entry.options.map_entry = True
+    
+    kind = msg.enum_type.add(name='Kind')
+    kind.value.add(name='UNKNOWN', number=0)
+    kind.value.add(name='OTHER', number=5)
+    
+    return msg
+
+class ProtoSchemaTest(TestCase):
+    def test_same_descriptors_as_before(self):
+        self.assertEqual(schema_message().to_proto(), descriptor_message())
+        
+        # Unset attributes stay unset, rather than being given default values
+        desc = schema_message().to_proto()
+        self.assertFalse(desc.field[0].HasField('type_name'))
+        self.assertFalse(desc.field[0].HasField('oneof_index'))
+        self.assertFalse(desc.nested_type[0].HasField('options'))
+    
+    def test_same_output_as_before(self):
+        def to_file(msg):
+            return descpb_to_proto(FileDescriptorProto(name='p/msg.proto', package='p', message_type=[msg]))
+        
+        self.assertEqual(to_file(schema_message().to_proto()), to_file(descriptor_message()))
+    
+    def test_dump_and_load(self):
+        msg = schema_message()
+        loaded = load_schema(loads(dumps(msg.dump())))
+        
+        self.assertIsInstance(loaded, Message)
+        self.assertEqual(loaded.dump(), msg.dump())
+        self.assertEqual(loaded.to_proto(), descriptor_message())
+        self.assertEqual(load_schema(loads(dumps(msg.enum_type[0].dump()))).to_proto(), descriptor_message().enum_type[0])
+
+if __name__ == '__main__':
+    main()
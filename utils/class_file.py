@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from struct import unpack_from, error
+from re import findall
+
+"""
+    A minimal parser for JVM class files [1], reading only the parts
+    that are useful for recognizing Protobuf library and generated
+    classes: the constant pool, the superclass, and the declared
+    fields and methods (attributes are skipped over, except for the
+    code of methods when asked to, which can then be decoded with
+    read_instructions()).
+    
+    This is much cheaper than decompiling a class, and more precise
+    than looking for substrings in its bytes.
+    
+    [1] https://docs.oracle.com/javase/specs/jvms/se7/html/jvms-4.html
+    [2] https://docs.oracle.com/javase/specs/jvms/se7/html/jvms-6.html
+"""
+
+# Constant pool tags
+CONSTANT_Utf8 = 1
+CONSTANT_Class = 7
+CONSTANT_String = 8
+CONSTANT_Fieldref = 9
+CONSTANT_Methodref = 10
+CONSTANT_InterfaceMethodref = 11
+CONSTANT_NameAndType = 12
+
+# Size of the entries that we don't need to read, after the tag
+CONSTANT_SIZES = {3: 4, 4: 4, 5: 8, 6: 8, 7: 2, 8: 2, 9: 4, 10: 4, 11: 4, 12: 4,
+                  15: 3, 16: 2, 17: 4, 18: 4, 19: 2, 20: 2}
+
+# Instruction opcodes [2] that callers need to tell apart
+OP_ILOAD = 0x15
+OP_ISTORE = 0x36
+OP_ASTORE = 0x3a
+OP_IFEQ = 0x99
+OP_IFNE = 0x9a
+OP_GOTO = 0xa7
+OP_TABLESWITCH = 0xaa
+OP_LOOKUPSWITCH = 0xab
+OP_INVOKEVIRTUAL = 0xb6
+OP_INVOKESPECIAL = 0xb7
+OP_INVOKESTATIC = 0xb8
+OP_INVOKEINTERFACE = 0xb9
+OP_WIDE = 0xc4
+OP_GOTO_W = 0xc8
+OP_JSR_W = 0xc9
+
+OP_INVOKES = (OP_INVOKEVIRTUAL, OP_INVOKESPECIAL, OP_INVOKESTATIC, OP_INVOKEINTERFACE)
+OP_BRANCHES = (*range(0x99, 0xa9), 0xc6, 0xc7) # Instructions with a 16-bit offset
+
+# Size of the operands of every instruction, except for the switches and "wide"
+OPERAND_SIZES = bytes([0] * 16 + [1, 2, 1, 2, 2] + [1] * 5 + [0] * 28 + [1] * 5 + [0] * 73 + [2] + [0] * 20 +
+                      [2] * 16 + [1] + [0] * 8 + [2] * 7 + [4, 4, 2, 1, 2, 0, 0, 2, 2, 0, 0, 0, 3, 2, 2, 4, 4])
+
+"""
+    Class names use the internal form (i.e "com/google/protobuf/
+    CodedInputStream"), as in descriptors.
+    
+    A truncated or otherwise invalid class file doesn't raise, but
+    yields a ClassInfo holding whatever could be read before.
+"""
+
+class ClassInfo:
+    def __init__(self, binr=None, with_code=False):
+        self.name = None
+        self.superclass = None
+        self.interfaces = []
+        
+        self.classes = set() # Names of the classes referenced through CONSTANT_Class
+        self.types = set() # The above, along with classes used in field/method descriptors
+        self.strings = '' # String literals, separated with null characters
+        
+        self.method_names = set() # Names of the methods declared or called
+        self.descriptors = set() # Descriptors of the methods declared or called
+        self.methods = [] # Declared methods, as (access flags, name, descriptor) tuples
+        self.method_refs = set() # Called methods, as (class, name, descriptor) tuples
+        
+        # Only filled in when "with_code" is set:
+        self.code = {} # Bytecode of the declared methods, as {(name, descriptor): bytes}
+        self.constants = {} # Constant pool entries that instructions refer to: class names, or (class, name, descriptor) tuples for methods
+        
+        if binr is not None:
+            try:
+                self.parse(binr, with_code)
+            except (error, IndexError, KeyError):
+                pass
+    
+    def parse(self, binr, with_code=False):
+        if binr[:4] != b'\xca\xfe\xba\xbe':
+            return
+        
+        utf8 = {}
+        classes = {}
+        strings = []
+        name_and_types = {}
+        refs = []
+        
+        # Read the constant pool
+        
+        count, = unpack_from('>H', binr, 8)
+        pos = 10
+        index = 1
+        
+        while index < count:
+            tag = binr[pos]
+            
+            if tag == CONSTANT_Utf8:
+                size, = unpack_from('>H', binr, pos + 1)
+                utf8[index] = decode_utf8(binr[pos + 3:pos + 3 + size])
+                pos += 3 + size
+            
+            else:
+                if tag == CONSTANT_Class:
+                    classes[index], = unpack_from('>H', binr, pos + 1)
+                elif tag == CONSTANT_String:
+                    strings.append(unpack_from('>H', binr, pos + 1)[0])
+                elif tag in (CONSTANT_Methodref, CONSTANT_InterfaceMethodref):
+                    refs.append((index, *unpack_from('>HH', binr, pos + 1)))
+                elif tag == CONSTANT_NameAndType:
+                    name_and_types[index] = unpack_from('>HH', binr, pos + 1)
+                
+                pos += 1 + CONSTANT_SIZES[tag]
+            
+            # Long and double constants take two slots
+            index += 2 if tag in (5, 6) else 1
+        
+        classes = {index: utf8[name] for index, name in classes.items()}
+        
+        self.classes = set(classes.values())
+        self.strings = '\0'.join(utf8[index] for index in strings)
+        
+        for index, cls, name_and_type in refs:
+            name, desc = name_and_types[name_and_type]
+            self.method_refs.add((classes[cls], utf8[name], utf8[desc]))
+            
+            if with_code:
+                self.constants[index] = (classes[cls], utf8[name], utf8[desc])
+        
+        if with_code:
+            self.constants.update(classes)
+        
+        # Read the class header
+        
+        access, this, superclass, count = unpack_from('>HHHH', binr, pos)
+        self.name = classes[this]
+        self.superclass = classes.get(superclass)
+        self.interfaces = [classes[index] for index in unpack_from('>%dH' % count, binr, pos + 8)]
+        pos += 8 + 2 * count
+        
+        # Read fields, then methods
+        
+        field_descs = [desc for name, desc in name_and_types.values()]
+        
+        for is_method in (False, True):
+            count, = unpack_from('>H', binr, pos)
+            pos += 2
+            
+            for i in range(count):
+                access, name, desc, attr_count = unpack_from('>HHHH', binr, pos)
+                pos += 8
+                
+                for j in range(attr_count):
+                    attr_name, attr_size = unpack_from('>HI', binr, pos)
+                    
+                    # The "Code" attribute starts with max_stack, max_locals and code_length
+                    if is_method and with_code and utf8[attr_name] == 'Code':
+                        code_size, = unpack_from('>I', binr, pos + 10)
+                        self.code[utf8[name], utf8[desc]] = binr[pos + 14:pos + 14 + code_size]
+                    
+                    pos += 6 + attr_size
+                
+                if is_method:
+                    self.methods.append((access, utf8[name], utf8[desc]))
+                else:
+                    field_descs.append(desc)
+        
+        self.method_names = {name for cls, name, desc in self.method_refs} | \
+                            {name for access, name, desc in self.methods}
+        self.descriptors = {desc for cls, name, desc in self.method_refs} | \
+                           {desc for access, name, desc in self.methods}
+        
+        self.types = set(self.classes)
+        for desc in self.descriptors | {utf8[desc] for desc in field_descs}:
+            self.types.update(findall(r'L([^;]+);', desc))
+
+"""
+    Decode the bytecode of a method, yielding (offset, opcode, operand)
+    tuples, where the operand is:
+    
+    - For branches, the offset of the target,
+    - For switches, a (default target, [(key, target)...]) tuple,
+    - For other instructions, the unsigned value of their operand (i.e
+      a constant pool index, or a local variable number), or None.
+    
+    Short forms of load and store instructions (i.e "iload_1") are
+    normalized into their generic form (i.e "iload 1"), and so are
+    these prefixed with "wide".
+    
+    Decoding stops at the first invalid opcode, while truncated
+    operands raise struct.error.
+"""
+
+def read_instructions(code):
+    pos = 0
+    
+    while pos < len(code):
+        op = code[pos]
+        
+        if op in (OP_TABLESWITCH, OP_LOOKUPSWITCH):
+            args = pos + 4 - pos % 4 # Operands are 4-byte aligned
+            
+            if op == OP_TABLESWITCH:
+                default, low, high = unpack_from('>iii', code, args)
+                targets = unpack_from('>%di' % (high - low + 1), code, args + 12)
+                cases = [(low + i, pos + target) for i, target in enumerate(targets)]
+                size = args + 12 + 4 * len(targets) - pos
+            else:
+                default, count = unpack_from('>ii', code, args)
+                pairs = unpack_from('>%di' % (2 * count), code, args + 8)
+                cases = [(key, pos + target) for key, target in zip(pairs[::2], pairs[1::2])]
+                size = args + 8 + 8 * count - pos
+            
+            yield pos, op, (pos + default, cases)
+        
+        elif op == OP_WIDE:
+            op = code[pos + 1]
+            yield pos, op, unpack_from('>H', code, pos + 2)[0]
+            size = 6 if op == 0x84 else 4 # iinc also has a wide constant
+        
+        elif op >= len(OPERAND_SIZES):
+            return
+        
+        else:
+            size = 1 + OPERAND_SIZES[op]
+            operand = int.from_bytes(code[pos + 1:pos + size], 'big') if size > 1 else None
+            
+            if op in OP_BRANCHES:
+                operand = pos + unpack_from('>h', code, pos + 1)[0]
+            elif op in (OP_GOTO_W, OP_JSR_W):
+                operand = pos + unpack_from('>i', code, pos + 1)[0]
+            elif op in (OP_INVOKEINTERFACE, 0xba): # Followed by a count and/or zero bytes
+                operand, = unpack_from('>H', code, pos + 1)
+            
+            elif 0x1a <= op <= 0x2d: # xload_<n>
+                op, operand = OP_ILOAD + (op - 0x1a) // 4, (op - 0x1a) % 4
+            elif 0x3b <= op <= 0x4e: # xstore_<n>
+                op, operand = OP_ISTORE + (op - 0x3b) // 4, (op - 0x3b) % 4
+            
+            yield pos, op, operand
+        
+        pos += size
+
+"""
+    Class files use a "modified UTF-8" encoding, that stores the null
+    character over two bytes and supplementary characters as surrogate
+    pairs.
+"""
+
+def decode_utf8(binr):
+    binr = binr.replace(b'\xc0\x80', b'\0')
+    try:
+        return binr.decode('utf8', 'surrogatepass')
+    except UnicodeDecodeError:
+        return binr.decode('utf8', 'replace')
@@ -7,13 +7,17 @@ from importlib import import_module, reload
 from tempfile import TemporaryDirectory
 from inspect import getmembers, isclass
 from sys import platform, path as PATH
-from os import environ, makedirs, sep
+from os import environ, makedirs, sep, cpu_count
 from importlib.util import find_spec
-from argparse import ArgumentParser
+from argparse import ArgumentParser, SUPPRESS
 from urllib.parse import urlparse
 from platform import architecture
+from concurrent.futures import ProcessPoolExecutor
 from subprocess import run, PIPE
+from traceback import format_exc
 from json import dump, load
+from time import perf_counter
+from glob import glob
 from re import findall, sub
 from pathlib import Path
 from shutil import which
@@ -49,7 +53,8 @@ extractors = OrderedDict()
 def register_extractor(name = None, # Used to refer to internally
                        desc = None, # Used to describe extractor in GUI
                        pick_url = False, # Pick URL rather than file
-                       depends = None): # kwargs for assert_installed()
+                       depends = None, # kwargs for assert_installed()
+                       options = None): # {flag: kwargs for add_argument()}, passed to the extractor from the CLI
 """
 def register_extractor(**kwargs):
     def register_extractor_decorate(func):
@@ -229,6 +234,16 @@ def extractor_save(base_path, folder, outputs):
                 nb_written += 1
             name_to_path[name] = str(path)
         
+        elif name.endswith('.json'): # Reports, such as jar_extract's inventory
+            if folder:
+                path = base_path / 'protos' / folder / name
+            else:
+                path = base_path / name
+            
+            makedirs(str(path.parent), exist_ok=True)
+            with open(str(path), 'w') as fd:
+                fd.write(contents)
+        
         elif name.endswith('.sample'):
             endpoint = contents
             
@@ -256,8 +271,115 @@ def extractor_main(extractor):
         else:
             parser.add_argument('input_', metavar='input_file')
         parser.add_argument('output_dir', type=Path, default='.', nargs='?')
-        args = parser.parse_args()
+        for flag, kwargs in extractor.get('options', {}).items():
+            parser.add_argument(flag, **kwargs)
+        args = vars(parser.parse_args())
+        input_, output_dir = args.pop('input_'), args.pop('output_dir')
         
-        nb_written, wrote_endpoints = extractor_save(args.output_dir, '', extractor['func'](args.input_))
+        nb_written, wrote_endpoints = extractor_save(output_dir, '', extractor['func'](input_, **args))
         if nb_written:
-            print('\n[+] Wrote %s .proto files to "%s".\n' % (nb_written, args.output_dir))
+            print('\n[+] Wrote %s .proto files to "%s".\n' % (nb_written, output_dir))
+
+# CLI entry point for running an extractor over many inputs at once
+
+def extractor_batch():
+    parser = ArgumentParser(description='Run an extractor over a directory, glob or manifest of inputs')
+    parser.add_argument('extractor', choices=list(extractors))
+    parser.add_argument('inputs', nargs='*', help='Input files, directories, glob patterns or URLs')
+    parser.add_argument('output_dir', type=Path)
+    parser.add_argument('-m', '--manifest', type=Path, help='Text file listing one input per line')
+    parser.add_argument('-j', dest='batch_jobs', metavar='JOBS', type=int, default=cpu_count(), help='Number of inputs processed at once')
+    
+    # Options of every extractor, passed through to the chosen one
+    option_dests = defaultdict(set)
+    for name, extractor in extractors.items():
+        for flag, kwargs in extractor.get('options', {}).items():
+            dest = flag.lstrip('-').replace('-', '_')
+            if dest not in set().union(*option_dests.values()):
+                parser.add_argument(flag, **{**kwargs, 'default': SUPPRESS})
+            option_dests[name].add(dest)
+    
+    args = parser.parse_intermixed_args()
+    
+    extractor = extractors[args.extractor]
+    if not assert_installed(**extractor.get('depends', {})):
+        return
+    
+    options = {dest: getattr(args, dest) for dest in option_dests[args.extractor] if hasattr(args, dest)}
+    for dest in set().union(*option_dests.values()) - option_dests[args.extractor]:
+        if hasattr(args, dest):
+            parser.error('--%s is not an option of %s' % (dest.replace('_', '-'), args.extractor))
+    
+    # Inputs are already processed concurrently, don't multiply processes
+    if 'jobs' in option_dests[args.extractor]:
+        options.setdefault('jobs', 1)
+    
+    # Expand directories, globs and manifest entries to a list of inputs
+    
+    inputs = list(args.inputs)
+    if args.manifest:
+        with open(str(args.manifest)) as fd:
+            inputs += [line.strip() for line in fd if line.strip() and not line.startswith('#')]
+    
+    paths = []
+    for input_ in inputs:
+        if extractor.get('pick_url'):
+            paths.append((input_, urlparse(input_).netloc))
+        elif Path(input_).is_dir():
+            paths += [(str(i), i.stem) for i in sorted(Path(input_).iterdir()) if i.is_file()]
+        else:
+            paths += [(i, Path(i).stem) for i in sorted(glob(input_)) or [input_]]
+    
+    # Inputs given twice (e.g through a glob and a manifest) are processed once
+    
+    unique = OrderedDict()
+    for input_, folder in paths:
+        unique.setdefault(input_ if extractor.get('pick_url') else realpath(input_), (input_, folder))
+    
+    # Give each input its own output folder
+    
+    jobs = []
+    folders = set()
+    for input_, folder in unique.values():
+        while folder in folders:
+            folder += '_'
+        folders.add(folder)
+        jobs.append((args.extractor, input_, args.output_dir / folder, options))
+    
+    summary = []
+    with ProcessPoolExecutor(max(args.batch_jobs, 1)) as pool:
+        for result in pool.map(_extractor_batch_job, *zip(*jobs)):
+            summary.append(result)
+            
+            if result['error']:
+                print('[-] %s: failed after %.1fs (%s)' % (result['input'], result['seconds'], result['error'].splitlines()[-1]))
+            else:
+                print('[+] %s: wrote %d .proto files in %.1fs' % (result['input'], result['protos'], result['seconds']))
+    
+    makedirs(str(args.output_dir), exist_ok=True)
+    with open(str(args.output_dir / 'summary.json'), 'w') as fd:
+        dump(summary, fd, ensure_ascii=False, indent=4)
+    
+    nb_failed = sum(bool(i['error']) for i in summary)
+    print('\n[+] Processed %d inputs (%d failed), wrote %d .proto files to "%s".\n' % (
+        len(summary), nb_failed, sum(i['protos'] for i in summary), args.output_dir))
+
+def _extractor_batch_job(extractor, input_, output_dir, options):
+    start = perf_counter()
+    nb_written, error = 0, None
+    
+    try:
+        if not extractors[extractor].get('pick_url') and not exists(input_):
+            raise FileNotFoundError('No such file or directory: %r' % input_)
+        
+        nb_written, wrote_endpoints = extractor_save(output_dir, '', extractors[extractor]['func'](input_, **options))
+    except Exception:
+        error = format_exc()
+    
+    return {
+        'input': input_,
+        'output_dir': str(output_dir),
+        'seconds': round(perf_counter() - start, 3),
+        'protos': nb_written,
+        'error': error
+    }
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from os import makedirs, replace, remove, utime, walk, getpid
+from threading import Lock
+from pathlib import Path
+from hashlib import sha1
+from shutil import rmtree
+
+from utils.common import BASE_PATH
+
+"""
+    An on-disk cache for decompiled sources, shared across runs.
+    
+    Entries are addressed by a hash of the class file contents along
+    with the decompiler flags, so that classes that didn't change
+    between two builds of an application don't get decompiled again.
+    
+    The cache is capped in size: when it grows beyond, the least
+    recently used entries (according to their modification time, which
+    is refreshed on every hit) are evicted.
+"""
+
+CACHE_PATH = BASE_PATH / 'cache' / 'jad'
+CACHE_SIZE = 512 << 20 # Maximal size on disk, in bytes
+
+class DecompCache:
+    def __init__(self, path=CACHE_PATH, max_size=CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        
+        self.size = None # Lazily computed on first write
+        self.lock = Lock()
+    
+    def key(self, binr, flags):
+        return sha1(binr + b'\0' + ' '.join(flags).encode('utf8')).hexdigest()
+    
+    def get(self, key):
+        path = self.path / key[:2] / (key + '.java')
+        try:
+            with open(str(path)) as fd:
+                source = fd.read()
+            utime(str(path))
+        except OSError:
+            return None
+        return source
+    
+    def put(self, key, source):
+        path = self.path / key[:2] / (key + '.java')
+        tmp_path = path.with_suffix('.tmp%d' % getpid())
+        
+        makedirs(str(path.parent), exist_ok=True)
+        with open(str(tmp_path), 'w') as fd:
+            fd.write(source)
+        replace(str(tmp_path), str(path))
+        
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for path, size, mtime in self.entries())
+            else:
+                self.size += len(source.encode('utf8'))
+            
+            if self.size > self.max_size:
+                self.evict()
+    
+    """
+    Remove least recently used entries until the cache is back at 90%
+    of its maximal size.
+    """
+    
+    def evict(self):
+        for path, size, mtime in sorted(self.entries(), key=lambda entry: entry[2]):
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                remove(path)
+            except OSError:
+                pass
+            self.size -= size
+    
+    def entries(self):
+        for root, dirs, files in walk(str(self.path)):
+            for name in files:
+                path = Path(root) / name
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                yield str(path), stat.st_size, stat.st_mtime
+    
+    def clear(self):
+        rmtree(str(self.path), ignore_errors=True)
+        self.size = 0
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from subprocess import run, Popen, DEVNULL, PIPE, TimeoutExpired
+from threading import Lock, Timer
+from os.path import exists
+from os import getpid, remove
+
+from utils.common import jad
+
+"""
+    Decompiler backends, turning a batch of classes from a JarWrapper
+    into Java sources. Sources are expected in the format produced by
+    Jad with the flags below (including its annotations of method
+    calls), which is what ClassWrapper parses.
+    
+    A backend provides:
+    - flags(no_parse): the options that the output depends on, used
+      for addressing the decompiled classes cache (which is shared by
+      backends, as these produce the same format),
+    - identity(): what tells the backend apart from others, so that
+      extraction results kept across runs are only reused with the
+      backend that produced them,
+    - decompile(jar, classes, no_parse): a dict with the sources of
+      the classes that could be decompiled,
+    - close(): called when the JarWrapper is cleaned up.
+"""
+
+JAD_TIMEOUT = 5 # Seconds allowed to Jad, per class of a batch
+JAD_BATCH_SIZE = 16 # Maximal number of classes per Jad invocation
+
+"""
+    Run the native Jad binary over a batch of class files, extracted
+    to the JarWrapper's work directory.
+    
+    If Jad hangs on a class, the batch is split in two halves that are
+    retried separately, until the culprit is isolated.
+"""
+
+class JadDecompiler:
+    def flags(self, no_parse):
+        flags = ['-af', '-b', '-d', '-dead', '-f', '-i', '-ff', '-noinner', '-o', '-r', '-radix10', '-lradix10', '-s', '.java']
+        if no_parse:
+            flags.remove('-af')
+            flags.insert(0, '-nofd')
+        return flags
+    
+    def identity(self):
+        return 'jad'
+    
+    def decompile(self, jar, classes, no_parse):
+        outdir = jar.work_dir + ('/jad_noparse' if no_parse else '/jad')
+        
+        flags = self.flags(no_parse)
+        flags.insert(flags.index('-d') + 1, outdir)
+        
+        try:
+            run([jad] + flags + [jar.extract_class(cls) for cls in classes],
+                timeout=JAD_TIMEOUT * len(classes), cwd=jar.work_dir, stdout=DEVNULL, stderr=DEVNULL)
+        except TimeoutExpired:
+            if len(classes) == 1:
+                # Don't keep the partial output, that would be cached
+                print('(Jad timed out)')
+                outpath = outdir + '/' + classes[0].replace('.', '/') + '.java'
+                if exists(outpath):
+                    remove(outpath)
+                return {}
+            else:
+                half = len(classes) // 2
+                return {**self.decompile(jar, classes[:half], no_parse),
+                        **self.decompile(jar, classes[half:], no_parse)}
+        
+        sources = {}
+        for cls in classes:
+            outpath = outdir + '/' + cls.replace('.', '/') + '.java'
+            
+            if exists(outpath):
+                with open(outpath) as fd:
+                    sources[cls] = fd.read()
+        
+        return sources
+    
+    def close(self):
+        pass
+
+"""
+    Pass batches of classes to a long-lived decompiler process (i.e a
+    JVM-based decompiler wrapped so as to produce Jad-compatible
+    output), rather than spawning a process for every batch.
+    
+    The process is started from the given shell command, and talks
+    over its standard input and output. For every batch, it is sent a
+    "<number of classes> <flags...>" line, then for every class a
+    "<class name> <size>" line followed by the class file. It answers
+    with, for every class, a "<class name> <size>" line followed by
+    the UTF-8 source (of size 0 when it couldn't be decompiled).
+    
+    Classes that the server couldn't decompile are passed to Jad. If
+    the server can't be started, dies, or doesn't answer in time, Jad
+    is used for the rest of the run.
+    
+    See utils/jad_server.py for a stub implementation of the protocol.
+"""
+
+class ServerDecompiler:
+    def __init__(self, command, fallback=None):
+        self.command = command
+        self.fallback = fallback or JadDecompiler()
+        
+        self.process = None
+        self.pid = None # Process that started the server, as forked processes need their own
+        self.failed = False
+        self.lock = Lock()
+    
+    def flags(self, no_parse):
+        return self.fallback.flags(no_parse)
+    
+    def identity(self):
+        return 'server ' + self.command
+    
+    def decompile(self, jar, classes, no_parse):
+        sources = {}
+        
+        if not self.failed:
+            batch = [(cls, jar.read(cls)) for cls in classes]
+            
+            with self.lock:
+                try:
+                    sources = self.request(batch, self.flags(no_parse))
+                except (OSError, ValueError) as exc:
+                    print('(Decompiler server failed: %s, falling back to Jad)' % exc)
+                    self.failed = True
+                    self.close()
+        
+        missing = [cls for cls in classes if not sources.get(cls)]
+        if missing:
+            sources.update(self.fallback.decompile(jar, missing, no_parse))
+        
+        return sources
+    
+    def request(self, batch, flags):
+        if self.pid != getpid():
+            self.process = Popen(self.command, shell=True, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+            self.pid = getpid()
+        
+        # Don't wait forever for a hung server
+        timed_out = []
+        
+        def kill():
+            timed_out.append(True)
+            self.process.kill()
+        
+        def exited():
+            return ValueError('no answer in time' if timed_out else 'server exited (status %s)' % self.process.wait())
+        
+        watchdog = Timer(JAD_TIMEOUT * len(batch), kill)
+        watchdog.start()
+        
+        try:
+            stdin, stdout = self.process.stdin, self.process.stdout
+            
+            try:
+                stdin.write(('%d %s\n' % (len(batch), ' '.join(flags))).encode('utf8'))
+                for cls, binr in batch:
+                    stdin.write(('%s %d\n' % (cls, len(binr))).encode('utf8'))
+                    stdin.write(binr)
+                stdin.flush()
+            except BrokenPipeError:
+                raise exited()
+            
+            sources = {}
+            for i in range(len(batch)):
+                line = stdout.readline()
+                if not line or not line.endswith(b'\n'):
+                    raise exited()
+                
+                cls, size = line.decode('utf8').rsplit(' ', 1)
+                source = stdout.read(int(size))
+                if len(source) != int(size):
+                    raise ValueError('no answer in time' if timed_out else 'truncated answer')
+                sources[cls] = source.decode('utf8', 'replace')
+        
+        finally:
+            watchdog.cancel()
+        
+        return sources
+    
+    def close(self):
+        if self.process and self.pid == getpid():
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+        self.pid = None
+        
+        self.fallback.close()
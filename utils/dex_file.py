@@ -0,0 +1,421 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from struct import unpack_from, error
+from array import array
+from sys import byteorder
+from hashlib import sha1
+from re import findall
+
+from utils.class_file import ClassInfo, decode_utf8
+
+"""
+    A minimal reader for Dalvik executables [1], indexing the string,
+    type, prototype, field and method tables, as well as class
+    definitions.
+    
+    For every class, the bytecode of its methods is swept in order to
+    gather the strings, types, fields and methods it refers to, so that
+    the same information as from a JVM class file's constant pool is
+    available without converting the DEX to a JAR first.
+    
+    [1] https://source.android.com/devices/tech/dalvik/dex-format
+"""
+
+NO_INDEX = 0xffffffff
+
+# Length of every instruction in 16-bit code units, by opcode
+OPCODE_SIZES = [1, 1, 2, 3, 1, 2, 3, 1, 2, 3, 1, 1, 1, 1, 1, 1, # 0x00
+                1, 1, 1, 2, 3, 2, 2, 3, 5, 2, 2, 3, 2, 1, 1, 2, # 0x10
+                2, 1, 2, 2, 3, 3, 3, 1, 1, 2, 3, 3, 3, 2, 2, 2, # 0x20
+                2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 1, 1, # 0x30
+                1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, # 0x40
+                2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, # 0x50
+                2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 3, 3, # 0x60
+                3, 3, 3, 1, 3, 3, 3, 3, 3, 1, 1, 1, 1, 1, 1, 1, # 0x70
+                1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, # 0x80
+                2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, # 0x90
+                2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, # 0xa0
+                1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, # 0xb0
+                1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, # 0xc0
+                2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, # 0xd0
+                2, 2, 2, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, # 0xe0
+                1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 4, 4, 3, 3, 2, 2] # 0xf0
+
+# Kind of the index referred to by every instruction, by opcode
+REF_STRING, REF_STRING_JUMBO, REF_TYPE, REF_FIELD, REF_METHOD = range(1, 6)
+
+OPCODE_REFS = [0] * 256
+OPCODE_REFS[0x1a] = REF_STRING # const-string
+OPCODE_REFS[0x1b] = REF_STRING_JUMBO # const-string/jumbo
+for opcode in (0x1c, 0x1f, 0x20, 0x22, 0x23, 0x24, 0x25): # const-class, check-cast, instance-of, new-*, filled-new-array*
+    OPCODE_REFS[opcode] = REF_TYPE
+for opcode in range(0x52, 0x6e): # iget*, iput*, sget*, sput*
+    OPCODE_REFS[opcode] = REF_FIELD
+for opcode in [*range(0x6e, 0x73), *range(0x74, 0x79), 0xfa, 0xfb]: # invoke-*
+    OPCODE_REFS[opcode] = REF_METHOD
+
+# Types of encoded values (from static field initializers) that don't
+# have their contents stored after them, and that refer to an index
+VALUE_STRING, VALUE_ARRAY, VALUE_ANNOTATION, VALUE_NULL, VALUE_BOOLEAN = 0x17, 0x1c, 0x1d, 0x1e, 0x1f
+VALUE_REFS = {VALUE_STRING: REF_STRING, 0x18: REF_TYPE, 0x19: REF_FIELD, 0x1a: REF_METHOD, 0x1b: REF_FIELD}
+
+class DexFile:
+    def __init__(self, binr):
+        self.binr = binr
+        
+        if binr[:4] != b'dex\n':
+            raise ValueError('Not a DEX file')
+        
+        (string_ids_size, string_ids_off, type_ids_size, type_ids_off,
+         proto_ids_size, proto_ids_off, field_ids_size, field_ids_off,
+         method_ids_size, method_ids_off, class_defs_size, class_defs_off) = unpack_from('<12I', binr, 0x38)
+        
+        self.string_offs = unpack_from('<%dI' % string_ids_size, binr, string_ids_off)
+        self.string_cache = {}
+        
+        self.type_ids = unpack_from('<%dI' % type_ids_size, binr, type_ids_off)
+        self.proto_ids = [unpack_from('<3I', binr, proto_ids_off + 12 * i) for i in range(proto_ids_size)]
+        self.field_ids = [unpack_from('<HHI', binr, field_ids_off + 8 * i) for i in range(field_ids_size)]
+        self.method_ids = [unpack_from('<HHI', binr, method_ids_off + 8 * i) for i in range(method_ids_size)]
+        self.class_defs = [unpack_from('<8I', binr, class_defs_off + 32 * i) for i in range(class_defs_size)]
+        
+        # Instructions are read as 16-bit code units
+        self.code = array('H', binr[:len(binr) & ~1])
+        if byteorder == 'big':
+            self.code.byteswap()
+    
+    def string(self, index):
+        if index not in self.string_cache:
+            pos = self.string_offs[index]
+            size, pos = read_uleb128(self.binr, pos)
+            self.string_cache[index] = decode_utf8(self.binr[pos:self.binr.index(b'\0', pos)])
+        return self.string_cache[index]
+    
+    # Return the name of a type, in the internal form used by ClassInfo
+    
+    def type(self, index):
+        desc = self.string(self.type_ids[index])
+        if desc.startswith('L'):
+            return desc[1:-1]
+        return desc
+    
+    def type_desc(self, index):
+        return self.string(self.type_ids[index])
+    
+    def type_list(self, offset):
+        if not offset:
+            return []
+        size, = unpack_from('<I', self.binr, offset)
+        return list(unpack_from('<%dH' % size, self.binr, offset + 4))
+    
+    def proto_desc(self, index):
+        shorty, return_type, params = self.proto_ids[index]
+        return '(%s)%s' % (''.join(self.type_desc(i) for i in self.type_list(params)), self.type_desc(return_type))
+    
+    """
+    Names of the classes defined in the file, as they would be named
+    by dex2jar (i.e "com.google.protobuf.CodedInputStream").
+    """
+    
+    def class_names(self):
+        return [self.type(class_def[0]).replace('/', '.') for class_def in self.class_defs]
+    
+    def class_info(self, index):
+        info = ClassInfo()
+        try:
+            self.read_class(info, self.class_defs[index])
+        except (error, IndexError, ValueError):
+            pass
+        return info
+    
+    def read_class(self, info, class_def):
+        class_idx, access, superclass_idx, interfaces_off, source_file, annotations_off, class_data_off, static_values_off = class_def
+        
+        info.name = self.type(class_idx)
+        if superclass_idx != NO_INDEX:
+            info.superclass = self.type(superclass_idx)
+        info.interfaces = [self.type(i) for i in self.type_list(interfaces_off)]
+        
+        classes = {class_idx, *self.type_list(interfaces_off)}
+        if superclass_idx != NO_INDEX:
+            classes.add(superclass_idx)
+        
+        strings = []
+        fields = set()
+        methods = set()
+        field_types = set()
+        
+        # Read declared fields and methods
+        
+        for field_idx, field_access in self.class_fields(class_data_off):
+            field_types.add(self.field_ids[field_idx][1])
+        
+        for method_idx, method_access, code_off in self.class_methods(class_data_off):
+            owner, proto, name = self.method_ids[method_idx]
+            info.methods.append((method_access, self.string(name), self.proto_desc(proto)))
+            
+            if code_off:
+                self.read_code(code_off, strings, classes, fields, methods)
+        
+        # Resolve what the code referred to
+        
+        for field_idx in fields:
+            owner, field_type, name = self.field_ids[field_idx]
+            classes.add(owner)
+            field_types.add(field_type)
+        
+        for method_idx in methods:
+            owner, proto, name = self.method_ids[method_idx]
+            classes.add(owner)
+            info.method_refs.add((self.type(owner), self.string(name), self.proto_desc(proto)))
+        
+        # String constants assigned to static fields, that are part of
+        # the constant pool in a class file
+        
+        static_strings = []
+        if static_values_off:
+            for value in self.read_encoded_array(static_values_off)[0]:
+                if isinstance(value, tuple) and value[0] == VALUE_STRING:
+                    static_strings.append(value[1])
+        
+        info.classes = {self.type(i) for i in classes}
+        info.strings = '\0'.join(dict.fromkeys([*(self.string(i) for i in strings), *static_strings]))
+        
+        info.method_names = {name for cls, name, desc in info.method_refs} | \
+                            {name for access, name, desc in info.methods}
+        info.descriptors = {desc for cls, name, desc in info.method_refs} | \
+                           {desc for access, name, desc in info.methods}
+        
+        info.types = set(info.classes)
+        for desc in info.descriptors | {self.type_desc(i) for i in field_types}:
+            info.types.update(findall(r'L([^;]+);', desc))
+    
+    """
+    Iterate over the fields and methods declared in a class_data_item,
+    with their absolute indexes.
+    """
+    
+    def class_fields(self, class_data_off):
+        if not class_data_off:
+            return
+        
+        binr = self.binr
+        (static_fields, instance_fields, direct_methods, virtual_methods), pos = self.class_data_sizes(class_data_off)
+        
+        for nb_fields in (static_fields, instance_fields):
+            field_idx = 0
+            for i in range(nb_fields):
+                diff, pos = read_uleb128(binr, pos)
+                field_access, pos = read_uleb128(binr, pos)
+                field_idx += diff
+                yield field_idx, field_access
+    
+    def class_methods(self, class_data_off):
+        if not class_data_off:
+            return
+        
+        binr = self.binr
+        (static_fields, instance_fields, direct_methods, virtual_methods), pos = self.class_data_sizes(class_data_off)
+        
+        # Skip over fields
+        for i in range(2 * (static_fields + instance_fields)):
+            value, pos = read_uleb128(binr, pos)
+        
+        for nb_methods in (direct_methods, virtual_methods):
+            method_idx = 0
+            for i in range(nb_methods):
+                diff, pos = read_uleb128(binr, pos)
+                method_access, pos = read_uleb128(binr, pos)
+                code_off, pos = read_uleb128(binr, pos)
+                method_idx += diff
+                yield method_idx, method_access, code_off
+    
+    def class_data_sizes(self, class_data_off):
+        pos = class_data_off
+        sizes = []
+        for i in range(4):
+            size, pos = read_uleb128(self.binr, pos)
+            sizes.append(size)
+        return sizes, pos
+    
+    """
+    Walk the instructions of a code_item, collecting the indexes of
+    the strings, types, fields and methods they refer to.
+    """
+    
+    def read_code(self, code_off, strings, types, fields, methods):
+        code = self.code
+        insns_size, = unpack_from('<I', self.binr, code_off + 12)
+        
+        pc = (code_off + 16) // 2
+        end = pc + insns_size
+        
+        while pc < end:
+            unit = code[pc]
+            opcode = unit & 0xff
+            ref = OPCODE_REFS[opcode]
+            
+            if ref == REF_STRING:
+                strings.append(code[pc + 1])
+            elif ref == REF_METHOD:
+                methods.add(code[pc + 1])
+            elif ref == REF_FIELD:
+                fields.add(code[pc + 1])
+            elif ref == REF_TYPE:
+                types.add(code[pc + 1])
+            elif ref == REF_STRING_JUMBO:
+                strings.append(code[pc + 1] | code[pc + 2] << 16)
+            
+            # Skip over switch tables and array data
+            elif unit == 0x0100: # packed-switch-payload
+                pc += 4 + code[pc + 1] * 2
+                continue
+            elif unit == 0x0200: # sparse-switch-payload
+                pc += 2 + code[pc + 1] * 4
+                continue
+            elif unit == 0x0300: # fill-array-data-payload
+                pc += 4 + (code[pc + 1] * (code[pc + 2] | code[pc + 3] << 16) + 1) // 2
+                continue
+            
+            pc += OPCODE_SIZES[opcode]
+
+    """
+    Return a hash of the definition of a class that stays the same
+    across builds as long as the class didn't change, even though it
+    was moved around in the file, and the strings, types, fields and
+    methods it refers to were renumbered: indexes are replaced with
+    what they point to before hashing.
+    
+    Debug information, annotations and exception handler types are
+    left out. None is returned for a class that can't be read.
+    """
+    
+    def class_digest(self, index):
+        digest = sha1()
+        
+        try:
+            class_idx, access, superclass_idx, interfaces_off, source_file, annotations_off, class_data_off, static_values_off = self.class_defs[index]
+            
+            digest.update(repr((self.type_desc(class_idx), access,
+                                superclass_idx != NO_INDEX and self.type_desc(superclass_idx),
+                                [self.type_desc(i) for i in self.type_list(interfaces_off)])).encode())
+            
+            for field_idx, field_access in self.class_fields(class_data_off):
+                digest.update(repr((self.ref_name(REF_FIELD, field_idx), field_access)).encode())
+            
+            for method_idx, method_access, code_off in self.class_methods(class_data_off):
+                digest.update(repr((self.ref_name(REF_METHOD, method_idx), method_access)).encode())
+                
+                if code_off:
+                    self.digest_code(code_off, digest)
+            
+            if static_values_off:
+                digest.update(repr(self.read_encoded_array(static_values_off)[0]).encode())
+        
+        except (error, IndexError, ValueError):
+            return None
+        
+        return digest.hexdigest()
+    
+    def digest_code(self, code_off, digest):
+        code = self.code
+        registers_size, ins_size, outs_size, tries_size, debug_info_off, insns_size = unpack_from('<4HII', self.binr, code_off)
+        digest.update(repr((registers_size, ins_size, outs_size, tries_size)).encode())
+        
+        pc = (code_off + 16) // 2
+        end = pc + insns_size
+        
+        while pc < end:
+            unit = code[pc]
+            opcode = unit & 0xff
+            ref = OPCODE_REFS[opcode]
+            
+            if unit == 0x0100: # packed-switch-payload
+                size = 4 + code[pc + 1] * 2
+            elif unit == 0x0200: # sparse-switch-payload
+                size = 2 + code[pc + 1] * 4
+            elif unit == 0x0300: # fill-array-data-payload
+                size = 4 + (code[pc + 1] * (code[pc + 2] | code[pc + 3] << 16) + 1) // 2
+            else:
+                size = OPCODE_SIZES[opcode]
+            
+            units = code[pc:pc + size]
+            
+            if ref == REF_STRING_JUMBO:
+                digest.update(repr(self.ref_name(ref, units[1] | units[2] << 16)).encode())
+                units[1] = units[2] = 0
+            elif ref:
+                digest.update(repr(self.ref_name(ref, units[1])).encode())
+                units[1] = 0
+            
+            digest.update(units.tobytes())
+            pc += size
+        
+        # Try blocks follow the instructions, 4-byte aligned
+        if tries_size:
+            tries_off = (code_off + 16 + insns_size * 2 + 3) & ~3
+            digest.update(self.binr[tries_off:tries_off + tries_size * 8])
+    
+    def ref_name(self, ref, index):
+        if ref in (REF_STRING, REF_STRING_JUMBO):
+            return self.string(index)
+        elif ref == REF_TYPE:
+            return self.type_desc(index)
+        elif ref == REF_FIELD:
+            owner, field_type, name = self.field_ids[index]
+            return '%s->%s:%s' % (self.type_desc(owner), self.string(name), self.type_desc(field_type))
+        elif ref == REF_METHOD:
+            owner, proto, name = self.method_ids[index]
+            return '%s->%s%s' % (self.type_desc(owner), self.string(name), self.proto_desc(proto))
+    
+    """
+    Read an encoded_array or encoded_value, such as the initial values
+    of static fields, with indexes resolved.
+    """
+    
+    def read_encoded_array(self, pos):
+        size, pos = read_uleb128(self.binr, pos)
+        
+        values = []
+        for i in range(size):
+            value, pos = self.read_encoded_value(pos)
+            values.append(value)
+        return values, pos
+    
+    def read_encoded_value(self, pos):
+        value_type, value_arg = self.binr[pos] & 0x1f, self.binr[pos] >> 5
+        pos += 1
+        
+        if value_type == VALUE_ARRAY:
+            return self.read_encoded_array(pos)
+        
+        elif value_type == VALUE_ANNOTATION:
+            type_idx, pos = read_uleb128(self.binr, pos)
+            size, pos = read_uleb128(self.binr, pos)
+            
+            elements = [self.type_desc(type_idx)]
+            for i in range(size):
+                name_idx, pos = read_uleb128(self.binr, pos)
+                value, pos = self.read_encoded_value(pos)
+                elements.append((self.string(name_idx), value))
+            return elements, pos
+        
+        elif value_type in (VALUE_NULL, VALUE_BOOLEAN):
+            return (value_type, value_arg), pos
+        
+        raw = self.binr[pos:pos + value_arg + 1]
+        pos += value_arg + 1
+        
+        if value_type in VALUE_REFS:
+            return (value_type, self.ref_name(VALUE_REFS[value_type], int.from_bytes(raw, 'little'))), pos
+        return (value_type, raw), pos
+
+def read_uleb128(binr, pos):
+    value = shift = 0
+    while True:
+        byte = binr[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
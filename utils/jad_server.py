@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from subprocess import run, DEVNULL, TimeoutExpired
+from tempfile import TemporaryDirectory
+from os.path import exists, dirname, realpath
+from os import makedirs
+from sys import stdin, stdout
+
+__import__('sys').path.append(dirname(realpath(__file__)) + '/..')
+from utils.common import jad
+from utils.decompilers import JAD_TIMEOUT
+
+"""
+    A stub decompiler server, speaking the protocol described in
+    utils/decompilers.py, and used for testing it. It is not a
+    persistent decompiler: a new Jad process is still spawned for
+    every batch it receives, so that it is no faster (and somewhat
+    slower) than the built-in Jad backend.
+    
+    It is meant as a starting point for wrapping a decompiler that
+    does keep its state between batches (i.e running in a JVM):
+    
+        ./extractors/jar_extract.py --decompiler "python3 utils/jad_server.py" app.apk
+"""
+
+def serve(reader, writer):
+    while True:
+        line = reader.readline()
+        if not line:
+            break
+        
+        size, *flags = line.decode('utf8').split()
+        batch = []
+        for i in range(int(size)):
+            cls, size = reader.readline().decode('utf8').rsplit(' ', 1)
+            batch.append((cls, reader.read(int(size))))
+        
+        for cls, source in decompile(batch, flags):
+            writer.write(('%s %d\n' % (cls, len(source))).encode('utf8'))
+            writer.write(source)
+        writer.flush()
+
+def decompile(batch, flags):
+    with TemporaryDirectory() as work_dir:
+        paths = []
+        for cls, binr in batch:
+            path = work_dir + '/' + cls.replace('.', '/') + '.class'
+            makedirs(dirname(path), exist_ok=True)
+            with open(path, 'wb') as fd:
+                fd.write(binr)
+            paths.append(path)
+        
+        flags = list(flags)
+        flags.insert(flags.index('-d') + 1, work_dir + '/out')
+        
+        # Output is partial when Jad hangs: answer nothing, so that the
+        # client retries these classes through its own Jad fallback
+        try:
+            run([jad] + flags + paths, timeout=JAD_TIMEOUT * len(batch),
+                cwd=work_dir, stdout=DEVNULL, stderr=DEVNULL)
+            timed_out = False
+        except TimeoutExpired:
+            timed_out = True
+        
+        for cls, binr in batch:
+            outpath = work_dir + '/out/' + cls.replace('.', '/') + '.java'
+            
+            source = b''
+            if exists(outpath) and not timed_out:
+                with open(outpath, 'rb') as fd:
+                    source = fd.read()
+            yield cls, source
+
+if __name__ == '__main__':
+    serve(stdin.buffer, stdout.buffer)
@@ -1,112 +1,482 @@
 #!/usr/bin/python3
 #-*- encoding: Utf-8 -*-
-from re import findall, MULTILINE, search, finditer, split, sub
-from subprocess import run, DEVNULL, PIPE, TimeoutExpired
+from re import findall, MULTILINE, search, finditer, split, sub, compile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from subprocess import run, DEVNULL
 from tempfile import TemporaryDirectory
+from bisect import bisect_left, bisect_right
 from collections import OrderedDict
-from zipfile import ZipFile
-from os.path import exists
+from itertools import accumulate
+from zipfile import ZipFile, is_zipfile
+from io import BytesIO
+from os.path import exists, dirname
+from os import cpu_count, makedirs, getpid
+from multiprocessing import get_context, get_all_start_methods
+from threading import Lock
+from hashlib import sha1
+from struct import error
+from pathlib import Path
 
-from extractors.from_binary import walk_binary
-from utils.common import dex2jar, jad
+from extractors.from_binary import read_descriptors, descriptor_to_proto
+from utils.decomp_cache import DecompCache
+from utils.class_file import ClassInfo
+from utils.dex_file import DexFile
+from utils.decompilers import JadDecompiler, ServerDecompiler, JAD_BATCH_SIZE
+from utils.common import dex2jar
+
+MAX_MEMORY = 1024 << 20 # Default memory budget for parsed classes, in bytes
+WRAPPER_SIZE_FACTOR = 3 # Approximate memory used by a parsed class, relative to the length of its source
+
+# Patterns used for parsing Jad output
+ANNOTE = compile('\n {4,}//(?:[* ] {0,3}[0-9]{1,5}){2}:.+(?:\n {4,}//.+)*')
+ANNOTE_METHOD = compile('<Method ([\w.$\[\]]+) ([\w.$]+)\.([\w$]+)\((.*)\)>')
+FUNCLINE = compile('([\w.$]+) ([\w$]+)\((.*)\)')
+STRING = compile(r'"(?:.*?[^"\\])?"')
+LOC_CALL = compile('(?<!new )(?<![\w.$])(\w+)\((?=([^;]+))')
+GLOB_CALL = compile('\.(\w+)\((?=([^;]+))')
+ASSIGNMENT = compile('(?=\s+(?:super\.)?([\w$]+)(?:\[\])* = (.+?);)')
+DECLARATION = compile('(?=([\w.$]+) ([\w$]+)(?:\[\])*(?: =|;))')
 
 """
-    This is a catch-all class that will handle either a JAR, DEX or APK file.
+    This is a catch-all class that will handle either a JAR, DEX or APK file
+    (or a bundle of APKs, such as .aab, .apks or .xapk files).
 """
 class JarWrapper(TemporaryDirectory):
-    def __init__(self, fname):
+    def __init__(self, fname, jobs=None, cache=True, max_memory=MAX_MEMORY, decompiler=None):
         super().__init__()
         
+        self.work_dir = self.name # Where class files are extracted and decompiled
+        self.jobs = jobs or cpu_count() # Number of concurrent decompiler processes
+        
+        # Jad, or a persistent decompiler process started from the given command
+        self.decompiler = ServerDecompiler(decompiler) if decompiler else JadDecompiler()
+        
+        # Cache for Jad output, persistent or only spilling to the temporary directory
+        self.cache = DecompCache() if cache else DecompCache(Path(self.name) / 'spill', float('inf'))
+        
         self.classes = []
-        self.decompiled = {}
+        self.class_files = {} # For a given class, the archive and member it can be read from
+        self.class_dexes = {} # For a given class from a DEX file, the file, its DexFile and the class' index
+        self.dex_files = OrderedDict() # DexFile for a given DEX file, named after its path within archives
+        self.converted = set() # DEX files already converted to a JAR
+        self.archives = []
+        self.lock = Lock()
+        
+        self.decompiled = {} # Parsed classes
+        self.sources = {} # Jad output, for a given (class, no_parse) couple
+        self.unfolded = {} # Code returned by decomp_func(), for a given method, along with the classes it was read from
+        self.memory = OrderedDict() # Estimated memory used by entries of the above, for a given (table, key) couple, least recently used first
+        self.memory_used = 0
+        self.max_memory = max_memory
+        self.accessed = set() # Classes decompiled since this was last reset
         
         self.bonus_protos = OrderedDict()
         
         self.handle_file(fname)
-
+    
+    """
+    Index the contents of an archive, without extracting it: classes
+    are read from the archive when needed, and only written to disk
+    when Jad has to decompile them.
+    
+    Archives nested into others (split APKs inside of an .apks/.xapk
+    bundle, or JARs inside of an APK) are opened from memory and
+    indexed the same way, so that nothing is written to disk at this
+    step.
+    
+    DEX files are indexed natively, and only converted to a JAR when
+    one of their classes has to be decompiled.
+    """
+    
     def handle_file(self, fname):
         with open(fname, 'rb') as fd:
             if fd.read(4) == b'dex\n':
-                new_jar = self.name + '/classes-dex2jar.jar'
-                run([dex2jar, fname, '-f', '-o', new_jar], cwd=self.name, stderr=DEVNULL)
-                fname = new_jar
+                fd.seek(0)
+                self.handle_dex(fname, fd.read())
+                return
+        
+        libraries = []
+        self.handle_archive(fname, ZipFile(fname), libraries)
+        self.scan_libraries(libraries)
     
-        with ZipFile(fname) as jar:
-            jar.extractall(self.name)
+    def handle_archive(self, name, jar, libraries):
+        self.archives.append(jar)
+        
+        for member in jar.namelist():
+            if member.endswith('.class'):
+                cls = member.replace('/', '.')[:-6]
+                self.classes.append(cls)
+                self.class_files[cls] = (jar, member)
             
-            for cls in jar.namelist():
-                if cls.endswith('.class'):
-                    cls = cls.replace('/', '.')[:-6]
-                    self.classes.append(cls)
-                
-                elif cls.endswith('.dex'):
-                    self.handle_file(self.name + '/' + cls)
-                
-                elif cls.endswith('.proto'):
-                    self.bonus_protos[cls] = jar.read(cls).decode('utf8')
-                
-                elif cls.endswith('.so'):
-                    self.bonus_protos.update(walk_binary(self.name + '/' + cls))
+            elif member.endswith('.dex'):
+                self.handle_dex(name + '/' + member, jar.read(member))
             
+            elif member.endswith(('.apk', '.jar')):
+                nested = BytesIO(jar.read(member))
+                if is_zipfile(nested): # Skip e.g encrypted or placeholder files
+                    self.handle_archive(name + '/' + member, ZipFile(nested), libraries)
+            
+            elif member.endswith('.proto'):
+                self.bonus_protos[member] = jar.read(member).decode('utf8')
+            
+            elif member.endswith('.so'):
+                libraries.append((jar, member))
+    
+    def handle_dex(self, name, binr):
+        try:
+            dex = DexFile(binr)
+            class_names = dex.class_names()
+        except (ValueError, error, IndexError): # Skip e.g encrypted payloads or stubs
+            return
+        self.dex_files[name] = dex
+        
+        for index, cls in enumerate(class_names):
+            self.classes.append(cls)
+            self.class_dexes[cls] = (name, dex, index)
+    
+    """
+    Look for embedded descriptors in native libraries. The same library
+    is usually shipped for several architectures: identical files are
+    scanned only once, the others are scanned concurrently, and
+    descriptors found in several of them are only converted once.
+    
+    Libraries are handed to forked workers through their initializer,
+    that they inherit from the parent, and each task only refers to
+    one of them by its index, rather than having it pickled.
+    """
+    
+    def scan_libraries(self, members):
+        binaries = OrderedDict()
+        
+        for jar, member in members:
+            binr = jar.read(member)
+            binaries.setdefault(sha1(binr).hexdigest(), binr)
+        
+        binaries = list(binaries.values())
+        
+        if self.jobs > 1 and len(binaries) > 1 and 'fork' in get_all_start_methods():
+            with ProcessPoolExecutor(min(self.jobs, len(binaries)), mp_context=get_context('fork'),
+                                     initializer=_init_scan_worker, initargs=(binaries,)) as pool:
+                results = list(pool.map(_scan_library_worker, range(len(binaries))))
+        else:
+            results = [read_descriptors(binr) for binr in binaries]
+        
+        converted = set()
+        for descriptors in results:
+            for serialized in descriptors:
+                if serialized not in converted:
+                    converted.add(serialized)
+                    
+                    name, contents = descriptor_to_proto(serialized)
+                    self.bonus_protos[name] = contents
+    
     def __enter__(self):
         super().__enter__()
         return self
     
+    def cleanup(self):
+        self.decompiler.close()
+        for jar in self.archives:
+            jar.close()
+        super().cleanup()
+    
+    """
+    Called from a process forked off the one that created the
+    JarWrapper, so that it has its own handles to the archives (rather
+    than sharing file offsets with its parent) and its own directory
+    to run Jad into.
+    """
+    
+    def reopen(self):
+        self.lock = Lock()
+        self.work_dir = self.name + '/worker-%d' % getpid()
+        
+        # Archives nested into others are read from memory, that isn't shared
+        archives = {jar: ZipFile(jar.filename) if jar.filename else jar for jar in self.archives}
+        self.archives = list(archives.values())
+        
+        for cls, (jar, member) in self.class_files.items():
+            self.class_files[cls] = (archives[jar], member)
+    
     def read(self, cls):
-        cls = cls.replace('.', '/') + '.class'
-        with open(self.name + '/' + cls, 'rb') as fd:
-            return fd.read()
+        with self.lock:
+            self.convert_dexes([cls])
+            
+            jar, member = self.class_files[cls]
+            return jar.read(member)
+    
+    # Return whether the bytecode for a class is available, converting its DEX file if needed
+    
+    def load_class(self, cls):
+        with self.lock:
+            self.convert_dexes([cls])
+            
+            return cls in self.class_files
+    
+    """
+    Convert the DEX files holding a set of classes, if not already
+    done. As applications ship their classes over several DEX files,
+    and the classes to be decompiled are usually spread over a few of
+    them, these are converted at once by concurrent dex2jar processes.
+    """
+    
+    def convert_dexes(self, classes):
+        fnames = {self.class_dexes[cls][0] for cls in classes if cls in self.class_dexes}
+        fnames = [fname for fname in self.dex_files if fname in fnames and fname not in self.converted]
+        if not fnames:
+            return
+        
+        with ThreadPoolExecutor(self.jobs) as pool:
+            new_jars = list(pool.map(self.convert_dex, fnames))
+        
+        for fname, new_jar in zip(fnames, new_jars):
+            self.converted.add(fname)
+            
+            if exists(new_jar):
+                jar = ZipFile(new_jar)
+                self.archives.append(jar)
+                
+                for member in jar.namelist():
+                    if member.endswith('.class'):
+                        self.class_files[member.replace('/', '.')[:-6]] = (jar, member)
+    
+    def convert_dex(self, fname):
+        index = list(self.dex_files).index(fname)
+        dex_path = self.work_dir + '/classes-%d.dex' % index
+        new_jar = self.work_dir + '/dex2jar-%d.jar' % index
+        
+        makedirs(self.work_dir, exist_ok=True)
+        with open(dex_path, 'wb') as fd:
+            fd.write(self.dex_files[fname].binr)
+        
+        run([dex2jar, dex_path, '-f', '-o', new_jar], cwd=self.work_dir, stderr=DEVNULL)
+        return new_jar
+    
+    """
+    Return the strings, methods and classes a class refers to, either
+    from its class file or straight from the DEX file it's part of.
+    """
+    
+    def info(self, cls):
+        with self.lock:
+            if cls in self.class_dexes:
+                fname, dex, index = self.class_dexes[cls]
+                return dex.class_info(index)
+        
+        return ClassInfo(self.read(cls))
+    
+    """
+    Return a hash of the contents of a class, that can be compared
+    with the one from another build of the application, or None if
+    the class doesn't exist.
+    """
+    
+    def digest(self, cls):
+        if cls in self.class_dexes:
+            fname, dex, index = self.class_dexes[cls]
+            return dex.class_digest(index)
+        
+        elif cls in self.class_files:
+            return sha1(self.read(cls)).hexdigest()
+    
+    # Write a class file to the temporary directory, for Jad to process it
+    
+    def extract_class(self, cls):
+        path = self.work_dir + '/' + cls.replace('.', '/') + '.class'
+        if not exists(path):
+            makedirs(dirname(path), exist_ok=True)
+            with open(path, 'wb') as fd:
+                fd.write(self.read(cls))
+        return path
     
     def decomp(self, cls, no_parse=False):
         if cls not in self.decompiled:
-            # Handle generated class files containing a "$"
-            if cls not in self.classes:
-                _cls = cls
-                pkg, cls = cls.rsplit('.', 1)
-                cls = next((i for i in self.classes if i.startswith(pkg) and i.endswith('$' + cls)), _cls)
+            cls = self.resolve(cls)
+            self.accessed.add(cls)
             
             if no_parse:
                 return ClassWrapper(cls, self, True)
+            
             self.decompiled[cls] = ClassWrapper(cls, self)
+            self.remember('decompiled', cls, len(self.decompiled[cls].raw) * WRAPPER_SIZE_FACTOR)
         
+        else:
+            self.remember('decompiled', cls)
+        
+        self.accessed.add(cls)
         return self.decompiled[cls]
     
-    # Will return only a specific method from class, with its local method calls inlined
+    """
+    Parsed classes, decompiled sources and unfolded methods are kept
+    within a shared memory budget: when it's exceeded, the least
+    recently used entries are dropped. Sources are read again from the
+    cache, and classes parsed again, if requested later.
+    
+    Register the estimated size of a new entry, or mark an existing
+    one as used when no size is given.
+    """
+    
+    def remember(self, table, key, size=None):
+        if size is not None:
+            self.memory_used += size - self.memory.get((table, key), 0)
+            self.memory[table, key] = size
+        elif (table, key) not in self.memory:
+            return
+        
+        self.memory.move_to_end((table, key))
+        
+        while self.memory_used > self.max_memory and len(self.memory) > 1:
+            (evicted_table, evicted_key), evicted_size = self.memory.popitem(last=False)
+            del getattr(self, evicted_table)[evicted_key]
+            self.memory_used -= evicted_size
+    
+    def forget(self, table, key):
+        self.memory_used -= self.memory.pop((table, key), 0)
+        return getattr(self, table).pop(key)
+    
+    # Handle generated class files containing a "$"
+    
+    def resolve(self, cls):
+        if cls not in self.classes:
+            _cls = cls
+            pkg, cls = cls.rsplit('.', 1)
+            cls = next((i for i in self.classes if i.startswith(pkg) and i.endswith('$' + cls)), _cls)
+        return cls
+    
+    """
+    Return the Jad output for a class, running Jad if it wasn't
+    already done through prefetch().
+    """
+    
+    def source(self, cls, no_parse=False):
+        if (cls, no_parse) not in self.sources:
+            self.add_source(cls, no_parse, self.run_decompiler([cls], no_parse)[cls])
+        
+        if no_parse:
+            self.remember('sources', (cls, no_parse))
+            return self.sources[cls, no_parse]
+        return self.forget('sources', (cls, no_parse))
+    
+    # Failed classes are not counted, so that they are never decompiled twice
+    
+    def add_source(self, cls, no_parse, source):
+        self.sources[cls, no_parse] = source
+        if source:
+            self.remember('sources', (cls, no_parse), len(source))
+    
+    """
+    Decompile a set of classes ahead of their use, using a pool of
+    concurrent Jad processes, each of them being passed a batch of
+    classes. Yield the count of classes processed as they complete.
+    """
+    
+    def prefetch(self, classes, no_parse=False):
+        classes = {self.resolve(cls) for cls in classes}
+        classes = sorted(cls for cls in classes if (cls, no_parse) not in self.sources and \
+                         (no_parse or cls not in self.decompiled))
+        
+        # Convert the DEX files of all classes at once, rather than one by one from batches
+        with self.lock:
+            self.convert_dexes(classes)
+        
+        batch_size = max(1, min(JAD_BATCH_SIZE, -(-len(classes) // self.jobs)))
+        batches = [classes[i:i + batch_size] for i in range(0, len(classes), batch_size)]
+        
+        with ThreadPoolExecutor(self.jobs) as pool:
+            tasks = [pool.submit(self.run_decompiler, batch, no_parse) for batch in batches]
+            
+            nb_done = 0
+            for task in as_completed(tasks):
+                for cls, source in task.result().items():
+                    self.add_source(cls, no_parse, source)
+                nb_done += len(task.result())
+                yield nb_done
+    
+    """
+    Run the decompiler over a batch of classes at once, and return
+    their sources.
+    """
+    
+    def run_decompiler(self, classes, no_parse=False):
+        flags = self.decompiler.flags(no_parse)
+        
+        # Classes that aren't part of the archive can't be decompiled
+        sources = {cls: '' for cls in classes if not self.load_class(cls)}
+        classes = [cls for cls in classes if cls not in sources]
+        
+        # Look for already decompiled classes in the cache
+        cache_keys = {}
+        for cls in classes:
+            cache_keys[cls] = self.cache.key(self.read(cls), flags)
+            source = self.cache.get(cache_keys[cls])
+            if source is not None:
+                sources[cls] = source
+        
+        classes = [cls for cls in classes if cls not in sources]
+        
+        if not classes:
+            return sources
+        
+        decompiled = self.decompiler.decompile(self, classes, no_parse)
+        
+        for cls in classes:
+            sources[cls] = ''
+            
+            if cls in decompiled:
+                sources[cls] = decompiled[cls]
+                self.cache.put(cache_keys[cls], sources[cls])
+        
+        return sources
+    
+    """
+    Will return only a specific method from class, with its local method
+    calls inlined.
+    
+    As the same methods (from superclasses, or helper classes) are
+    requested for every message, the result is kept within the memory
+    budget when unfolding starts from scratch (and the classes it came
+    from are marked as accessed again on reuse).
+    """
     
     def decomp_func(self, func, merged=None):
+        if merged is None:
+            if func not in self.unfolded:
+                accessed, self.accessed = self.accessed, set()
+                self.unfolded[func] = (self.decomp_func(func, set()), self.accessed)
+                self.accessed = accessed
+                self.remember('unfolded', func, len(self.unfolded[func][0]))
+            else:
+                self.remember('unfolded', func)
+            
+            code, classes = self.unfolded[func]
+            self.accessed |= classes
+            return code
+        
+        parts = []
+        self.unfold_func(func, merged, parts)
+        return ''.join(parts)
+    
+    def unfold_func(self, func, merged, parts):
         ret, obj, name, args = func
         if obj.startswith('java.'):
-            return ''
+            return
         decomp = self.decomp(obj)
         if decomp.raw:
-            decomp = decomp.get_method_unfold((ret, name, args), merged)
-        else:
-            decomp = ''
-        return decomp
+            decomp.unfold_method((ret, name, args), merged, parts)
+
+def _init_scan_worker(binaries):
+    global _worker_binaries
+    _worker_binaries = binaries
+
+def _scan_library_worker(index):
+    return read_descriptors(_worker_binaries[index])
 
 """
     A class to perform decompilation and basic parsing of Java classes.
 """
 class ClassWrapper:
     def __init__(self, cls, jar, no_parse=False):
-        inpath = jar.name + '/' + cls.replace('.', '/') + '.class'
-        outpath = jar.name + '/' + cls.replace('.', '/') + '.java'
-        
-        jad_args = [jad, '-af', '-b', '-d', jar.name, '-dead', '-f', '-i', '-ff', '-noinner', '-o', '-r', '-radix10', '-lradix10', '-s', '.java', inpath]
-        if no_parse:
-            jad_args.remove('-af')
-            jad_args.insert(1, '-nofd')
-        try:
-            run(jad_args, timeout=5, cwd=jar.name, stdout=DEVNULL, stderr=DEVNULL)
-        except TimeoutExpired:
-            print('(Jad timed out)')
-
-        if not exists(outpath):
-            self.raw = ''
-            return
-        
-        with open(outpath) as fd:
-            self.raw = fd.read()
+        self.raw = jar.source(cls, no_parse)
         
         if not self.raw.strip().endswith('\n}'): # Truncated source
             self.raw = ''
@@ -116,14 +486,14 @@ class ClassWrapper:
         if not self.raw or no_parse:
             return
         
-        # Parse Jad annotations
+        # Parse Jad annotations, and strip them in a single pass
         self.annotes = []
-        while True:
-            annote = search('\n {4,}//(?:[* ] {0,3}[0-9]{1,5}){2}:.+(?:\n {4,}//.+)*', self.raw, flags=MULTILINE)
-            if not annote:
-                break
-            self.annotes.extend(findall('<Method ([\w.$\[\]]+) ([\w.$]+)\.([\w$]+)\((.*)\)>', annote.group(0)))
-            self.raw = self.raw[:annote.start()] + self.raw[annote.end():]
+        
+        def strip_annote(annote):
+            self.annotes.extend(ANNOTE_METHOD.findall(annote.group(0)))
+            return ''
+        
+        self.raw = ANNOTE.sub(strip_annote, self.raw)
         
         # Parse package/extends directives
         
@@ -173,25 +543,26 @@ class ClassWrapper:
         pos = 0 # Keep track of position in file
         
         for line in self.raw.splitlines(True):
+            stripped = line.strip()
             indent = (len(line) - len(line.lstrip(' '))) / 4
 
-            if line.strip().startswith('throws') or line.strip().startswith('implements ') or line.strip().startswith('//'):
+            if stripped.startswith(('throws', 'implements ', '//')):
                 pos += len(line)
                 continue
             
             # We see a class declaration
-            if ' class ' in line or (' new ' in line and line.strip().endswith('{')):
+            if ' class ' in line or (' new ' in line and stripped.endswith('{')):
                 cls_indent = indent
             
             # We see a method declaration
-            if indent == cls_indent + 1 and line.strip().endswith(')'):
-                funcline = search('([\w.$]+) ([\w$]+)\((.*)\)', line)
+            if indent == cls_indent + 1 and stripped.endswith(')'):
+                funcline = FUNCLINE.search(line)
                 
                 if funcline and funcline.group(2) not in ('if', 'for', 'while', 'switch', 'catch', 'super', 'this', 'synchronized'):
                     ret, name, args = funcline.groups()
                     method_sig = (ret, name, ', '.join(i.split(' ')[0] for i in args.split(', ')))
 
-                    method_code = ''
+                    method_code = []
                     method_loc_calls = []
                     method_glob_calls = []
             
@@ -200,7 +571,7 @@ class ClassWrapper:
                 if indent >= cls_indent + 2 > last_indent:
                     method_start = pos
                 
-                if indent >= cls_indent + 2 and line.strip().endswith(')') and not cond_indent:
+                if indent >= cls_indent + 2 and stripped.endswith(')') and not cond_indent:
                     cond_start = pos
                     cond_indent = indent
                 elif line.startswith('label') and not cond_indent:
@@ -209,44 +580,46 @@ class ClassWrapper:
                 # We're in a method
                 if indent >= cls_indent + 2:
                     
-                    nostrings_line = sub(r'"(?:.*?[^"\\])?"', '""', line)
-                    
-                    # Store calls to local methods
-                    for match in finditer('(?<!new )(?<![\w.$])(\w+)\((?=([^;]+))', nostrings_line):
-                        if match.group(1) not in ('if', 'for', 'while', 'switch', 'catch', 'super', 'this', 'synchronized', 'getClass'):
+                    # Lines without parentheses can't contain calls
+                    if '(' in line:
+                        nostrings_line = STRING.sub('""', line)
+                        
+                        # Store calls to local methods
+                        for match in LOC_CALL.finditer(nostrings_line):
+                            if match.group(1) not in ('if', 'for', 'while', 'switch', 'catch', 'super', 'this', 'synchronized', 'getClass'):
+                                (name, args), (call_start, call_end) = match.groups(), match.span()
+                                
+                                call_info = self.prototype_from_annote(name, args)
+                                if call_info:
+                                    ret, obj, name, args = call_info
+                                    call_sig = ret, name, args
+                                
+                                    self.method_loc_calls[call_start + pos] = (call_sig, call_end + pos)
+                                    method_loc_calls.append(call_sig)
+                        
+                        # Store calls to external methods
+                        for match in reversed(list(GLOB_CALL.finditer(nostrings_line))):
                             (name, args), (call_start, call_end) = match.groups(), match.span()
                             
-                            call_info = self.prototype_from_annote(name, args)
-                            if call_info:
-                                ret, obj, name, args = call_info
-                                call_sig = ret, name, args
+                            call_sig = self.prototype_from_annote(name, args)
                             
-                                self.method_loc_calls[call_start + pos] = (call_sig, call_end + pos)
-                                method_loc_calls.append(call_sig)
+                            if call_sig:
+                                self.method_calls[call_start + pos] = (call_sig, call_end + pos)
+                                method_glob_calls.append(call_sig)
                     
-                    # Store calls to external methods
-                    for match in reversed(list(finditer('\.(\w+)\((?=([^;]+))', nostrings_line))):
-                        (name, args), (call_start, call_end) = match.groups(), match.span()
-                        
-                        call_sig = self.prototype_from_annote(name, args)
-                        
-                        if call_sig:
-                            self.method_calls[call_start + pos] = (call_sig, call_end + pos)
-                            method_glob_calls.append(call_sig)
-                    
-                    method_code += line
+                    method_code.append(line)
                     
                 # We're getting out of a block
 
-                if indent >= cls_indent + 2 and line.strip().startswith('}') and cond_start and (not cond_indent or indent <= cond_indent):
+                if indent >= cls_indent + 2 and stripped.startswith('}') and cond_start and (not cond_indent or indent <= cond_indent):
                     self.cond_bounds.append((cond_start, pos + len(line) - 1))
                     cond_start = None
                     cond_indent = None
                 
-                if indent < cls_indent + 2 and line.strip() == '}':
+                if indent < cls_indent + 2 and stripped == '}':
                     if last_indent >= cls_indent + 2:
                         self.method_bounds[method_sig] = (method_start, pos)
-                        self.method_cache[method_sig] = (method_code, method_loc_calls, method_glob_calls)
+                        self.method_cache[method_sig] = (''.join(method_code), method_loc_calls, method_glob_calls)
                     
                     method_sig = None
             
@@ -256,6 +629,81 @@ class ClassWrapper:
             pos += len(line)
             if line.strip('\n') and indent:
                 last_indent = indent
+        
+        # Index the above for lookups by position
+        
+        self.call_starts = sorted(self.method_calls)
+        self.call_order = {start: i for i, start in enumerate(self.method_calls)}
+        
+        self.method_index = IntervalIndex(self.method_bounds.values())
+        self.cond_index = IntervalIndex(self.cond_bounds)
+        
+        self.assignments = None # Built on first use by index_vars()
+        self.declarations = None
+    
+    """
+    Index, in a single pass over the code, the values assigned to every
+    variable and the type it's first declared with.
+    
+    Matches are looked for at every position, then overlapping ones
+    are discarded for a given variable, so that the values are the same
+    as from a findall() specific to this variable.
+    """
+    
+    def index_vars(self):
+        self.assignments = {}
+        self.declarations = {}
+        
+        ends = {}
+        for match in ASSIGNMENT.finditer(self.raw):
+            var = match.group(1)
+            if match.start() >= ends.get(var, 0):
+                self.assignments.setdefault(var, []).append(match.group(2))
+                ends[var] = match.end(2) + 1
+        
+        for match in DECLARATION.finditer(self.raw):
+            self.declarations.setdefault(match.group(2), match.group(1))
+    
+    # Return the values assigned to a variable, in order
+    
+    def assigned_values(self, var):
+        if self.assignments is None:
+            self.index_vars()
+        return self.assignments.get(var, [])
+    
+    # Return the type a variable was first declared with, if any
+    
+    def declared_type(self, var):
+        if self.declarations is None:
+            self.index_vars()
+        return self.declarations.get(var)
+    
+    """
+    Return calls to external methods located strictly between two
+    positions, in the same order as in method_calls.
+    """
+    
+    def calls_in_range(self, start, end):
+        starts = self.call_starts[bisect_right(self.call_starts, start):bisect_left(self.call_starts, end)]
+        return [(i, self.method_calls[i]) for i in sorted(starts, key=self.call_order.get)]
+    
+    # Return the bounds of the method or condition block containing a position, if any
+    
+    def method_at(self, pos):
+        return self.method_index.find(pos)
+    
+    def cond_at(self, pos):
+        return self.cond_index.find(pos)
+    
+    # Return the code from a position to the end of its line (or of the following ones)
+    
+    def lines_from(self, pos, count=1):
+        end = pos
+        for i in range(count):
+            end = self.raw.find('\n', end) + 1
+            if not end:
+                return self.raw[pos:]
+        return self.raw[pos:end - 1]
 
     """
     Return the method signature for a given method call, parsed out of
@@ -283,33 +731,37 @@ class ClassWrapper:
     """
     
     def get_method_unfold(self, ret_method, merged=None, unfold=True):
-        ret_code = ''
+        parts = []
+        self.unfold_method(ret_method, set() if merged is None else merged, parts, unfold)
+        return ''.join(parts)
+    
+    # Append the code to "parts" rather than returning it, not to copy it at every level
+    
+    def unfold_method(self, ret_method, merged, parts, unfold=True):
         ret, name, args = ret_method
         
-        if merged is None:
-            merged = set()
-        elif (ret, self.cls, name, args) in merged:
-            return ''
+        if (ret, self.cls, name, args) in merged:
+            return
         merged.add((ret, self.cls, name, args))
         
         if self.extends and self.extends != self.cls and ret_method not in self.method_cache:
-            return self.jar.decomp_func((ret, self.extends, name, args), merged)
+            return self.jar.unfold_func((ret, self.extends, name, args), merged, parts)
         
         if ret_method not in self.method_cache:
-            return ''
+            return
         method_code, method_loc_calls, method_glob_calls = self.method_cache[ret_method]
         
         if unfold:
             for func in method_glob_calls:
                 if func not in merged:
-                    ret_code += self.jar.decomp_func(func, merged)
+                    self.jar.unfold_func(func, merged, parts)
             
             for func in method_loc_calls:
                 ret2, name2, args2 = func
                 if (ret2, self.cls, name2, args2) not in merged:
-                    ret_code += self.get_method_unfold(func, merged)
+                    self.unfold_method(func, merged, parts)
         
-        return ret_code + method_code
+        parts.append(method_code)
     
     """
     Used for switch structures extraction.
@@ -359,3 +811,28 @@ class ClassWrapper:
             label_to_val = sorted(label_to_val.items())
         
         return label_to_val
+
+"""
+    Index a list of (start, end) intervals, that may be nested, in
+    order to find the first one (in list order) strictly containing a
+    given position without going through the whole list.
+"""
+class IntervalIndex:
+    def __init__(self, intervals):
+        self.intervals = sorted((start, end, order) for order, (start, end) in enumerate(intervals))
+        self.starts = [start for start, end, order in self.intervals]
+        self.max_ends = list(accumulate((end for start, end, order in self.intervals), max))
+    
+    def find(self, pos):
+        found = None
+        
+        # Walk back from the last interval starting before the
+        # position, for as long as one may still contain it
+        i = bisect_left(self.starts, pos) - 1
+        while i >= 0 and self.max_ends[i] > pos:
+            start, end, order = self.intervals[i]
+            if end > pos and (found is None or order < found[2]):
+                found = self.intervals[i]
+            i -= 1
+        
+        return found[:2] if found else None
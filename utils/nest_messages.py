@@ -1,10 +1,12 @@
 #!/usr/bin/python3
 #-*- encoding: Utf-8 -*-
-from google.protobuf.descriptor_pb2 import FileDescriptorProto, DescriptorProto
+from google.protobuf.descriptor_pb2 import FileDescriptorProto, FieldDescriptorProto
 from collections import defaultdict, OrderedDict
+from copy import deepcopy
 from re import sub
 
 from utils.descpb_to_proto import descpb_to_proto
+from utils.proto_schema import Message
 
 """
     When parsing output from e.g. the Java extractor, messages aren't
@@ -16,6 +18,10 @@ from utils.descpb_to_proto import descpb_to_proto
     
     Also, ensure every message starts by an uppercase letter. Once this
     is done, render the .proto files to ASCII using the existing module.
+    
+    Messages and enums are passed as Message/Enum objects, which are
+    nested by reference, and are only converted to descriptors when
+    building the files.
 """
 
 def nest_and_print_to_files(msg_path_to_obj, msg_to_referrers):
@@ -34,8 +40,8 @@ def nest_and_print_to_files(msg_path_to_obj, msg_to_referrers):
             for field, referrer, _ in referrers:
                 field = next((i for i in msg_path_to_obj[referrer].field if i.name == field), None)
                 
-                field.ClearField('type_name')
-                field.type = field.TYPE_BYTES
+                field.type_name = None
+                field.type = FieldDescriptorProto.TYPE_BYTES
         else:
             for _, referrer, _ in referrers:
                 msg_to_imports[referrer].append(msg)
@@ -59,7 +65,7 @@ def nest_and_print_to_files(msg_path_to_obj, msg_to_referrers):
             in_pkg = [(field, referrer) for field, referrer, _ in referrers \
                       if (get_pkg(referrer) == msg_pkg or not msg_pkg) \
                       and msg_to_topmost.get(referrer, referrer) != msg \
-                      and not msg_path_to_obj[referrer].options.map_entry \
+                      and not msg_path_to_obj[referrer].map_entry \
                       # If it's a subclass, parent must be the same
                       and ('$' not in msg or msg.split('.')[-1].split('$')[0] == \
                                         referrer.split('.')[-1].split('$')[0])]
@@ -83,7 +89,7 @@ def nest_and_print_to_files(msg_path_to_obj, msg_to_referrers):
         msg_obj = msg_path_to_obj[msg]
 
         # Check for duplicate enum fields in the same package.
-        if not isinstance(msg_obj, DescriptorProto):
+        if not isinstance(msg_obj, Message):
             for enum_field in msg_obj.value:
                 name = msg_pkg + '.' + enum_field.name
                 enumfield_to_enums[name].add(msg)
@@ -162,11 +168,10 @@ def nest_and_print_to_files(msg_path_to_obj, msg_to_referrers):
                     if import_path not in file_obj.dependency:
                         file_obj.dependency.append(import_path)
 
-            if isinstance(msg_obj, DescriptorProto):
-                nested = file_obj.message_type.add()
+            if isinstance(msg_obj, Message):
+                msg_obj.to_proto(file_obj.message_type.add())
             else:
-                nested = file_obj.enum_type.add()
-            nested.MergeFrom(msg_obj)
+                msg_obj.to_proto(file_obj.enum_type.add())
 
             path_to_defines[path].append(msg)
             path_to_defines[path] += [k for k, v in msg_to_topmost.items() if v == msg and '$map' not in k]
@@ -192,7 +197,7 @@ def merge_and_rename(msg, referrer, msg_pkg, is_group,
     # Ensure first letter is uppercase, and avoid conflicts
     new_name = new_name[0].upper() + new_name[1:]
     
-    other_names = [i.name for i in [*filter(lambda x: x.type != x.TYPE_GROUP,
+    other_names = [i.name for i in [*filter(lambda x: x.type != FieldDescriptorProto.TYPE_GROUP,
                                             referrer_obj.field),
                                     *referrer_obj.nested_type,
                                     *referrer_obj.enum_type]]
@@ -204,13 +209,17 @@ def merge_and_rename(msg, referrer, msg_pkg, is_group,
         new_name += '_'
     msg_obj.name = new_name
 
-    # Perform the merging of nested message
+    # Perform the merging of nested message. It is moved rather than
+    # copied, unless it is merged into itself (i.e a recursive group)
+    
+    if msg_to_topmost.get(referrer, referrer) == msg:
+        msg_obj = deepcopy(msg_obj)
     
-    if isinstance(msg_obj, DescriptorProto):
-        nested = referrer_obj.nested_type.add()
+    if isinstance(msg_obj, Message):
+        referrer_obj.nested_type.append(msg_obj)
     else:
-        nested = referrer_obj.enum_type.add()
-    nested.MergeFrom(msg_obj)
+        referrer_obj.enum_type.append(msg_obj)
+    nested = msg_obj
     
     # Perform the renaming of references to nested message, and
     # of references to children of nested message. Also, fix imports
@@ -253,7 +262,7 @@ def fix_naming(nested, new_path, prev_path, top_path,
         msg_to_imports[referrer_top_path].append(top_path)
     
     # Do the same with children.
-    if isinstance(nested, DescriptorProto):
+    if isinstance(nested, Message):
         for child in [*nested.nested_type, *nested.enum_type]:
             fix_naming(child, new_path + '.' + child.name, prev_path + '.' + child.name, top_path,
                        msg_to_referrers, msg_to_topmost, msg_to_newloc, msg_to_imports, msg_path_to_obj, newloc_to_msg)
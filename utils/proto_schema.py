@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from google.protobuf.descriptor_pb2 import DescriptorProto, EnumDescriptorProto
+from collections import namedtuple
+
+"""
+    Lightweight representation of the messages and enums rebuilt by
+    extractors, which may be counted by tens of thousands for large
+    applications.
+    
+    Objects only hold the attributes that extractors use, through
+    __slots__, under the same names as in descriptor protos. They are
+    turned into DescriptorProto/EnumDescriptorProto objects (that are
+    much heavier, with the pure-Python implementation of Protobuf) only
+    once nested, when writing output files.
+    
+    Field labels and types are FieldDescriptorProto constants.
+"""
+
+class Field:
+    __slots__ = ('name', 'number', 'label', 'type', 'type_name', 'default_value', 'oneof_index')
+    
+    def __init__(self, name=None, number=None, label=None, type=None, type_name=None, default_value=None, oneof_index=None):
+        self.name = name
+        self.number = number
+        self.label = label
+        self.type = type
+        self.type_name = type_name
+        self.default_value = default_value
+        self.oneof_index = oneof_index
+    
+    def to_proto(self, desc):
+        for attr in self.__slots__:
+            if getattr(self, attr) is not None:
+                setattr(desc, attr, getattr(self, attr))
+        return desc
+    
+    def dump(self):
+        return [getattr(self, attr) for attr in self.__slots__]
+
+class Message:
+    __slots__ = ('name', 'field', 'oneof_decl', 'nested_type', 'enum_type', 'map_entry')
+    
+    def __init__(self, name=None, map_entry=False):
+        self.name = name
+        self.field = []
+        self.oneof_decl = [] # Names of the oneofs
+        self.nested_type = []
+        self.enum_type = []
+        self.map_entry = map_entry
+    
+    def to_proto(self, desc=None):
+        if desc is None:
+            desc = DescriptorProto()
+        
+        desc.name = self.name
+        for field in self.field:
+            field.to_proto(desc.field.add())
+        for name in self.oneof_decl:
+            desc.oneof_decl.add().name = name
+        for nested in self.nested_type:
+            nested.to_proto(desc.nested_type.add())
+        for nested in self.enum_type:
+            nested.to_proto(desc.enum_type.add())
+        if self.map_entry:
+            desc.options.map_entry = True
+        
+        return desc
+    
+    def dump(self):
+        return ['message', self.name, [field.dump() for field in self.field], self.oneof_decl,
+                [nested.dump() for nested in self.nested_type], [nested.dump() for nested in self.enum_type], self.map_entry]
+
+EnumValue = namedtuple('EnumValue', 'name number')
+
+class Enum:
+    __slots__ = ('name', 'value')
+    
+    def __init__(self, name=None):
+        self.name = name
+        self.value = []
+    
+    def to_proto(self, desc=None):
+        if desc is None:
+            desc = EnumDescriptorProto()
+        
+        desc.name = self.name
+        for name, number in self.value:
+            value = desc.value.add()
+            value.name = name
+            value.number = number
+        
+        return desc
+    
+    def dump(self):
+        return ['enum', self.name, [list(value) for value in self.value]]
+
+"""
+    Rebuild a Message or Enum from the output of its dump() method, once
+    e.g serialized to JSON.
+"""
+
+def load_schema(data):
+    if data[0] == 'enum':
+        obj = Enum(data[1])
+        obj.value = [EnumValue(*value) for value in data[2]]
+    
+    else:
+        kind, name, fields, oneofs, nested_types, enum_types, map_entry = data
+        
+        obj = Message(name, map_entry)
+        obj.field = [Field(*field) for field in fields]
+        obj.oneof_decl = list(oneofs)
+        obj.nested_type = [load_schema(nested) for nested in nested_types]
+        obj.enum_type = [load_schema(nested) for nested in enum_types]
+    
+    return obj